@@ -0,0 +1,170 @@
+import os
+import random
+import argparse
+import contextlib
+
+from common import ROOT, time_fn, write_results
+
+import torch
+import torch.nn as nn
+
+from dataset import collate_fn
+from models.build import MODELS, model_spec, make_model
+
+
+# forward and forward+backward time of every model at training / inference shapes
+# python benchmarks/bench_models.py --out benchmarks/results/models.json
+# python benchmarks/bench_models.py --models pesi lstm --batch_sizes 16 128 --epi_lens 72
+# - inputs are random paratopes (six CDRs joined by "/") and epitopes of the given length, batched by
+#   dataset.collate_fn as in cov_train, so the tokenization inside forward is part of the time
+# - on CPU the models' .cuda() calls are made no-ops while they run; on CUDA every trial is synchronised
+# - a case that runs out of memory is recorded with its error and the suite goes on, any other error stops
+#   the suite with a non-zero exit
+# - python benchmarks/bench_models.py --models SetModel SetModel_lstm SetModel_window compares the per-kmer
+#   transformer / LSTM encoders with WindowEncoder, a new model (see models/build.py) and not a faster form of them
+
+# models outside the registry, with the hyperparameters pre_train.py used for them
+EXTRA_MODELS = {
+    "EnsembleModel": {"module": "ensemble", "cls": "EnsembleModel",
+                      "kwargs": dict(embed_size=16, hidden=64, max_len=100, num_encoder_layers=1, num_heads=2,
+                                     num_inds=6, num_outputs=6, ln=False, dropout=0.5, use_coattn=False)},
+    "InteractTransformer": {"module": "ITransformer", "cls": "InteractTransformer",
+                            "kwargs": dict(embed_size=32, num_encoder_layers=1, nhead=2, dropout=0.3)},
+    "SetModel": {"module": "setmodel", "cls": "SetModel",
+                 "kwargs": dict(embed_size=32, hidden=64, num_layers=1, dropout=0.3, k4kmer=3, use_pretrain=False,
+                                use_coattn=False, seq_encoder_type="transformer", num_heads=2, num_inds=6,
+                                num_outputs=6, ln=True)},
+    # the same SetModel with the per-kmer LSTM, SetModel_window (WindowEncoder) is registered in models/build.py
+    "SetModel_lstm": {"module": "setmodel", "cls": "SetModel",
+                      "kwargs": dict(embed_size=32, hidden=64, num_layers=1, dropout=0.3, k4kmer=3, use_pretrain=False,
+                                     use_coattn=False, seq_encoder_type="lstm", num_heads=2, num_inds=6,
+                                     num_outputs=6, ln=True)},
+}
+
+AMINO = "ACDEFGHIKLMNPQRSTVWY"
+CDR_LENS = [8, 8, 15, 11, 3, 9]             # H1, H2, H3, L1, L2, L3, typical lengths
+
+
+def spec_of(name):
+    return EXTRA_MODELS[name] if name in EXTRA_MODELS else model_spec(name, stage="cov")
+
+
+def random_seq(length, rng):
+    return "".join(rng.choice(AMINO) for _ in range(length))
+
+
+def make_batch(batch_size, epi_len, use_lens, seed=0):
+    '''
+    :return:    collate_fn batch of batch_size random (paratope, epitope) pairs, epitopes of length epi_len
+    '''
+    rng = random.Random(seed)
+    pairs = [("/".join(random_seq(n + rng.randint(-2, 2), rng) for n in CDR_LENS),
+              random_seq(epi_len, rng),
+              torch.tensor(float(rng.random()<0.5))) for _ in range(batch_size)]
+    return collate_fn(pairs, use_augment=False, return_lens=use_lens)
+
+
+@contextlib.contextmanager
+def cuda_calls_on(device):
+    # the models move their inputs with .cuda(), on CPU that has to leave them where they are
+    if device.type=="cuda":
+        yield
+        return
+    tensor_cuda, module_cuda = torch.Tensor.cuda, nn.Module.cuda
+    torch.Tensor.cuda = lambda self, *args, **kwargs: self
+    nn.Module.cuda = lambda self, *args, **kwargs: self
+    try:
+        yield
+    finally:
+        torch.Tensor.cuda, nn.Module.cuda = tensor_cuda, module_cuda
+
+
+def output_of(out):
+    # use_BSS models return (pred, BSS)
+    return out[0] if isinstance(out, tuple) else out
+
+
+def out_of_memory(e):
+    # CUDA raises torch.cuda.OutOfMemoryError, the CPU allocator a RuntimeError
+    oom = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom is not None and isinstance(e, oom):
+        return True
+    message = str(e)
+    return isinstance(e, RuntimeError) and ("out of memory" in message or "DefaultCPUAllocator" in message)
+
+
+def bench_model(name, batch_sizes, epi_lens, device, modes, warmup, trials, max_seconds):
+    model = make_model(spec_of(name)).to(device)
+    use_lens = getattr(model, "accepts_lens", False)
+    params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    sync = torch.cuda.synchronize if device.type=="cuda" else None
+    criterion = nn.BCELoss()
+
+    results = []
+    for epi_len in epi_lens:
+        for batch_size in batch_sizes:
+            para, epi, label, *lens = make_batch(batch_size, epi_len, use_lens)
+            label = label.view(-1).to(device)
+
+            def forward():
+                with torch.no_grad():
+                    model(para, epi, *lens)
+
+            def forward_backward():
+                model.zero_grad(set_to_none=True)
+                pred = output_of(model(para, epi, *lens))
+                criterion(pred.view(-1), label).backward()
+
+            for mode, fn in [("forward", forward), ("forward_backward", forward_backward)]:
+                if mode not in modes:
+                    continue
+                model.train(mode=="forward_backward")
+                result = {"name": "{}/{}".format(name, mode), "model": name, "mode": mode,
+                          "params": {"batch_size": batch_size, "epi_len": epi_len, "padded_len": len(para[0])},
+                          "num_params": params}
+                try:
+                    result.update(time_fn(fn, warmup=warmup, trials=trials, max_seconds=max_seconds, sync=sync))
+                    result["samples_per_s"] = batch_size / (result["median_ms"] / 1e3)
+                    print("{:<24}{:<18}batch {:<6}epi {:<5}{:>10.2f} ms  ± {:.2f}  {:>10.0f} samples/s".format(
+                        name, mode, batch_size, epi_len, result["median_ms"], result["mad_ms"], result["samples_per_s"]))
+                except Exception as e:
+                    result["error"] = "{}: {}".format(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+                    print("{:<24}{:<18}batch {:<6}epi {:<5}failed: {}".format(name, mode, batch_size, epi_len, result["error"]))
+                    if not out_of_memory(e):
+                        raise
+                    if device.type=="cuda":
+                        torch.cuda.empty_cache()
+                results.append(result)
+    return results
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="forward / backward benchmark of every model")
+    parser.add_argument("--models", type=str, nargs="*", default=list(MODELS.keys()) + list(EXTRA_MODELS.keys()))
+    parser.add_argument("--batch_sizes", type=int, nargs="*", default=[1, 16, 128, 1024])
+    parser.add_argument("--epi_lens", type=int, nargs="*", default=[48, 72, 800])
+    parser.add_argument("--modes", type=str, nargs="*", default=["forward", "forward_backward"])
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads, default torch's")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--trials", type=int, default=10)
+    parser.add_argument("--max_seconds", type=float, default=30.0, help="time budget per case, at least 3 trials")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=os.path.join(ROOT, "benchmarks", "results", "models.json"))
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+
+    results = []
+    with cuda_calls_on(device):
+        for name in args.models:
+            if name not in MODELS and name not in EXTRA_MODELS:
+                print("unknown model {}, skipped".format(name))
+                continue
+            results += bench_model(name, args.batch_sizes, args.epi_lens, device, args.modes,
+                                   args.warmup, args.trials, args.max_seconds)
+
+    write_results(args.out, results, config=vars(args))
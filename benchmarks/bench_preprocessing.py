@@ -0,0 +1,146 @@
+import os
+import math
+import pickle
+import argparse
+import tempfile
+import contextlib
+
+from common import ROOT, time_fn, write_results
+import synthetic
+
+
+# scaling of the SAbDab / CoV-AbDab preprocessing on synthetic data (benchmarks/synthetic.py)
+# python benchmarks/bench_preprocessing.py --sizes 1000 3000 10000 30000 100000
+# cases, each timed at every size n:
+#   get_knearest_epi    k nearest antigen residues of n complexes
+#   get_pair            pairs of n complexes with their knn epitopes cached, seq_clip_mode 1 / neg_sample_mode 0
+#                       as pre_train (the cache pickle is read from a temporary ./data/)
+#   seq_sim             n alignments of random 48-residue epitopes
+#   sabdab_dataset      SAbDabDataset from a preprocessed pickle of n complexes (1 + num_neg pairs each)
+#   cov_dataset         SeqDataset from a CoV-AbDab-shaped csv of n rows
+# - a case stops growing once a size takes longer than --max_seconds, the larger sizes are reported with the
+#   time extrapolated from the fitted curve
+# - the curve is time ~ n^exponent, fitted by least squares on log time / log n of the measured sizes
+# - runs in a temporary working directory, get_pair and the datasets write ./data/ files
+
+CASES = ["get_knearest_epi", "get_pair", "seq_sim", "sabdab_dataset", "cov_dataset"]
+
+
+@contextlib.contextmanager
+def quiet():
+    # the preprocessing prints and shows tqdm bars per complex
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def prepare(case, n, args):
+    '''
+    :return:    function running case on n synthetic inputs, built outside the timed region
+    '''
+    from utils import get_knearest_epi, seq_sim
+    from dataset import get_pair, SAbDabDataset, SeqDataset
+
+    if case=="get_knearest_epi":
+        data = synthetic.make_sabdab(n, seed=args.seed, pool=args.pool)
+        return lambda: get_knearest_epi(data, K=48)
+
+    if case=="get_pair":
+        data = synthetic.make_sabdab(n, seed=args.seed, pool=args.pool)
+        with quiet():
+            data = get_knearest_epi(data, K=48)
+        pickle.dump(data, open("./data/tmp_knnepi.pkl", "wb"))
+        return lambda: get_pair(data, epi_seq_length=args.epi_len, seq_clip_mode=1, neg_sample_mode=0,
+                                num_neg=args.num_neg, K=48, use_cache=True, use_pair=False)
+
+    if case=="seq_sim":
+        rng = synthetic.np.random.default_rng(args.seed)
+        pairs = [(synthetic.random_seq(48, rng), synthetic.random_seq(48, rng)) for _ in range(n)]
+        return lambda: [seq_sim(a, b) for a, b in pairs]
+
+    if case=="sabdab_dataset":
+        path = "./data/processed_{}.pkl".format(n)
+        pickle.dump(synthetic.make_pairs(n, seed=args.seed, epi_len=args.epi_len, num_neg=args.num_neg), open(path, "wb"))
+        return lambda: SAbDabDataset(data=None, epi_seq_length=args.epi_len, is_train_test_full="train",
+                                     is_shuffle=True, folds_path=path)
+
+    if case=="cov_dataset":
+        path = "./data/cov_{}.csv".format(n)
+        synthetic.make_cov_abdab(n, seed=args.seed).to_csv(path, index=False)
+        return lambda: SeqDataset(data_path=path, kfold=10, holdout_fold=0, is_train_test_full="train")
+
+    raise ValueError("unknown case {}".format(case))
+
+
+def fit_curve(points):
+    '''
+    :param points:  [(n, seconds)] of the measured sizes
+    :return:        exponent, coefficient of seconds = coefficient * n^exponent, None with fewer than 2 sizes
+    '''
+    if len(points)<2:
+        return None, None
+    xs = [math.log(n) for n, _ in points]
+    ys = [math.log(max(t, 1e-9)) for _, t in points]
+    mx, my = sum(xs) / len(xs), sum(ys) / len(ys)
+    exponent = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sum((x - mx) ** 2 for x in xs)
+    return exponent, math.exp(my - exponent * mx)
+
+
+def run_case(case, sizes, args):
+    results = []
+    points = []
+    over_budget = False
+    for n in sizes:
+        result = {"name": case, "params": {"n": n}}
+        if over_budget:
+            result["skipped"] = True
+            results.append(result)
+            continue
+
+        fn = prepare(case, n, args)
+        with quiet():
+            result.update(time_fn(fn, warmup=0, trials=args.trials, min_trials=1, max_seconds=args.max_seconds))
+        seconds = result["median_ms"] / 1e3
+        result["per_item_us"] = seconds / n * 1e6
+        points.append((n, seconds))
+        results.append(result)
+        print("{:<20}n {:<8}{:>12.3f} s{:>12.2f} us/item".format(case, n, seconds, result["per_item_us"]))
+        over_budget = seconds>args.max_seconds
+
+    exponent, coef = fit_curve(points)
+    for result in results:
+        if result.get("skipped") and exponent is not None:
+            result["estimated_s"] = coef * result["params"]["n"] ** exponent
+            print("{:<20}n {:<8}{:>12.1f} s estimated, over the budget".format(case, result["params"]["n"],
+                                                                               result["estimated_s"]))
+    if exponent is not None:
+        print("{:<20}time ~ n^{:.2f}".format(case, exponent))
+    return results, {"exponent": exponent, "coefficient": coef}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="preprocessing scaling benchmark on synthetic SAbDab / CoV-AbDab data")
+    parser.add_argument("--cases", type=str, nargs="*", default=CASES, choices=CASES)
+    parser.add_argument("--sizes", type=int, nargs="*", default=[1000, 3000, 10000, 30000, 100000])
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--max_seconds", type=float, default=300.0, help="a case stops growing past this time")
+    parser.add_argument("--pool", type=int, default=1000, help="distinct synthetic complexes")
+    parser.add_argument("--epi_len", type=int, default=72)
+    parser.add_argument("--num_neg", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=str, default=os.path.join(ROOT, "benchmarks", "results", "preprocessing.json"))
+    args = parser.parse_args()
+
+    results = []
+    curves = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "data"))
+        os.chdir(tmp)
+        try:
+            for case in args.cases:
+                case_results, curves[case] = run_case(case, sorted(args.sizes), args)
+                results += case_results
+        finally:
+            os.chdir(cwd)
+
+    write_results(args.out, results, curves=curves, config=vars(args))
@@ -0,0 +1,90 @@
+import argparse
+
+import common            # puts the repository root on sys.path
+from bench_models import EXTRA_MODELS, make_batch, cuda_calls_on, spec_of, output_of
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from utils import vocab
+from models.build import MODELS, make_model
+from models.masonscnn import CNNmodule
+from models.TextCNN import TextInception
+
+
+# correctness checks of the fast model paths, on the CPU
+# python benchmarks/check_models.py
+# - the gathered convolutions over token indices (CNNmodule / TextInception index_conv) match the convolutions
+#   over the one-hot input, in output and in gradient
+# - every model runs forward + backward in train mode and forward in eval mode on a collate_fn batch
+# exits non-zero on the first failure, with the failing check
+
+
+def fail(message):
+    print("FAIL: {}".format(message))
+    exit(1)
+
+
+def check_index_conv(name, module, idx, atol):
+    '''
+    :param module:  module taking (batch, len) token indices or the (batch, len, len(vocab)) one-hot input
+    :param idx:     (batch, len) token indices
+    '''
+    onehot = F.one_hot(idx, len(vocab)).float()
+    module.eval()
+    diff = (module(idx) - module(onehot)).abs().max().item()
+    if diff>atol:
+        fail("{} index_conv differs from the one-hot conv by {:.3g}".format(name, diff))
+
+    # gradients of the weights through both paths
+    grads = []
+    for x in [idx, onehot]:
+        module.zero_grad(set_to_none=True)
+        module(x).sum().backward()
+        grads.append([p.grad.clone() for p in module.parameters()])
+    grad_diff = max((a - b).abs().max().item() for a, b in zip(*grads))
+    if grad_diff>atol * 100:
+        fail("{} index_conv gradients differ from the one-hot conv by {:.3g}".format(name, grad_diff))
+
+    # dropout in train mode must not break the index path
+    module.train()
+    module(idx).sum().backward()
+    print("{:<24}ok, max diff {:.2g}, grad diff {:.2g}".format(name, diff, grad_diff))
+
+
+def check_model(name, batch_size, epi_len):
+    model = make_model(spec_of(name))
+    use_lens = getattr(model, "accepts_lens", False)
+    para, epi, label, *lens = make_batch(batch_size, epi_len, use_lens)
+    try:
+        model.train()
+        model.zero_grad(set_to_none=True)
+        pred = output_of(model(para, epi, *lens))
+        nn.BCELoss()(pred.view(-1), label.view(-1)).backward()
+        model.eval()
+        with torch.no_grad():
+            output_of(model(para, epi, *lens))
+    except Exception as e:
+        fail("{} forward / backward: {}: {}".format(name, type(e).__name__, e))
+    print("{:<24}ok".format(name))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="correctness checks of the fast model paths")
+    parser.add_argument("--models", type=str, nargs="*", default=list(MODELS.keys()) + list(EXTRA_MODELS.keys()))
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--epi_len", type=int, default=72)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    idx = torch.randint(0, len(vocab), (4, 100))
+    check_index_conv("CNNmodule", CNNmodule(in_channel=len(vocab), kernel_width=len(vocab), l=100, out_channels=64),
+                     idx, args.atol)
+    check_index_conv("TextInception", TextInception(in_channel=1, kernel_width=len(vocab)), idx, args.atol)
+
+    with cuda_calls_on(torch.device("cpu")):
+        for name in args.models:
+            check_model(name, args.batch_size, args.epi_len)
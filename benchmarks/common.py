@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+from statistics import median
+
+
+# timing helpers and run environment shared by the benchmark scripts
+# every result is {"name", "params", "times_ms", "median_ms", "mad_ms", "min_ms", ...}, written as
+# {"environment": environment(), "results": [...]} so runs on different machines / commits can be compared
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        return out.stdout.strip() + ("-dirty" if dirty.stdout.strip()!="" else "")
+    except OSError:
+        return None
+
+
+def environment():
+    env = {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "host": socket.gethostname(),
+           "platform": platform.platform(),
+           "processor": platform.processor(),
+           "cpu_count": os.cpu_count(),
+           "python": platform.python_version(),
+           "commit": git_commit()}
+    for name in ["numpy", "torch", "pandas"]:
+        module = sys.modules.get(name)
+        env[name] = getattr(module, "__version__", None) if module is not None else None
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        env["torch_threads"] = torch.get_num_threads()
+        env["cuda"] = torch.cuda.get_device_name() if torch.cuda.is_available() else None
+    return env
+
+
+def summarize(times):
+    '''
+    :param times:   seconds of each trial
+    :return:        median / MAD (median absolute deviation) / min / mean in ms, and the trials
+    '''
+    ms = [t * 1e3 for t in times]
+    med = median(ms)
+    return {"times_ms": ms,
+            "median_ms": med,
+            "mad_ms": median([abs(t - med) for t in ms]),
+            "min_ms": min(ms),
+            "mean_ms": sum(ms) / len(ms)}
+
+
+def time_fn(fn, warmup=2, trials=10, min_trials=3, max_seconds=None, sync=None):
+    '''
+    :param fn:          function to time, called without arguments
+    :param warmup:      untimed calls first
+    :param trials:      timed calls
+    :param min_trials:  timed calls made even when max_seconds is exceeded
+    :param max_seconds: stop after the trial that exceeds this total, for slow cases
+    :param sync:        called after fn inside the timed region, e.g. torch.cuda.synchronize
+    :return:            summarize() of the timed calls
+    '''
+    for _ in range(warmup):
+        fn()
+        if sync is not None:
+            sync()
+
+    times = []
+    start = time.perf_counter()
+    for i in range(trials):
+        t = time.perf_counter()
+        fn()
+        if sync is not None:
+            sync()
+        times.append(time.perf_counter() - t)
+        if max_seconds is not None and i+1>=min_trials and time.perf_counter() - start>max_seconds:
+            break
+
+    return summarize(times)
+
+
+def write_results(path, results, **extra):
+    if os.path.dirname(path)!="":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(dict({"environment": environment(), "results": results}, **extra), f, indent=1)
+    print("results written to {}".format(path))
+
+
+def load_results(path):
+    return json.load(open(path))
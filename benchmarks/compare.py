@@ -0,0 +1,188 @@
+import os
+import pickle
+import argparse
+import tempfile
+
+from common import ROOT, environment, time_fn, write_results, load_results
+from bench_models import make_batch, cuda_calls_on, spec_of
+from bench_preprocessing import quiet
+import synthetic
+
+import torch
+
+
+# performance regression gate of the model and preprocessing hot paths
+# python benchmarks/compare.py --save-baseline       time the hot paths and write benchmarks/baseline.json
+# python benchmarks/compare.py                       time them again, exit 1 if one got slower than allowed
+# - every case is repeated --trials times and summarised by its median and MAD (median absolute deviation)
+# - a case regresses when its median exceeds the baseline median by more than the larger of
+#     --tolerance * baseline median                      (relative slack)
+#     --mad_k * 1.4826 * max(baseline MAD, current MAD)  (noise, MAD scaled to a standard deviation)
+# - medians only compare on the same machine and settings: save the baseline on the machine that runs the
+#   gate, a mismatch of host / cpu / torch / threads with the baseline is printed as a warning
+# - torch runs on --threads CPU threads (1 by default), the least noisy setting
+# - no baseline is committed, timings of another machine would not compare: until benchmarks/baseline.json is
+#   recorded and committed from the machine that runs the gate, the gate is skipped (exit 0, with a message);
+#   --require-baseline makes a missing baseline a failure instead
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+
+def hot_paths(tmp):
+    '''
+    :param tmp: working directory of get_pair, which writes ./data/tmp_knnepi.pkl
+    :return:    {case: function to time}, inputs built here outside the timed region
+    '''
+    from utils import to_index, seq_sim, get_knearest_epi
+    from dataset import collate_fn, get_pair
+    from models.build import make_model
+    from models.setmodel import MAB
+
+    cases = {}
+
+    mab = MAB(32, 32, 64, num_heads=2, ln=True).eval()
+    Q, K = torch.randn(128, 74, 32), torch.randn(128, 74, 32)
+
+    def mab_forward():
+        with torch.no_grad():
+            mab(Q, K)
+    cases["MAB.forward"] = mab_forward
+
+    pairs = [(p, e, torch.tensor(float(l))) for p, e, l in synthetic.make_pairs(26, num_neg=4)[:128]]
+    cases["collate_fn"] = lambda: collate_fn(pairs)
+
+    paras = collate_fn(pairs)[0]
+    cases["to_index"] = lambda: to_index(paras)
+
+    for name in ["pesi", "lstm"]:
+        model = make_model(spec_of(name)).eval()
+        use_lens = getattr(model, "accepts_lens", False)
+        para, epi, _, *lens = make_batch(128, 72, use_lens)
+
+        def forward(model=model, para=para, epi=epi, lens=lens):
+            with torch.no_grad():
+                model(para, epi, *lens)
+        cases["{}.forward".format(name)] = forward
+
+    rng = synthetic.np.random.default_rng(0)
+    seqs = [(synthetic.random_seq(48, rng), synthetic.random_seq(48, rng)) for _ in range(100)]
+    cases["seq_sim"] = lambda: [seq_sim(a, b) for a, b in seqs]
+
+    complexes = synthetic.make_sabdab(50, pool=50)
+    cases["get_knearest_epi"] = lambda: get_knearest_epi(complexes, K=48)
+
+    knn = synthetic.make_sabdab(100, seed=1, pool=100)
+    with quiet():
+        knn = get_knearest_epi(knn, K=48)
+    os.makedirs(os.path.join(tmp, "data"), exist_ok=True)
+    pickle.dump(knn, open(os.path.join(tmp, "data", "tmp_knnepi.pkl"), "wb"))
+    cases["get_pair"] = lambda: get_pair(knn, epi_seq_length=72, seq_clip_mode=1, neg_sample_mode=0,
+                                         num_neg=4, K=48, use_cache=True, use_pair=False)
+    return cases
+
+
+def compare(baseline, current, tolerance, mad_k):
+    '''
+    :param baseline:    {case: result} of the baseline
+    :param current:     {case: result} of this run
+    :return:            table rows (case, baseline ms, current ms, change, allowed ms, status), number of regressions
+    '''
+    rows, regressions = [], 0
+    for name in list(baseline) + [n for n in current if n not in baseline]:
+        base, cur = baseline.get(name), current.get(name)
+        if cur is None:
+            rows.append((name, base["median_ms"], None, None, None, "missing"))
+            continue
+        if base is None:
+            rows.append((name, None, cur["median_ms"], None, None, "new"))
+            continue
+        noise = 1.4826 * max(base["mad_ms"], cur["mad_ms"])
+        slack = max(tolerance * base["median_ms"], mad_k * noise)
+        change = cur["median_ms"] / base["median_ms"] - 1
+        if cur["median_ms"]>base["median_ms"] + slack:
+            status = "SLOWER"
+            regressions += 1
+        elif cur["median_ms"]<base["median_ms"] - slack:
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append((name, base["median_ms"], cur["median_ms"], change, base["median_ms"] + slack, status))
+    return rows, regressions
+
+
+def table(rows):
+    fmt = lambda x, spec: "-" if x is None else spec.format(x)
+    lines = ["{:<20}{:>14}{:>14}{:>10}{:>14}  {}".format("case", "baseline ms", "current ms", "change",
+                                                        "allowed ms", "status")]
+    for name, base, cur, change, allowed, status in rows:
+        lines.append("{:<20}{:>14}{:>14}{:>10}{:>14}  {}".format(name, fmt(base, "{:.3f}"), fmt(cur, "{:.3f}"),
+                                                                fmt(change, "{:+.1%}"), fmt(allowed, "{:.3f}"), status))
+    return "\n".join(lines)
+
+
+def environment_mismatch(saved, current):
+    keys = ["host", "processor", "cpu_count", "torch", "torch_threads"]
+    return ["{}: {} -> {}".format(k, saved.get(k), current.get(k)) for k in keys if saved.get(k)!=current.get(k)]
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="compare the hot paths against a saved baseline")
+    parser.add_argument("--save-baseline", dest="save_baseline", action="store_true",
+                        help="write the timings as the new baseline instead of comparing")
+    parser.add_argument("--baseline", type=str, default=BASELINE)
+    parser.add_argument("--require-baseline", dest="require_baseline", action="store_true",
+                        help="exit 1 without a baseline instead of skipping the gate")
+    parser.add_argument("--cases", type=str, nargs="*", default=None, help="default all")
+    parser.add_argument("--trials", type=int, default=15)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--max_seconds", type=float, default=20.0, help="time budget per case, at least 5 trials")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative slowdown allowed")
+    parser.add_argument("--mad_k", type=float, default=3.0, help="slowdown allowed in noise units")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--out", type=str, default=None, help="also write this run's timings here")
+    args = parser.parse_args()
+
+    if not args.save_baseline and not os.path.exists(args.baseline):
+        print("no baseline at {}, the regression gate is skipped".format(args.baseline))
+        print("record it on the machine that runs the gate with --save-baseline and commit it")
+        exit(1 if args.require_baseline else 0)
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+
+    results = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, cuda_calls_on(torch.device("cpu")):
+        os.chdir(tmp)
+        try:
+            cases = hot_paths(tmp)
+            for name, fn in cases.items():
+                if args.cases is not None and name not in args.cases:
+                    continue
+                with quiet():
+                    result = time_fn(fn, warmup=args.warmup, trials=args.trials, min_trials=5,
+                                     max_seconds=args.max_seconds)
+                result["name"] = name
+                results.append(result)
+                print("{:<20}{:>12.3f} ms  ± {:.3f}".format(name, result["median_ms"], result["mad_ms"]))
+        finally:
+            os.chdir(cwd)
+
+    if args.out is not None:
+        write_results(args.out, results, config=vars(args))
+    if args.save_baseline:
+        write_results(args.baseline, results, config=vars(args))
+        exit(0)
+
+    saved = load_results(args.baseline)
+    for line in environment_mismatch(saved["environment"], environment()):
+        print("warning: baseline environment differs, {}".format(line))
+
+    baseline = {r["name"]: r for r in saved["results"]}
+    if args.cases is not None:
+        baseline = {k: v for k, v in baseline.items() if k in args.cases}
+    rows, regressions = compare(baseline, {r["name"]: r for r in results}, args.tolerance, args.mad_k)
+    print(table(rows))
+    if regressions>0:
+        print("{} hot path(s) slower than the baseline allows".format(regressions))
+        exit(1)
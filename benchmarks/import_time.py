@@ -0,0 +1,77 @@
+import os
+import sys
+import argparse
+import subprocess
+from statistics import median
+
+
+# cold-start import budget of the inference path: a model class and the tokenizer
+# python benchmarks/import_time.py --budget 0.5
+# exits non-zero if the median overhead over `import torch, numpy` exceeds the budget
+# or if any forbidden (training / plotting / ESM) module gets imported beyond those torch and numpy import themselves
+# (torch.hub pulls in tqdm where it is installed)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INFERENCE_STMT = "from utils import to_index, seq_pad_clip; from models import MasonsCNN, TextCNN, AgFastParapred"
+BASELINE_STMT = "import torch, numpy"
+FORBIDDEN = ["matplotlib", "pandas", "sklearn", "imblearn", "Bio", "esm", "tqdm"]
+
+
+def import_time(stmt):
+    '''
+    :param stmt:    python statement, run in a fresh interpreter
+    :return:        total import time in seconds, set of imported top-level packages
+    '''
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", stmt], cwd=ROOT,
+                          stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if proc.returncode!=0:
+        print(proc.stderr)
+        raise RuntimeError("failed to run: {}".format(stmt))
+
+    total = 0
+    packages = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+        # top-level imports only, nested ones are part of their parent's cumulative time
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+
+    return total / 1e6, packages
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stmt", type=str, default=INFERENCE_STMT, help="imports of the path to measure")
+    parser.add_argument("--budget", type=float, default=0.5, help="seconds allowed on top of torch and numpy")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--forbid", type=str, nargs="*", default=FORBIDDEN)
+    args = parser.parse_args()
+
+    baseline, stmt_times = [], []
+    for _ in range(args.repeat):
+        t, baseline_packages = import_time(BASELINE_STMT)
+        baseline.append(t)
+        t, packages = import_time(args.stmt)
+        stmt_times.append(t)
+
+    overhead = median(stmt_times) - median(baseline)
+    print("{}".format(args.stmt))
+    print("total {:.3f}s\ttorch+numpy {:.3f}s\toverhead {:.3f}s\tbudget {:.3f}s".format(
+        median(stmt_times), median(baseline), overhead, args.budget))
+
+    failed = False
+    forbidden = sorted(set(args.forbid) & (packages - baseline_packages))
+    if forbidden:
+        print("FAIL: imported {}".format(", ".join(forbidden)))
+        failed = True
+    if overhead > args.budget:
+        print("FAIL: import overhead {:.3f}s over budget {:.3f}s".format(overhead, args.budget))
+        failed = True
+
+    if failed:
+        exit(1)
+    print("OK")
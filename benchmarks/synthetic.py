@@ -0,0 +1,148 @@
+import os
+import copy
+import pickle
+import argparse
+import numpy as np
+
+
+# synthetic data in the formats of ./data/data_list.pkl (SAbDab) and the CoV-AbDab csv, for benchmarks and
+# offline tests of the preprocessing
+# python benchmarks/synthetic.py sabdab 5000 ./data/synthetic_data_list.pkl
+# python benchmarks/synthetic.py cov 20000 ./data/synthetic_cov.csv
+# SAbDab complex, as read by pre_train.load_data, utils.get_knearest_epi and dataset.get_pair:
+#   {"pdb", "Hchain", "Lchain", "Achain": [chain ids],
+#    "Hseq" / "Lseq" / "Aseq": {chain id: [{"name": "GLN", "abbr": "Q", "pos": float32 (4, 3) N / CA / C / O}]},
+#    "H1", "H2", "H3", "L1", "L2", "L3": CDR sequences, substrings of the heavy / light chain,
+#    "Hpos" / "Lpos": per-residue (4, 3) coordinates, "Apos": one (n, 4, 3) array per antigen chain}
+# - chains are random walks with 3.8 A between CA atoms, the antigen is placed in contact with the CDRs
+# - complexes beyond `pool` distinct ones share their chains with earlier ones (the top-level dicts are
+#   separate, get_knearest_epi writes "epitope" into them), which keeps 100k complexes in memory; the work
+#   per complex is unchanged
+
+AMINO = "ACDEFGHIKLMNPQRSTVWY"
+THREE = {"A": "ALA", "C": "CYS", "D": "ASP", "E": "GLU", "F": "PHE", "G": "GLY", "H": "HIS", "I": "ILE",
+         "K": "LYS", "L": "LEU", "M": "MET", "N": "ASN", "P": "PRO", "Q": "GLN", "R": "ARG", "S": "SER",
+         "T": "THR", "V": "VAL", "W": "TRP", "Y": "TYR"}
+
+# (name, start, min length, max length) of the CDRs in the variable domains, roughly IMGT / Chothia positions
+HEAVY_CDRS = [("H1", 25, 7, 10), ("H2", 50, 6, 10), ("H3", 96, 5, 22)]
+LIGHT_CDRS = [("L1", 23, 6, 17), ("L2", 49, 3, 3), ("L3", 88, 7, 12)]
+HEAVY_LEN = (115, 130)
+LIGHT_LEN = (105, 115)
+# N, CA, C, O offsets from CA
+BACKBONE = np.array([[-1.2, 0.8, 0.0], [0.0, 0.0, 0.0], [1.2, 0.8, 0.0], [1.3, 2.0, 0.3]], dtype=np.float32)
+
+
+def random_seq(length, rng):
+    return "".join(rng.choice(list(AMINO), size=length))
+
+
+def random_walk(length, rng, start, step=3.8):
+    steps = rng.normal(size=(length, 3))
+    steps *= step / np.linalg.norm(steps, axis=1, keepdims=True)
+    return (start + np.cumsum(steps, axis=0)).astype(np.float32)
+
+
+def residues(seq, ca):
+    return [{"name": THREE[a], "abbr": a, "pos": ca[i] + BACKBONE} for i, a in enumerate(seq)]
+
+
+def antibody_chain(length_range, cdrs, rng, start):
+    seq = random_seq(int(rng.integers(*length_range, endpoint=True)), rng)
+    out = {}
+    for name, begin, lo, hi in cdrs:
+        out[name] = seq[begin:begin+int(rng.integers(lo, hi, endpoint=True))]
+    return seq, random_walk(len(seq), rng, start), out
+
+
+def make_complex(rng, index, antigen_len=(60, 600), antigen_chains=(1, 3)):
+    '''
+    :param antigen_len:     range of the total antigen length
+    :param antigen_chains:  range of the number of antigen chains
+    :return:                one SAbDab complex dict
+    '''
+    hseq, hca, hcdrs = antibody_chain(HEAVY_LEN, HEAVY_CDRS, rng, np.zeros(3))
+    lseq, lca, lcdrs = antibody_chain(LIGHT_LEN, LIGHT_CDRS, rng, rng.normal(scale=10, size=3))
+
+    # antigen chains start next to a CDR residue, so the k nearest residues form a contiguous-ish patch
+    cdr_ca = np.concatenate([hca[25:40], hca[96:110], lca[23:40], lca[88:100]])
+    n_chains = int(rng.integers(*antigen_chains, endpoint=True))
+    total = int(rng.integers(*antigen_len, endpoint=True))
+    lengths = np.maximum(np.diff(np.sort(np.concatenate([[0, total], rng.integers(0, total, size=n_chains-1)]))), 1)
+    chain_ids = list("ABCDEFGIJKMNOPQRSTUVWXYZ")[:n_chains]
+
+    aseq, apos = {}, []
+    for chain, length in zip(chain_ids, lengths):
+        start = cdr_ca[rng.integers(len(cdr_ca))] + rng.normal(scale=6, size=3)
+        seq = random_seq(int(length), rng)
+        ca = random_walk(len(seq), rng, start)
+        aseq[chain] = residues(seq, ca)
+        apos.append(ca[:, None, :] + BACKBONE)
+
+    entry = {"pdb": "{:04x}".format(index % 65536), "Hchain": "H", "Lchain": "L", "Achain": chain_ids,
+             "Hseq": {"H": residues(hseq, hca)}, "Lseq": {"L": residues(lseq, lca)}, "Aseq": aseq,
+             "Hpos": [r + BACKBONE for r in hca], "Lpos": [r + BACKBONE for r in lca], "Apos": apos}
+    entry.update(hcdrs)
+    entry.update(lcdrs)
+    return entry
+
+
+def make_sabdab(n, seed=0, pool=1000, antigen_len=(60, 600), antigen_chains=(1, 3)):
+    '''
+    :param n:       number of complexes
+    :param pool:    number of distinct complexes, later ones are shallow copies of them
+    :return:        list of SAbDab complex dicts, as pre_train.load_data returns
+    '''
+    rng = np.random.default_rng(seed)
+    distinct = [make_complex(rng, i, antigen_len, antigen_chains) for i in range(min(n, pool))]
+    return [copy.copy(distinct[i % len(distinct)]) for i in range(n)]
+
+
+def make_cov_abdab(n, seed=0, positive=0.5):
+    '''
+    :return:    pandas DataFrame with the columns of CoV-AbDab_extract.csv (Index, AB_name, Class, Paratope, Epitope),
+                paratopes are concatenated CDRs, epitopes 10 - 45 residues
+    '''
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    paratopes = [random_seq(int(rng.integers(15, 40, endpoint=True)), rng) for _ in range(n)]
+    epitopes = [random_seq(int(rng.integers(10, 45, endpoint=True)), rng) for _ in range(n)]
+    return pd.DataFrame({"Index": np.arange(1, n+1),
+                         "AB_name": ["syn{}".format(i) for i in range(n)],
+                         "Class": (rng.random(n)<positive).astype(int),
+                         "Paratope": paratopes,
+                         "Epitope": epitopes})
+
+
+def make_pairs(n, seed=0, epi_len=72, num_neg=4):
+    '''
+    :return:    get_pair output of n complexes: [(paratope, epitope, label)], 1 positive and num_neg negatives each
+    '''
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(n):
+        paratope = "/".join(random_seq(int(rng.integers(lo, hi, endpoint=True)), rng)
+                            for _, _, lo, hi in HEAVY_CDRS + LIGHT_CDRS)
+        # k nearest epitopes (K = 48) padded by seq_pad_clip
+        for label in [1] + [0]*num_neg:
+            pairs.append((paratope, random_seq(min(48, epi_len), rng) + "#"*max(epi_len-48, 0), label))
+    return pairs
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="write synthetic SAbDab / CoV-AbDab data")
+    parser.add_argument("kind", type=str, choices=["sabdab", "cov"])
+    parser.add_argument("n", type=int)
+    parser.add_argument("path", type=str)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pool", type=int, default=1000, help="distinct SAbDab complexes")
+    args = parser.parse_args()
+
+    if os.path.dirname(args.path)!="":
+        os.makedirs(os.path.dirname(args.path), exist_ok=True)
+    if args.kind=="sabdab":
+        pickle.dump(make_sabdab(args.n, seed=args.seed, pool=args.pool), open(args.path, "wb"))
+    else:
+        make_cov_abdab(args.n, seed=args.seed).to_csv(args.path, index=False)
+    print("{} {} entries written to {}".format(args.n, args.kind, args.path))
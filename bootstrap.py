@@ -0,0 +1,164 @@
+import os
+import argparse
+import numpy as np
+
+
+# bootstrap confidence intervals and paired permutation tests of k-fold metrics, from the best-epoch predictions
+# that cov_train saves as val_pred_{k}_best.npy / val_label_{k}_best.npy
+# python bootstrap.py pesi_ft masonscnn lstm --n_boot 1000
+# - a resample draws every fold's test pairs with replacement, the statistic is the mean over folds of the
+#   per-fold metric, as metrics.evaluate reports it
+# - all resamples of a fold are one (n_boot, n) index matrix and all metrics are computed on it at once
+# - thresholds as metrics.StreamingMetrics: > 0.5 for acc / F1 / G-mean, >= 0.5 for MCC, rank AUC with ties halved
+
+METRICS = ["acc", "f1", "auc", "gmean", "mcc"]
+
+
+def load_predictions(model_name, kfold=10, result_dir=None):
+    '''
+    :return:    [(pred, label)] of each fold, in test set order
+    '''
+    result_dir = result_dir or "./results/CoV-AbDab/{}/".format(model_name)
+    folds = []
+    for k in range(kfold):
+        pred = np.load(os.path.join(result_dir, "val_pred_{}_best.npy".format(k)))
+        label = np.load(os.path.join(result_dir, "val_label_{}_best.npy".format(k)))
+        folds.append((pred.astype(np.float64), label==1))
+    return folds
+
+
+def safe_divide(a, b):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(b > 0, a / np.where(b > 0, b, 1), 0.0)
+
+
+def rank_auc(pred, label):
+    '''
+    :param pred:    (n_boot, n) scores
+    :param label:   (n_boot, n) bool
+    :return:        (n_boot, ) AUC, nan for resamples with a single class
+    '''
+    order = np.argsort(pred, axis=1, kind="stable")
+    scores = np.take_along_axis(pred, order, axis=1)
+    labels = np.take_along_axis(label, order, axis=1)
+
+    # first and last sorted position of each tie group, ties share the average of their 1-based ranks
+    n = scores.shape[1]
+    pos = np.broadcast_to(np.arange(n), scores.shape)
+    new_group = np.ones(scores.shape, dtype=bool)
+    new_group[:, 1:] = scores[:, 1:]!=scores[:, :-1]
+    first = np.maximum.accumulate(np.where(new_group, pos, 0), axis=1)
+    group_end = np.ones(scores.shape, dtype=bool)
+    group_end[:, :-1] = new_group[:, 1:]
+    last = np.minimum.accumulate(np.where(group_end, pos, n-1)[:, ::-1], axis=1)[:, ::-1]
+    ranks = (first + last) / 2 + 1
+
+    num_pos = labels.sum(axis=1)
+    num_neg = n - num_pos
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auc = ((ranks * labels).sum(axis=1) - num_pos * (num_pos + 1) / 2) / (num_pos * num_neg)
+    return np.where((num_pos > 0) & (num_neg > 0), auc, np.nan)
+
+
+def batch_metrics(pred, label):
+    '''
+    :param pred:    (n_boot, n) probabilities
+    :param label:   (n_boot, n) bool
+    :return:        {metric: (n_boot, )}
+    '''
+    hard = pred > 0.5
+    tp, fp = (hard & label).sum(axis=1), (hard & ~label).sum(axis=1)
+    fn, tn = (~hard & label).sum(axis=1), (~hard & ~label).sum(axis=1)
+
+    hard = pred >= 0.5
+    tp2, fp2 = (hard & label).sum(axis=1).astype(np.float64), (hard & ~label).sum(axis=1).astype(np.float64)
+    fn2, tn2 = (~hard & label).sum(axis=1).astype(np.float64), (~hard & ~label).sum(axis=1).astype(np.float64)
+
+    return {"acc": (tp + tn) / label.shape[1],
+            "f1": safe_divide(2*tp, 2*tp + fp + fn),
+            "auc": rank_auc(pred, label),
+            "gmean": np.sqrt(safe_divide(tp, tp + fn) * safe_divide(tn, tn + fp)),
+            "mcc": safe_divide(tp2*tn2 - fp2*fn2, np.sqrt((tp2 + fp2) * (tp2 + fn2) * (tn2 + fp2) * (tn2 + fn2)))}
+
+
+def fold_mean(per_fold):
+    # [{metric: (n_boot, )}] of each fold -> {metric: (n_boot, )} mean over folds
+    return {m: np.nanmean(np.stack([f[m] for f in per_fold]), axis=0) for m in METRICS}
+
+
+def resample_indices(folds, n_boot, rng):
+    return [rng.integers(0, len(label), size=(n_boot, len(label))) for _, label in folds]
+
+
+def bootstrap(folds, n_boot=1000, alpha=0.05, seed=0, indices=None):
+    '''
+    :param folds:   load_predictions() of one model
+    :param indices: resample_indices() to reuse, e.g. the same resamples for several models
+    :return:        {metric: (estimate, lower, upper)}, the per-resample values {metric: (n_boot, )}
+    '''
+    if indices is None:
+        indices = resample_indices(folds, n_boot, np.random.default_rng(seed))
+
+    estimate = fold_mean([batch_metrics(pred[None], label[None]) for pred, label in folds])
+    samples = fold_mean([batch_metrics(pred[idx], label[idx]) for (pred, label), idx in zip(folds, indices)])
+
+    ci = {m: (float(estimate[m][0]),
+              float(np.nanpercentile(samples[m], 100*alpha/2)),
+              float(np.nanpercentile(samples[m], 100*(1-alpha/2)))) for m in METRICS}
+    return ci, samples
+
+
+def permutation_test(folds_a, folds_b, n_perm=1000, seed=0):
+    '''
+    paired permutation test of model a against model b on the same test pairs:
+    every permutation swaps the predictions of the two models on a random half of the pairs
+
+    :return:    {metric: (difference a - b, two-sided p-value)}
+    '''
+    rng = np.random.default_rng(seed)
+    observed = []
+    permuted = []
+    for (pred_a, label), (pred_b, label_b) in zip(folds_a, folds_b):
+        if not np.array_equal(label, label_b):
+            raise ValueError("the models were not evaluated on the same test pairs")
+        swap = rng.random((n_perm, len(label))) < 0.5
+        labels = np.broadcast_to(label, swap.shape)
+        a = batch_metrics(np.where(swap, pred_b, pred_a), labels)
+        b = batch_metrics(np.where(swap, pred_a, pred_b), labels)
+        permuted.append({m: a[m] - b[m] for m in METRICS})
+        a = batch_metrics(pred_a[None], label[None])
+        b = batch_metrics(pred_b[None], label[None])
+        observed.append({m: a[m] - b[m] for m in METRICS})
+
+    observed = fold_mean(observed)
+    permuted = fold_mean(permuted)
+    return {m: (float(observed[m][0]),
+                float((np.sum(np.abs(permuted[m]) >= np.abs(observed[m][0]) - 1e-12) + 1) / (n_perm + 1)))
+            for m in METRICS}
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="bootstrap CIs and paired permutation tests of cov_train results")
+    parser.add_argument("model_names", type=str, nargs="+", help="the first model is compared with the others")
+    parser.add_argument("--kfold", type=int, default=10)
+    parser.add_argument("--result_dirs", type=str, nargs="*", default=None,
+                        help="one per model, default ./results/CoV-AbDab/<model_name>/")
+    parser.add_argument("--n_boot", type=int, default=1000)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    result_dirs = args.result_dirs or [None] * len(args.model_names)
+    predictions = [load_predictions(name, args.kfold, d) for name, d in zip(args.model_names, result_dirs)]
+
+    # the same resamples for every model, so their intervals are comparable
+    indices = resample_indices(predictions[0], args.n_boot, np.random.default_rng(args.seed))
+    print("{:<32}".format("model") + "".join("{:>24}".format(m) for m in METRICS))
+    for name, folds in zip(args.model_names, predictions):
+        ci, _ = bootstrap(folds, alpha=args.alpha, indices=indices)
+        print("{:<32}".format(name) + "".join("{:>24}".format("{:.4f} [{:.4f}, {:.4f}]".format(*ci[m])) for m in METRICS))
+
+    for name, folds in zip(args.model_names[1:], predictions[1:]):
+        res = permutation_test(predictions[0], folds, n_perm=args.n_boot, seed=args.seed)
+        print("{} - {}: ".format(args.model_names[0], name) +
+              "  ".join("{} {:+.4f} (p={:.4f})".format(m, *res[m]) for m in METRICS))
@@ -0,0 +1,251 @@
+import os
+import copy
+import json
+import queue
+import pickle
+import argparse
+import threading
+
+import numpy as np
+import torch
+
+
+# checkpoint file: torch.save({"version", "spec", "state_dict"}), spec is the JSON string of models.build.model_spec()
+# - loadable with weights_only=True (no pickled classes, independent of the source layout)
+# - loadable with mmap=True, tensors are paged in from disk when first used
+# older checkpoints are pickled whole modules (torch.save(model)), unpickling runs arbitrary code so load_model
+# refuses them unless allow_pickle=True; convert them once, from a trusted source:
+# python checkpoint.py ./results/SAbDab/full/seq1_neg0/*/model_best.pth     converts them in place
+
+CKPT_VERSION = 1
+
+
+def get_spec(model):
+    return getattr(model, "_spec", None)
+
+
+def cpu_state_dict(model):
+    # detached CPU copy of the weights, safe to write while the model keeps training
+    return {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+
+
+def write_checkpoint(ckpt, path):
+    # write next to the target and rename, a crash never leaves a half-written checkpoint at path
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    torch.save(ckpt, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_array(path, value):
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asarray(value))
+    os.replace(tmp_path, path)
+
+
+def append_record(path, record):
+    # one JSON line per epoch
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def make_checkpoint(model, spec=None, state_dict=None):
+    '''
+    :param model:       model to save, its _spec is used if spec is None
+    :param spec:        models.build.model_spec() of the model
+    :param state_dict:  CPU state dict, taken from the model if None
+    :return:            checkpoint dict, or a CPU copy of the model if it has no spec (saved as a legacy pickle)
+    '''
+    spec = spec if spec is not None else get_spec(model)
+    if spec is None:
+        print("warning: {} has no model spec, saving the pickled module".format(type(model).__name__))
+        return copy.deepcopy(model).to("cpu")
+
+    return {"version": CKPT_VERSION,
+            "spec": json.dumps(spec),
+            "state_dict": state_dict if state_dict is not None else cpu_state_dict(model)}
+
+
+def save_model(model, path, spec=None):
+    write_checkpoint(make_checkpoint(model, spec=spec), path)
+
+
+def spec_matches(model, spec):
+    from models.build import make_model
+
+    try:
+        ref = make_model(spec).state_dict()
+    except Exception:
+        return False
+    state_dict = model.state_dict()
+    return ref.keys()==state_dict.keys() and all(ref[k].shape==state_dict[k].shape for k in ref)
+
+
+def read_checkpoint(path, mmap=True, allow_pickle=False):
+    '''
+    :param allow_pickle:    unpickle legacy module checkpoints, only for trusted files
+    :return:                checkpoint dict, or the module of a legacy checkpoint
+    '''
+    try:
+        return torch.load(path, map_location="cpu", weights_only=True, mmap=mmap)
+    except pickle.UnpicklingError:
+        if not allow_pickle:
+            print("{} is a pickled module checkpoint, convert it with: python checkpoint.py {}".format(path, path))
+            raise
+    # pickled module: needs the classes importable under their original module paths
+    return torch.load(path, map_location="cpu", weights_only=False)
+
+
+def load_model(path, device="cuda", mmap=True, spec=None, strict=True, allow_pickle=False):
+    '''
+    :param path:            checkpoint written by save_model
+    :param device:          device of the returned model, None to keep the (memory-mapped) CPU tensors
+    :param mmap:            memory-map the checkpoint instead of reading it into memory
+    :param spec:            spec attached to legacy models, so that they are saved in the new format; ignored if it
+                            does not match the loaded weights
+    :param allow_pickle:    also read legacy pickled modules, which runs arbitrary code from the file
+    :return:                model
+    '''
+    from models.build import make_model
+
+    ckpt = read_checkpoint(path, mmap=mmap, allow_pickle=allow_pickle)
+
+    if isinstance(ckpt, torch.nn.Module):
+        model = ckpt
+        if spec is not None and spec_matches(model, spec):
+            model._spec = spec
+    else:
+        model = make_model(json.loads(ckpt["spec"]))
+        # assign keeps the memory-mapped tensors instead of copying them into freshly initialised ones
+        model.load_state_dict(ckpt["state_dict"], strict=strict, assign=True)
+
+    if device is not None:
+        model = model.to(device)
+    return model
+
+
+class AsyncCheckpointWriter(object):
+    '''
+    writes checkpoints and metrics on a background thread, the caller only pays for the CPU snapshot of the weights
+    at most max_pending jobs wait in the queue, submitting blocks beyond that to bound host memory
+    epoch records also go to store (results_store.ResultsStore) if given
+    '''
+    def __init__(self, max_pending=2, store=None):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.store = store
+        self.error = None
+        self.latest = {}        # checkpoint path -> number of its newest submitted snapshot
+        self.count = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args = item
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, fn, *args):
+        self.check()
+        self.queue.put((fn, args))
+
+    def save(self, model, path, spec=None):
+        self.submit(write_checkpoint, make_checkpoint(model, spec=spec), path)
+
+    def epoch(self, history_path, record, model=None, ckpt_path=None, best_arrays=None, key=None):
+        '''
+        one job per epoch: append record to history_path, and if model is given (new best) write its checkpoint 
+        to ckpt_path and best_arrays {path: value}; a best snapshot superseded by a newer one before it 
+        reached the disk is skipped
+        key: {stage, dataset, model, run, fold} of the record in the results store
+        '''
+        ckpt, snapshot = None, None
+        if model is not None:
+            ckpt = make_checkpoint(model)
+            self.count += 1
+            snapshot = self.latest[ckpt_path] = self.count
+        self.submit(self.write_epoch, history_path, record, ckpt, ckpt_path, snapshot, best_arrays or {}, key)
+
+    def write_epoch(self, history_path, record, ckpt, ckpt_path, snapshot, best_arrays, key=None):
+        append_record(history_path, record)
+        if self.store is not None and key is not None:
+            self.store.append(dict(key, best=ckpt is not None, **record))
+        if ckpt is not None and self.latest.get(ckpt_path)==snapshot:
+            write_checkpoint(ckpt, ckpt_path)
+            for path, value in best_arrays.items():
+                write_array(path, value)
+
+    def arrays(self, arrays):
+        # {path: value}, written as .npy by one job
+        self.submit(self.write_arrays, arrays)
+
+    def write_arrays(self, arrays):
+        for path, value in arrays.items():
+            write_array(path, value)
+
+    def flush(self):
+        if self.store is not None:
+            self.submit(self.store.flush)
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+def infer_model_name(path):
+    '''
+    ./results/SAbDab/full/seq1_neg0/lstm/model_best.pth           -> lstm, pretrain
+    ./results/SAbDab/full/seq1_neg0/lstm_encoder/model_best.pth   -> lstm_encoder, pretrain (models.build.ENCODERS)
+    ./results/CoV-AbDab/lstm_ft/model_3_best.pth                   -> lstm_ft, cov
+    '''
+    name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    stage = "cov" if "CoV-AbDab" in os.path.abspath(path) else "pretrain"
+    return name, stage
+
+
+def convert(path, model_name=None, stage=None):
+    from models.build import model_spec
+
+    name, inferred_stage = infer_model_name(path)
+    model_name = model_name or name
+    stage = stage or inferred_stage
+    spec = model_spec(model_name, stage=stage)
+
+    model = read_checkpoint(path, mmap=False, allow_pickle=True)
+    if not isinstance(model, torch.nn.Module):
+        print("skip {}: already a state_dict checkpoint".format(path))
+        return
+    if not spec_matches(model, spec):
+        print("skip {}: weights do not match the spec of {} ({})".format(path, model_name, stage))
+        return
+
+    os.replace(path, path + ".legacy")
+    save_model(model, path, spec=spec)
+    print("converted {} ({}, {}), original kept as {}.legacy".format(path, model_name, stage, path))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="convert pickled-module checkpoints to state_dict checkpoints")
+    parser.add_argument("paths", type=str, nargs="+")
+    parser.add_argument("--model_name", type=str, default=None, help="registered model name, default from the folder")
+    parser.add_argument("--stage", type=str, default=None, choices=["pretrain", "cov"],
+                        help="default pretrain for SAbDab results, cov for CoV-AbDab results")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        convert(path, model_name=args.model_name, stage=args.stage)
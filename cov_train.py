@@ -1,14 +1,11 @@
 import os
 import sys
 import time
+import pickle
+from functools import partial
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from sklearn.metrics import confusion_matrix
-from sklearn.metrics import accuracy_score, f1_score, roc_auc_score, matthews_corrcoef
-from imblearn.metrics import geometric_mean_score
 from metrics import *
-import matplotlib.pyplot as plt
 
 import torch
 import torch.nn as nn
@@ -16,841 +13,454 @@ import torch.optim as optim
 
 from dataset import *
 from utils import *
-from models import *
-
-
-def prepare_lstm(config):
-
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
-
-    if config["model_name"]=="lstm":
-        config["model"] = BiLSTM(embed_size=32, 
-                                 hidden=64, 
-                                 num_layers=1, 
-                                 dropout=0.5, 
-                                 use_pretrain=False).cuda()
-
-        config["epochs"] = 300
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-
-    elif config["model_name"]=="lstm_ft":
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/lstm/model_best.pth")
-        config["model"].train()
-        
-        if config["fix_FE"]==True:
-            for name, param in config["model"].LSTM_para.named_parameters():
-                param.requires_grad = False
-            for name, param in config["model"].LSTM_epi.named_parameters():
-                param.requires_grad = False
-        
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="lstm_ft_pairPreTrain":
-
-        encoder = torch.load("./results/SAbDab/full/seq1_neg0/lstm_encoder/model_best.pth")
-        encoder.train()
-        config["model"] = TowerBaseModel(embed_size=64, hidden=128, encoder=encoder, 
-                                         use_two_towers=False, use_coattn=False, fusion=1).cuda()
-        
-        if config["fix_FE"]==True:
-            for name, param in config["model"].encoder.named_parameters():
-                param.requires_grad = False
-        
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-
-    else:
-        print("Error Model Name")
-        exit()
-
-    return config
-
-
-def prepare_textcnn(config):
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
-
-    if config["model_name"]=="textcnn":
-        config["model"] = TextCNN(amino_ft_dim=len(vocab), 
-                                 max_antibody_len=100, 
-                                 max_virus_len=100, 
-                                 h_dim=512, 
-                                 dropout=0.1).cuda()
-        config["epochs"] = 100
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="textcnn_ft":
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/textcnn/model_best.pth")
-
-        if config["fix_FE"]==True:
-            for name, param in model.text_inception.named_parameters():
-                param.requires_grad = False
-            for name, param in model.text_inception2.named_parameters():
-                param.requires_grad = False
-
-
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="textcnn_ft_pairPreTrain":
-        
-        encoder = torch.load("./results/SAbDab/full/seq1_neg0/textcnn_encoder/model_best.pth")
-        config["model"] = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, 
-                                         use_two_towers=False, use_coattn=False, fusion=0).cuda()
-        
-        if config["fix_FE"]==True:
-            for name, param in model.encoder.named_parameters():
-                param.requires_grad = False
-        
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-
-    else:
-        print("Error Model Name")
-        exit()
-
-    return config
-
-
-def prepare_masonscnn(config):
-
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
-
-    if config["model_name"]=="masonscnn":
-        config["model"] = MasonsCNN(amino_ft_dim=len(vocab), 
-                                    max_antibody_len=100, 
-                                    max_virus_len=100, 
-                                    h_dim=512, 
-                                    dropout=0.1).cuda()
-        config["epochs"] = 100
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="masonscnn_ft":
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/masonscnn/model_best.pth")
-
-        if config["fix_FE"]==True:
-            for name, param in model.cnnmodule.named_parameters():
-                param.requires_grad = False
-            for name, param in model.cnnmodule2.named_parameters():
-                param.requires_grad = False
-
-
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="masonscnn_ft_pairPreTrain":
-        
-        encoder = torch.load("./results/SAbDab/full/seq1_neg0/masonscnn_encoder/model_best.pth")
-        config["model"] = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, 
-                                         use_two_towers=False, use_coattn=False, fusion=0).cuda()
-        
-        if config["fix_FE"]==True:
-            for name, param in model.encoder.named_parameters():
-                param.requires_grad = False
-        
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
+from models import build_model, make_model
+from checkpoint import load_model, AsyncCheckpointWriter
+from telemetry import Telemetry
+from profiling import stage, start_timing, stop_timing, ModelProfiler
+import results_store
+from results_store import ResultsStore
+
+
+# pesi_ft with BSS: a fresh use_BSS SetTransformer initialised from the pre-trained SetCoAttnTransformer
+def prepare_pesi_bss(config):
+    config["model"] = make_model({"module": "setmodel", 
+                                  "cls": "SetTransformer", 
+                                  "kwargs": dict(dim_input=32, 
+                                                 num_outputs=32, 
+                                                 dim_output=32, 
+                                                 dim_hidden=64, 
+                                                 num_inds=6, 
+                                                 num_heads=4, 
+                                                 ln=True, 
+                                                 dropout=0.5, 
+                                                 use_coattn=False, 
+                                                 share=False, 
+                                                 use_BSS=True)}).cuda()
+
+    # load pre-trained weights
+    pt_model = load_model("./results/SAbDab/full/seq1_neg0/SetCoAttnTransformer/model_best.pth", device=None).cuda()
+
+    config["model"].embedding = pt_model.embedding
+    
+    config["model"].para_enc = pt_model.para_enc
+    config["model"].epi_enc = pt_model.epi_enc
+    
+    config["model"].co_attn = pt_model.co_attn
+    
+    config["model"].para_dec = pt_model.para_dec
+    config["model"].epi_dec = pt_model.epi_dec
+    
+    config["model"].output_layer = pt_model.output_layer
+    
+    config["model"].train()
 
-    else:
-        print("Error Model Name")
-        exit()
+    # params
+    config["epochs"] = 500
+    config["lr"] = 6e-5
+    config["l2_coef"] = 5e-4
 
     return config
 
 
-def prepare_ag_fast_parapred(config):
-
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
-
-    if config["model_name"]=="ag_fast_parapred":
-        config["model"] = AgFastParapred(ft_dim=len(vocab), 
-                                         max_antibody_len=100, 
-                                         max_virus_len=100, 
-                                         h_dim=512, 
-                                         position_coding=True).cuda()
-        config["epochs"] = 100
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="ag_fast_parapred_ft":
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/ag_fast_parapred/model_best.pth")
-
-        if config["fix_FE"]==True:
-            # for name, param in model.cnnmodule.named_parameters():
-            #     param.requires_grad = False
-            # for name, param in model.cnnmodule2.named_parameters():
-            #     param.requires_grad = False
-            print("not implemented")
-            exit()
-
-
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="ag_fast_parapred_ft_pairPreTrain":
-        
-        encoder = torch.load("./results/SAbDab/full/seq1_neg0/ag_fast_parapred_encoder/model_best.pth")
-        config["model"] = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, 
-                                         use_two_towers=False, use_coattn=False, fusion=0).cuda()
-        
-        if config["fix_FE"]==True:
-            for name, param in model.encoder.named_parameters():
-                param.requires_grad = False
-        
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
+def set_model_name(config):
+    # fine-tuned variants are registered and saved as <name>_ft / <name>_ft_pairPreTrain
+    if config["use_fine_tune"]==True:
+        if "ft" not in config["model_name"]:
+            config["model_name"] += "_ft"
 
-    else:
-        print("Error Model Name")
-        exit()
+        if config["use_pair"]==True:
+            config["model_name"] += "_pairPreTrain"
 
     return config
 
-def prepare_pipr(config):
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
-
-    if config["model_name"]=="pipr":
-        config["model"] = PIPR(protein_ft_one_hot_dim=len(vocab)).cuda()
-
-        config["epochs"] = 100
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="pipr_ft":
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/pipr/model_best.pth")
-
-        if config["fix_FE"]==True:
-            # for name, param in model.cnnmodule.named_parameters():
-            #     param.requires_grad = False
-            # for name, param in model.cnnmodule2.named_parameters():
-            #     param.requires_grad = False
-            print("not implemented")
-            exit()
-
-
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-
-    else:
-        print("Error Model Name")
-        exit()
 
-    return config
+def open_store(config):
+    # results_store.ResultsStore of config["results_db"], None to write per-metric .npy files instead
+    if config.get("results_db")==None:
+        return None
+    return ResultsStore(config["results_db"])
 
-def prepare_resppi(config):
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
-
-    if config["model_name"]=="resppi":
-        config["model"] = ResPPI(amino_ft_dim=len(vocab), 
-                                    max_antibody_len=100, 
-                                    max_virus_len=100, 
-                                    h_dim=512, 
-                                    dropout=0.1).cuda()
-        config["epochs"] = 100
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="resppi_ft":
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/resppi/model_best.pth")
 
-        if config["fix_FE"]==True:
-            # for name, param in model.cnnmodule.named_parameters():
-            #     param.requires_grad = False
-            # for name, param in model.cnnmodule2.named_parameters():
-            #     param.requires_grad = False
-            print("not implemented")
-            exit()
+def store_key(config, k_iter):
+    return {"stage": "cov", "dataset": "CoV-AbDab", "model": config["model_name"], 
+            "run": config.get("run", 0), "fold": k_iter}
 
 
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="resppi_ft_pairPreTrain":
-        
-        encoder = torch.load("./results/SAbDab/full/seq1_neg0/resppi_encoder/model_best.pth")
-        config["model"] = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, 
-                                         use_two_towers=False, use_coattn=False, fusion=0).cuda()
-        
-        if config["fix_FE"]==True:
-            for name, param in model.encoder.named_parameters():
-                param.requires_grad = False
-        
-        config["epochs"] = 500
-        config["lr"] = 1e-4
-        config["l2_coef"] = 5e-4
+def train_fold(config, k_iter, writer, result_dir):
+    '''
+    train config["model_name"] with fold k_iter held out
 
+    :param config:      run config, config["model"] and its hyperparameters are set here
+    :param k_iter:      index of the validation fold
+    :param writer:      checkpoint.AsyncCheckpointWriter for checkpoints and metric files
+    :param result_dir:  folder of the checkpoints and metric files, ending with "/"
+    :return:            labels and predictions of the last epoch, history record of the best epoch
+    '''
+    # model name, see models/build.py for the registered models and their hyperparameters
+    if config["model_name"]=="pesi_ft" and config["use_BSS"]==True:
+        config = prepare_pesi_bss(config)
     else:
-        print("Error Model Name")
-        exit()
-
-    return config
-
-def prepare_deepaai(config):
-    pass
-
-def prepare_pesi(config):
-    # if config["use_fine_tune"]==True:
-    #     config["model_name"] += "_ft"
-
-    #     if config["use_pair"]==True:
-    #         config["model_name"] += "_pairPreTrain"
+        config = build_model(config, stage="cov")
     
-    if config["model_name"]=="SetTransformer":
-        config["model"] = SetTransformer(dim_input=32, 
-                            num_outputs=32, 
-                            dim_output=32, 
-                            dim_hidden=64, 
-                            num_inds=6, 
-                            num_heads=4, 
-                            ln=True, 
-                            dropout=0.5, 
-                            use_coattn=False, 
-                            share=False).cuda()
-        
-        epochs = 500
-        lr = 1e-4
-        l2_coef = 5e-4
-        
-    elif config["model_name"]=="SetTransformer_ft":
-
-        config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/SetTransformer/model_best.pth")
-        config["model"].train()
-
-        if config["fix_FE"]==True:
-            for name, param in config["model"].para_enc.named_parameters():
-                param.requires_grad = False
-            for name, param in config["model"].para_dec.named_parameters():
-                param.requires_grad = False
-            for name, param in config["model"].epi_enc.named_parameters():
-                param.requires_grad = False
-            for name, param in config["model"].epi_dec.named_parameters():
-                param.requires_grad = False
-
-        epochs = 500
-        lr = 1e-4
-        l2_coef = 5e-4
-        
-        
-    # elif config["model_name"]=="SetCoAttnTransformer":
-    elif config["model_name"]=="pesi":
-        config["model"] = SetTransformer(dim_input=32, 
-                                         num_outputs=32, 
-                                         dim_output=32, 
-                                         dim_hidden=64, 
-                                         num_inds=6, 
-                                         num_heads=4, 
-                                         ln=True, 
-                                         dropout=0.5, 
-                                         use_coattn=True, 
-                                         share=False, 
-                                         use_BSS=False).cuda()
-        config["epochs"] = 500
-        config["lr"] = 6e-5
-        config["l2_coef"] = 5e-4
-        
-    elif config["model_name"]=="pesi_ft":
-        if config["use_BSS"]==False:
-            config["model"] = torch.load("./results/SAbDab/full/seq1_neg0/pesi/model_best.pth")
-            config["model"].train()
-
-            if config["fix_FE"]==True:
-                for name, param in config["model"].para_enc.named_parameters():
-                    param.requires_grad = False
-                for name, param in config["model"].para_dec.named_parameters():
-                    param.requires_grad = False
-                for name, param in config["model"].epi_enc.named_parameters():
-                    param.requires_grad = False
-                for name, param in config["model"].epi_dec.named_parameters():
-                    param.requires_grad = False
-            
-            config["epochs"] = 500
-            config["lr"] = 6e-5
-            config["l2_coef"] = 5e-4
-            # model = SetTransformer(dim_input=32, 
-            #                     num_outputs=32, 
-            #                     dim_output=32, 
-            #                     dim_hidden=64, 
-            #                     num_inds=6, 
-            #                     num_heads=4, 
-            #                     ln=True, 
-            #                     dropout=0.5, 
-            #                     use_coattn=False, 
-            #                     share=False, 
-            #                     use_BSS=False).cuda()
-        
-            # pt_model = torch.load("./results/SAbDab/full/seq1_neg0/SetCoAttnTransformer/model_best.pth")
-        
-            # model.para_enc = pt_model.para_enc
-            # model.para_dec = pt_model.para_dec
-            # model.epi_enc = pt_model.epi_enc
-            # model.epi_dec = pt_model.epi_dec
-            # model.train()
-        
-            # epochs = 500
-            # lr = 6e-5
-            # l2_coef = 5e-4
-
-        elif config["use_BSS"]==True:
-            print(config["model_name"], config["use_BSS"])
-            config["model"] = SetTransformer(dim_input=32, 
-                                            num_outputs=32, 
-                                            dim_output=32, 
-                                            dim_hidden=64, 
-                                            num_inds=6, 
-                                            num_heads=4, 
-                                            ln=True, 
-                                            dropout=0.5, 
-                                            use_coattn=False, 
-                                            share=False, 
-                                            use_BSS=True).cuda()
-        
-            # load pre-trained weights
-            pt_model = torch.load("./results/SAbDab/full/seq1_neg0/SetCoAttnTransformer/model_best.pth")
-        
-            config["model"].embedding = pt_model.embedding
-            
-            config["model"].para_enc = pt_model.para_enc
-            config["model"].epi_enc = pt_model.epi_enc
-            
-            config["model"].co_attn = pt_model.co_attn
-            
-            config["model"].para_dec = pt_model.para_dec
-            config["model"].epi_dec = pt_model.epi_dec
-            
-            config["model"].output_layer = pt_model.output_layer
-            
-            config["model"].train()
-        
-            # params
-            config["epochs"] = 500
-            config["lr"] = 6e-5
-            config["l2_coef"] = 5e-4
-        else:
-            print("wrong use_BSS!")
-            quit()
-        
-        
-    elif config["model_name"]=="SetCoAttnTransformer_ft_pairPreTrain":
-        
-        encoder = torch.load("./results/SAbDab/full/seq1_neg0/SetTransformer_encoder/model_best.pth")
-        encoder.train()
-        model = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, use_two_towers=False, mid_coattn=True, use_coattn=True, fusion=1).cuda()
-        
-        if config["fix_FE"]==True:
-            for name, param in model.encoder.named_parameters():
-                param.requires_grad = False
-        
-        epochs = 1500
-        lr = 1e-4 #6e-5
-        l2_coef = 3e-4 #5e-4
-
+    train_dataset = SeqDataset(data_path=config["data_path"], 
+                               kfold=config["kfold"], 
+                               holdout_fold=k_iter, 
+                               is_train_test_full="train", 
+                               use_pair=config["use_pair"], 
+                               balance_samples=False)
+    test_dataset = SeqDataset(data_path=config["data_path"], 
+                              kfold=config["kfold"], 
+                              holdout_fold=k_iter, 
+                              is_train_test_full="test", 
+                              use_pair=config["use_pair"], 
+                              balance_samples=False)
+
+    use_lens = getattr(config["model"], "accepts_lens", False)
+    collate_fn_train = partial(collate_fn, use_augment=config["use_aug"], return_lens=use_lens)
+    collate_fn_test = partial(collate_fn, use_augment=False, return_lens=use_lens)
+
+    # ESM-feature models read precomputed embeddings instead of running ESM every batch
+    if config.get("esm_store")!=None and getattr(config["model"], "use_pretrain", False)==True:
+        store = ESMFeatureStore(config["esm_store"])
+        train_dataset = ESMFeatureDataset(train_dataset, store)
+        test_dataset = ESMFeatureDataset(test_dataset, store)
+        collate_fn_train = collate_fn_test = esm_collate_fn
+
+    train_loader = torch.utils.data.DataLoader(train_dataset, 
+                                               batch_size=config["batch_size"], 
+                                               shuffle=False, 
+                                               collate_fn=collate_fn_train)
+    # validation batches of pairs padded to the same length, so that predictions match one pair per batch; 
+    # models that pad to a fixed length or mask by lengths do not see the batch padding and share batches more widely
+    # BSS is a batch statistic, one pair per batch
+    if getattr(config["model"], "fixed_length", None)!=None:
+        max_shared_len = config["model"].fixed_length
+    elif getattr(config["model"], "accepts_lens", False)==True and collate_fn_test is not esm_collate_fn:
+        max_shared_len = float("inf")
     else:
-        print("Error Model Name")
-        exit()
-
-    return config
-
-
-def cov_train(config):
-
-    if config["use_fine_tune"]==True:
-        if "ft" not in config["model_name"]:
-            config["model_name"] += "_ft"
-
-        if config["use_pair"]==True:
-            config["model_name"] += "_pairPreTrain"
-
-    print("make folder ./results/CoV-AbDab/{}/".format(config["model_name"]))
-    os.makedirs("./results/CoV-AbDab/{}/".format(config["model_name"]), exist_ok=True)
-
-    print("model name: {}\tuse_fine_tune: {}".format(config["model_name"], config["use_fine_tune"]))
-
-    kfold_labels = []
-    kfold_preds = []
-
-    for k_iter in range(config["kfold"]):
-        
-        print("=========================================================")
-        print("fold {} as val set".format(k_iter))
-
-        # model name
-        if config["model_name"][:-3]=="lstm":
-            config = prepare_lstm(config)
-        elif config["model_name"][:-3]=="textcnn":
-            config = prepare_textcnn(config)
-        elif config["model_name"][:-3]=="masonscnn":
-            config = prepare_masonscnn(config)
-        elif config["model_name"][:-3]=="ag_fast_parapred":
-            config = prepare_ag_fast_parapred(config)
-        elif config["model_name"][:-3]=="pipr":
-            config = prepare_pipr(config)
-        elif config["model_name"][:-3]=="resppi":
-            config = prepare_resppi(config)
-        elif config["model_name"][:-3]=="deepaai":
-            config = prepare_deepaai(config)
-        elif config["model_name"][:-3]=="pesi":
-            config = prepare_pesi(config)
-        else:
-            print("wrong model name")
-            exit()
-        
-        train_dataset = SeqDataset(data_path=config["data_path"], 
-                                   kfold=config["kfold"], 
-                                   holdout_fold=k_iter, 
-                                   is_train_test_full="train", 
-                                   use_pair=config["use_pair"], 
-                                   balance_samples=False)
-        collate_fn_train = my_collate_fn2 if config["use_aug"]==True else collate_fn
-        train_loader = torch.utils.data.DataLoader(train_dataset, 
-                                                   batch_size=config["batch_size"], 
-                                                   shuffle=False, 
-                                                   collate_fn=collate_fn_train)
-
-        test_dataset = SeqDataset(data_path=config["data_path"], 
-                                  kfold=config["kfold"], 
-                                  holdout_fold=k_iter, 
-                                  is_train_test_full="test", 
-                                  use_pair=config["use_pair"], 
-                                  balance_samples=False)
-        collate_fn_test = my_collate_fn1 if config["use_aug"]==True else collate_fn
-        test_loader = torch.utils.data.DataLoader(test_dataset, 
-                                                  batch_size=1, 
-                                                  shuffle=False, 
-                                                  collate_fn=collate_fn_test)
-
-    #     if model_name=="demo":
-    #         model = BiLSTM_demo(embed_size=32, hidden=64, num_layers=1, dropout=0.5, use_pretrain=False).cuda()
-            
-    #         epochs = 100
-    #         lr = 6e-5
-        
-        
-    #     elif model_name=="InteractTransformer":
-    #         model = InteractTransformer(embed_size=32, 
-    #                                     num_encoder_layers=1, 
-    #                                     nhead=2, 
-    #                                     dropout=0.3, 
-    #                                     use_coattn=False).cuda()
-    #         epochs = 200
-    #         lr = 3e-5
-            
-    #     elif model_name=="InteractTransformer_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/InteractTransformer/model_best.pth")
-    #         model.train()
-            
-    #         if config["fix_FE"]==True:
-    #             for name, param in model.transformer_para.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.transformer_epi.named_parameters():
-    #                 param.requires_grad = False
-
-    #         epochs = 1000
-    #         lr = 1e-4
-    #         l2_coef = 5e-4
-                    
-    #     elif model_name=="InteractCoAttnTransformer":
-    #         model = InteractTransformer(embed_size=32, 
-    #                                     num_encoder_layers=1, 
-    #                                     nhead=2, 
-    #                                     dropout=0.5, 
-    #                                     use_coattn=True).cuda()
-    #         epochs = 200
-    #         lr = 3e-5
-            
-    #     elif model_name=="InteractCoAttnTransformer_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/InteractCoAttnTransformer/model_best.pth")
-    #         model.train()
-        
-    #         if config["fix_FE"]==True:
-    #             for name, param in model.transformer_para.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.transformer_epi.named_parameters():
-    #                 param.requires_grad = False
-            
-    #         epochs = 1500
-    #         lr = 6e-5
-    #         l2_coef = 5e-4
-            
-    #     elif model_name=="InteractCoAttnTransformer_ft_pairPreTrain":
-    #         encoder = torch.load("./results/SAbDab/full/seq1_neg0/InteractTransformer_encoder/model_best.pth")
-    #         encoder.train()
-            
-    #         model = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, 
-    #                             use_two_towers=False, use_coattn=True, fusion=1).cuda()
-        
-    #         if config["fix_FE"]==True:
-    #             for name, param in model.encoder.named_parameters():
-    #                 param.requires_grad = False
-            
-    #         epochs = 1500
-    #         lr = 6e-5
-    #         l2_coef = 5e-4
-
-    #     elif model_name=="InteractTransformerLSTM":
-    #         model = InteractTransformerLSTM(embed_size=32, 
-    #                                         hidden=64, 
-    #                                         num_encoder_layers=1, 
-    #                                         num_lstm_layers=1, 
-    #                                         nhead=2, 
-    #                                         dropout=0.5, 
-    #                                         use_coattn=True).cuda()
-    #         epochs = 200
-    #         lr = 6e-5
-
-    #     elif model_name=="InteractTransformerLSTM_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/InteractTransformerLSTM/model_best.pth")
-    #         model.train()
-            
-    #         epochs = 200
-    #         lr = 6e-5
-                    
+        max_shared_len = 0
+    test_batches = length_batches(test_dataset, 
+                                  batch_size=config.get("val_batch_size", 256) if config["use_BSS"]==False else 1, 
+                                  max_shared_len=max_shared_len)
+    test_loader = torch.utils.data.DataLoader(test_dataset, 
+                                              batch_sampler=test_batches, 
+                                              collate_fn=collate_fn_test)
+
+#     if model_name=="demo":
+#         model = BiLSTM_demo(embed_size=32, hidden=64, num_layers=1, dropout=0.5, use_pretrain=False).cuda()
+        
+#         epochs = 100
+#         lr = 6e-5
     
-            
-            
-    #     elif model_name=="SetModel":
-    #         model = SetModel(embed_size=32, 
-    #                         hidden=64, 
-    #                         num_layers=1, 
-    #                         dropout=0.3, 
-    #                         k4kmer=3, 
-    #                         use_pretrain=False, 
-    #                         use_coattn=False, 
-    #                         seq_encoder_type="transformer", 
-    #                         num_heads=2, 
-    #                         num_inds=6, 
-    #                         num_outputs=6, 
-    #                         ln=True).cuda()
-            
-    #         epochs = 200
-    #         lr = 3e-5
-    #         l2_coef = 5e-4
-            
-    #     elif model_name=="SetModel_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/SetModel/model_best.pth")
-    #         model.train()
-            
-    #         if config["fix_FE"]==True:
-    #             for name, param in model.para_enc.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.para_dec.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.epi_enc.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.epi_dec.named_parameters():
-    #                 param.requires_grad = False
-            
-    #         epochs = 200
-    #         lr = 3e-5
-    #         l2_coef = 5e-4
-        
-    #     elif model_name=="SetCoAttnModel":
-    #         model = SetModel(embed_size=32, 
-    #                         hidden=64, 
-    #                         num_layers=1, 
-    #                         dropout=0.3, 
-    #                         k4kmer=3, 
-    #                         use_pretrain=False, 
-    #                         use_coattn=True, 
-    #                         seq_encoder_type="transformer", 
-    #                         num_heads=2, 
-    #                         num_inds=6, 
-    #                         num_outputs=6, 
-    #                         ln=True).cuda()
-    #         epochs = 200
-    #         lr = 3e-5
-        
-    #     elif model_name=="SetCoAttnModel_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/SetCoAttnModel/model_best.pth")
-    #         model.train()
-            
-    #         if config["fix_FE"]==True:
-    #             for name, param in model.para_enc.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.para_dec.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.epi_enc.named_parameters():
-    #                 param.requires_grad = False
-    #             for name, param in model.epi_dec.named_parameters():
-    #                 param.requires_grad = False
-            
-    #         epochs = 200
-    #         lr = 3e-5
-    #         l2_coef = 5e-4
-            
-    #     elif model_name=="SetModel_ablation":
-    #         model = SetModel_ablation(embed_size=32, 
-    #                         hidden=64, 
-    #                         num_layers=2, 
-    #                         dropout=0.5, 
-    #                         k4kmer=7, 
-    #                         use_pretrain=False, 
-    #                         use_coattn=False, 
-    #                         use_kmer_embed=True, 
-    #                         use_seq_encoder=False, 
-    #                         seq_encoder_type="lstm", 
-    #                         num_heads=4, 
-    #                         num_inds=6, 
-    #                         num_outputs=6, 
-    #                         ln=True).cuda()
-    #         epochs = 150
-    #         lr = 6e-5
-            
-    #     elif model_name=="FTransformer":
-    #         model = FTransformer(embed_size=32, 
-    #                             hidden=64, 
-    #                             num_layers=2, 
-    #                             dropout=0.5, 
-    #                             k4kmer=3, 
-    #                             use_pretrain=False, 
-    #                             use_coattn=True, 
-    #                             seq_encoder_type="transformer", 
-    #                             num_heads=2).cuda()
-            
-    #         epochs = 100
-    #         lr = 3e-5
-            
-    #     elif model_name=="EnsembleModel":
-    #         model = EnsembleModel(embed_size=16, 
-    #                     hidden=64, 
-    #                     max_len=100, 
-    #                     num_encoder_layers=1, 
-    #                     num_heads=2, 
-    #                     num_inds=6, 
-    #                     num_outputs=6, 
-    #                     ln=True, 
-    #                     dropout=0.5, 
-    #                     use_coattn=True).cuda()
-            
-    #         epochs = 500
-    #         lr = 1e-5
-            
-    #     elif model_name=="EnsembleModel_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/EnsembleModel/model_best.pth")
-    #         model.train()
-            
-    #         epochs = 500
-    #         lr = 1e-4
-            
-    #     elif model_name=="PESI":
-    # #         model = PESI(embed_size=7, 
-    # #                      hidden=512, 
-    # #                      max_len=100, 
-    # #                      num_heads=2, 
-    # #                      num_inds=6, 
-    # #                      num_outputs=6, 
-    # #                      ln=True, 
-    # #                      dropout=0.5, 
-    # #                      use_coattn=True).cuda()
-    #         model = PESI(embed_size=8, 
-    #                     hidden=64, 
-    #                     max_len=100, 
-    #                     num_heads=2, 
-    #                     num_inds=6, 
-    #                     num_outputs=6, 
-    #                     ln=True, 
-    #                     dropout=0.5, 
-    #                     use_coattn=True).cuda()
-            
-    #         epochs = 200
-    #         lr = 5e-5
-    # #         wd = 3e-4
-    #         l2_coef = 5e-4
-            
-    #     elif model_name=="PESI_ft":
-    #         model = torch.load("./results/SAbDab/full/seq1_neg0/PESI/model_best.pth")
-    #         model.train()
-            
-    #         # freeze frame feature extractor
-    #         for name, param in model.Frame_para.named_parameters():
-    #             param.requires_grad = False
-    #         for name, param in model.Frame_epi.named_parameters():
-    #             param.requires_grad = False
+    
+#     elif model_name=="InteractTransformer":
+#         model = InteractTransformer(embed_size=32, 
+#                                     num_encoder_layers=1, 
+#                                     nhead=2, 
+#                                     dropout=0.3, 
+#                                     use_coattn=False).cuda()
+#         epochs = 200
+#         lr = 3e-5
+        
+#     elif model_name=="InteractTransformer_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/InteractTransformer/model_best.pth")
+#         model.train()
+        
+#         if config["fix_FE"]==True:
+#             for name, param in model.transformer_para.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.transformer_epi.named_parameters():
+#                 param.requires_grad = False
+
+#         epochs = 1000
+#         lr = 1e-4
+#         l2_coef = 5e-4
+                
+#     elif model_name=="InteractCoAttnTransformer":
+#         model = InteractTransformer(embed_size=32, 
+#                                     num_encoder_layers=1, 
+#                                     nhead=2, 
+#                                     dropout=0.5, 
+#                                     use_coattn=True).cuda()
+#         epochs = 200
+#         lr = 3e-5
+        
+#     elif model_name=="InteractCoAttnTransformer_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/InteractCoAttnTransformer/model_best.pth")
+#         model.train()
+    
+#         if config["fix_FE"]==True:
+#             for name, param in model.transformer_para.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.transformer_epi.named_parameters():
+#                 param.requires_grad = False
+        
+#         epochs = 1500
+#         lr = 6e-5
+#         l2_coef = 5e-4
+        
+#     elif model_name=="InteractCoAttnTransformer_ft_pairPreTrain":
+#         encoder = torch.load("./results/SAbDab/full/seq1_neg0/InteractTransformer_encoder/model_best.pth")
+#         encoder.train()
+        
+#         model = TowerBaseModel(embed_size=32, hidden=128, encoder=encoder, 
+#                             use_two_towers=False, use_coattn=True, fusion=1).cuda()
+    
+#         if config["fix_FE"]==True:
+#             for name, param in model.encoder.named_parameters():
+#                 param.requires_grad = False
+        
+#         epochs = 1500
+#         lr = 6e-5
+#         l2_coef = 5e-4
+
+#     elif model_name=="InteractTransformerLSTM":
+#         model = InteractTransformerLSTM(embed_size=32, 
+#                                         hidden=64, 
+#                                         num_encoder_layers=1, 
+#                                         num_lstm_layers=1, 
+#                                         nhead=2, 
+#                                         dropout=0.5, 
+#                                         use_coattn=True).cuda()
+#         epochs = 200
+#         lr = 6e-5
+
+#     elif model_name=="InteractTransformerLSTM_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/InteractTransformerLSTM/model_best.pth")
+#         model.train()
+        
+#         epochs = 200
+#         lr = 6e-5
                 
-    #         # freeze frame feature extractor        
-    #         for name, param in model.Set_para.named_parameters():
-    #             param.requires_grad = False
-    #         for name, param in model.Set_epi.named_parameters():
-    #             param.requires_grad = False
-            
-    #         epochs = 500
-    #         lr = 3e-5
-    #         l2_coef = 5e-4
-
-    #     else:
-    #         print("wrong model name!!!")
-    #         break
-
-        print("model_name: {}".format(config["model_name"]))
 
-        print("model parameters: ", sum(p.numel() for p in config["model"].parameters() if p.requires_grad))
         
-        criterion = nn.BCELoss()
-        optimizer = optim.Adam(config["model"].parameters(), lr=config["lr"])#, weight_decay=wd)
-        # scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=5, eta_min=1e-6, last_epoch=-1)
-
-        loss_buf = []
-        val_loss_buf = []
-        val_acc_buf = []
-        val_f1_buf = []
-        val_auc_buf = []
-        val_gmean_buf = []
-        val_mcc_buf = []
-        best_val_loss = float("inf")
         
-        for epoch in range(config["epochs"]):
+#     elif model_name=="SetModel":
+#         model = SetModel(embed_size=32, 
+#                         hidden=64, 
+#                         num_layers=1, 
+#                         dropout=0.3, 
+#                         k4kmer=3, 
+#                         use_pretrain=False, 
+#                         use_coattn=False, 
+#                         seq_encoder_type="transformer", 
+#                         num_heads=2, 
+#                         num_inds=6, 
+#                         num_outputs=6, 
+#                         ln=True).cuda()
+        
+#         epochs = 200
+#         lr = 3e-5
+#         l2_coef = 5e-4
+        
+#     elif model_name=="SetModel_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/SetModel/model_best.pth")
+#         model.train()
+        
+#         if config["fix_FE"]==True:
+#             for name, param in model.para_enc.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.para_dec.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.epi_enc.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.epi_dec.named_parameters():
+#                 param.requires_grad = False
+        
+#         epochs = 200
+#         lr = 3e-5
+#         l2_coef = 5e-4
+    
+#     elif model_name=="SetCoAttnModel":
+#         model = SetModel(embed_size=32, 
+#                         hidden=64, 
+#                         num_layers=1, 
+#                         dropout=0.3, 
+#                         k4kmer=3, 
+#                         use_pretrain=False, 
+#                         use_coattn=True, 
+#                         seq_encoder_type="transformer", 
+#                         num_heads=2, 
+#                         num_inds=6, 
+#                         num_outputs=6, 
+#                         ln=True).cuda()
+#         epochs = 200
+#         lr = 3e-5
+    
+#     elif model_name=="SetCoAttnModel_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/SetCoAttnModel/model_best.pth")
+#         model.train()
+        
+#         if config["fix_FE"]==True:
+#             for name, param in model.para_enc.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.para_dec.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.epi_enc.named_parameters():
+#                 param.requires_grad = False
+#             for name, param in model.epi_dec.named_parameters():
+#                 param.requires_grad = False
+        
+#         epochs = 200
+#         lr = 3e-5
+#         l2_coef = 5e-4
+        
+#     elif model_name=="SetModel_ablation":
+#         model = SetModel_ablation(embed_size=32, 
+#                         hidden=64, 
+#                         num_layers=2, 
+#                         dropout=0.5, 
+#                         k4kmer=7, 
+#                         use_pretrain=False, 
+#                         use_coattn=False, 
+#                         use_kmer_embed=True, 
+#                         use_seq_encoder=False, 
+#                         seq_encoder_type="lstm", 
+#                         num_heads=4, 
+#                         num_inds=6, 
+#                         num_outputs=6, 
+#                         ln=True).cuda()
+#         epochs = 150
+#         lr = 6e-5
+        
+#     elif model_name=="FTransformer":
+#         model = FTransformer(embed_size=32, 
+#                             hidden=64, 
+#                             num_layers=2, 
+#                             dropout=0.5, 
+#                             k4kmer=3, 
+#                             use_pretrain=False, 
+#                             use_coattn=True, 
+#                             seq_encoder_type="transformer", 
+#                             num_heads=2).cuda()
+        
+#         epochs = 100
+#         lr = 3e-5
+        
+#     elif model_name=="EnsembleModel":
+#         model = EnsembleModel(embed_size=16, 
+#                     hidden=64, 
+#                     max_len=100, 
+#                     num_encoder_layers=1, 
+#                     num_heads=2, 
+#                     num_inds=6, 
+#                     num_outputs=6, 
+#                     ln=True, 
+#                     dropout=0.5, 
+#                     use_coattn=True).cuda()
+        
+#         epochs = 500
+#         lr = 1e-5
+        
+#     elif model_name=="EnsembleModel_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/EnsembleModel/model_best.pth")
+#         model.train()
+        
+#         epochs = 500
+#         lr = 1e-4
+        
+#     elif model_name=="PESI":
+# #         model = PESI(embed_size=7, 
+# #                      hidden=512, 
+# #                      max_len=100, 
+# #                      num_heads=2, 
+# #                      num_inds=6, 
+# #                      num_outputs=6, 
+# #                      ln=True, 
+# #                      dropout=0.5, 
+# #                      use_coattn=True).cuda()
+#         model = PESI(embed_size=8, 
+#                     hidden=64, 
+#                     max_len=100, 
+#                     num_heads=2, 
+#                     num_inds=6, 
+#                     num_outputs=6, 
+#                     ln=True, 
+#                     dropout=0.5, 
+#                     use_coattn=True).cuda()
+        
+#         epochs = 200
+#         lr = 5e-5
+# #         wd = 3e-4
+#         l2_coef = 5e-4
+        
+#     elif model_name=="PESI_ft":
+#         model = torch.load("./results/SAbDab/full/seq1_neg0/PESI/model_best.pth")
+#         model.train()
+        
+#         # freeze frame feature extractor
+#         for name, param in model.Frame_para.named_parameters():
+#             param.requires_grad = False
+#         for name, param in model.Frame_epi.named_parameters():
+#             param.requires_grad = False
+            
+#         # freeze frame feature extractor        
+#         for name, param in model.Set_para.named_parameters():
+#             param.requires_grad = False
+#         for name, param in model.Set_epi.named_parameters():
+#             param.requires_grad = False
+        
+#         epochs = 500
+#         lr = 3e-5
+#         l2_coef = 5e-4
+
+#     else:
+#         print("wrong model name!!!")
+#         break
+
+    print("model_name: {}".format(config["model_name"]))
+
+    print("model parameters: ", sum(p.numel() for p in config["model"].parameters() if p.requires_grad))
+    
+    criterion = nn.BCELoss()
+    optimizer = optim.Adam(config["model"].parameters(), lr=config["lr"])#, weight_decay=wd)
+    # scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=5, eta_min=1e-6, last_epoch=-1)
+
+    loss_buf = []
+    val_loss_buf = []
+    val_acc_buf = []
+    val_f1_buf = []
+    val_auc_buf = []
+    val_gmean_buf = []
+    val_mcc_buf = []
+    best_val_loss = float("inf")
+    best = None
+    if os.path.exists(result_dir+"history_{}.jsonl".format(k_iter)):
+        os.remove(result_dir+"history_{}.jsonl".format(k_iter))
+    telemetry = Telemetry(result_dir+"telemetry_{}.jsonl".format(k_iter), 
+                          every=config.get("telemetry_every", 50), 
+                          interval=config.get("log_interval", 30), 
+                          epochs=config["epochs"], 
+                          tag="{} fold {}".format(config["model_name"], k_iter))
+    # per-stage step times in the telemetry epoch records, a torch.profiler trace of a window of train steps
+    timer = start_timing(sync=config.get("sync_timers", False)) if config.get("stage_timers", False)==True else None
+    profiler = None
+    if config.get("profile_steps")!=None:
+        profiler = ModelProfiler(config["model"], result_dir+"profile/", 
+                                 start=config["profile_steps"][0], 
+                                 active=config["profile_steps"][1], 
+                                 tag="fold{}".format(k_iter))
+    
+    for epoch in range(config["epochs"]):
 
-            config["model"].train()
+        config["model"].train()
 
-            loss_tmp = []
-            for i, (para, epi, label) in enumerate(tqdm(train_loader)):
-                optimizer.zero_grad()
+        loss_tmp = []
+        for i, (para, epi, label, *lens) in enumerate(telemetry.iterate(train_loader)):
+            optimizer.zero_grad()
 
+            with stage("forward"):
                 if config["use_BSS"]==False:
-                    pred = config["model"](para, epi)
+                    pred = config["model"](para, epi, *lens)
                 elif config["use_BSS"]==True:
-                    pred, BSS = config["model"](para, epi)
+                    pred, BSS = config["model"](para, epi, *lens)
                 else:
                     pass
-                    
-                loss = criterion(pred.view(-1), label.view(-1).cuda())
                 
+            with stage("loss"):
+                loss = criterion(pred.view(-1), label.view(-1).cuda())
+            
+            with stage("regularization"):
                 if config["use_reg"]==0:
                     param_l2_loss = 0
                     for name, param in config["model"].named_parameters():
@@ -872,103 +482,154 @@ def cov_train(config):
                 if config["use_BSS"]==True:
                     loss += 0.001*BSS
 
+            with stage("backward"):
                 loss.backward()
-                
+            
+            with stage("clip_grad"):
                 torch.nn.utils.clip_grad_norm_(config["model"].parameters(), config["clip_norm"])
 
+            with stage("optimizer"):
                 optimizer.step()
 
+            # waits for the queued GPU work of the step unless the timers synchronise
+            with stage("sync"):
                 loss_tmp.append(loss.item())
-            
-            loss_buf.append(np.mean(loss_tmp))
+            telemetry.update(loss=loss_tmp[-1])
+            if profiler is not None:
+                profiler.step()
+        
+        loss_buf.append(np.mean(loss_tmp))
 
-        #     scheduler.step()
-            print("lr: ", optimizer.param_groups[0]['lr'])
+    #     scheduler.step()
 
-            with torch.no_grad():
+        with torch.no_grad():
 
-                config["model"].eval()
+            config["model"].eval()
 
-                preds = []
-                labels = []
-                val_loss_tmp = []
-                for i, (para, epi, label) in enumerate(test_loader):
+            # predictions written in place in dataset order, the loss summed on the device: one sync per epoch
+            device = next(config["model"].parameters()).device
+            preds = torch.empty(len(test_dataset), device=device)
+            labels = torch.empty(len(test_dataset))
+            val_loss_sum = torch.zeros((), device=device)
+            val_metrics = StreamingMetrics()
+            for idx, (para, epi, label, *lens) in zip(test_batches, telemetry.iterate(test_loader, phase="val")):
+                with stage("eval_forward"):
                     if config["use_BSS"]==False:
-                        pred = config["model"](para, epi)
+                        pred = config["model"](para, epi, *lens)
                     elif config["use_BSS"]==True:
-                        pred, BSS = config["model"](para, epi)
-                    
-                    val_loss = criterion(pred.view(-1), label.view(-1).cuda())
+                        pred, BSS = config["model"](para, epi, *lens)
+                    pred = pred.view(-1)
+                
+                with stage("eval_loss"):
+                    # sum of the per-pair BCE losses
+                    val_loss_sum += nn.functional.binary_cross_entropy(pred, label.view(-1).cuda(), reduction="sum")
                     
                     if config["use_BSS"]==True:
-                        val_loss += 0.001*BSS
-                    
-                    preds.append(pred.detach().cpu().view(-1))
-                    labels.append(label.view(-1))
-                    val_loss_tmp.append(val_loss.item())
+                        val_loss_sum += 0.001*BSS
                 
-                preds = torch.stack(preds, axis=1).view(-1)
-                labels = torch.stack(labels, axis=1).view(-1)
+                with stage("eval_metrics"):
+                    preds[torch.tensor(idx, device=device)] = pred
+                    labels[torch.tensor(idx)] = label.view(-1)
+                    val_metrics.update(pred, label)
+            
+            with stage("eval_metrics"):
+                acc, f1, auc, gmean, mcc = val_metrics.compute()
+                preds = preds.cpu()
+                val_loss_mean = val_loss_sum.item() / len(test_dataset)
+
+            val_acc_buf.append(acc)
+            val_f1_buf.append(f1)
+            val_auc_buf.append(auc)
+            val_gmean_buf.append(gmean)
+            val_mcc_buf.append(mcc)
+            val_loss_buf.append(val_loss_mean)
+
+            # one background job per epoch: history record, plus best checkpoint and metrics on improvement
+            record = {"epoch": epoch, "loss": float(loss_buf[-1]), "val_loss": float(val_loss_buf[-1]), 
+                      "acc": float(acc), "f1": float(f1), "auc": float(auc), "gmean": float(gmean), "mcc": float(mcc)}
+            telemetry.end_epoch(record)
+            is_best = val_loss_mean<best_val_loss
+            if is_best:
+                best_val_loss = val_loss_mean
+                best = record
+            # predictions of the best epoch, in test set order, for bootstrap.py
+            best_arrays = {result_dir+"val_pred_{}_best.npy".format(k_iter): preds.numpy(), 
+                           result_dir+"val_label_{}_best.npy".format(k_iter): labels.numpy()}
+            if writer.store is None:
+                best_arrays.update({result_dir+"val_{}_{}_best.npy".format(m, k_iter): record[m] 
+                                    for m in ["acc", "f1", "auc", "gmean", "mcc"]})
+            writer.epoch(result_dir+"history_{}.jsonl".format(k_iter), record, 
+                         model=config["model"] if is_best else None, 
+                         ckpt_path=result_dir+"model_{}_best.pth".format(k_iter), 
+                         best_arrays=best_arrays, 
+                         key=store_key(config, k_iter))
 
-                acc, f1, auc, gmean, mcc = evaluate_metrics(pred_proba=preds, label=labels)
+        config["model"].train()
+    
+    telemetry.close()
+    if profiler is not None:
+        profiler.close()
+    if timer is not None:
+        print(stop_timing().table())
+    writer.save(config["model"], result_dir+"model_{}.pth".format(k_iter))
+    if writer.store is None:
+        # the results store has every epoch, the per-epoch buffers are only written without it
+        writer.arrays({result_dir+"loss_buf_{}.npy".format(k_iter): np.array(loss_buf), 
+                       result_dir+"val_loss_buf_{}.npy".format(k_iter): np.array(val_loss_buf), 
+                       result_dir+"val_acc_buf_{}.npy".format(k_iter): np.array(val_acc_buf), 
+                       result_dir+"val_f1_buf_{}.npy".format(k_iter): np.array(val_f1_buf), 
+                       result_dir+"val_auc_buf_{}.npy".format(k_iter): np.array(val_auc_buf), 
+                       result_dir+"val_gmean_buf_{}.npy".format(k_iter): np.array(val_gmean_buf), 
+                       result_dir+"val_mcc_buf_{}.npy".format(k_iter): np.array(val_mcc_buf)})
+
+    return labels, preds, best
 
-                val_acc_buf.append(acc)
-                val_f1_buf.append(f1)
-                val_auc_buf.append(auc)
-                val_gmean_buf.append(gmean)
-                val_mcc_buf.append(mcc)
-                val_loss_buf.append(np.mean(val_loss_tmp))
 
-                print("Epoch {}: \n Train Loss\t{:.4f} \n Val Loss\t{:.4f} \n Val Acc\t{:.4f} \n Val F1\t\t{:.4f} \n Val AUC\t{:.4f} \n Val GMean\t{:.4f} \n Val MCC\t{:.4f}".format(epoch, np.mean(loss_buf), np.mean(val_loss_buf), acc, f1, auc, gmean, mcc))
-                
-                if np.mean(val_loss_tmp)<best_val_loss:
-                    best_val_loss = np.mean(val_loss_tmp)
-                    torch.save(config["model"], "./results/CoV-AbDab/{}/model_{}_best.pth".format(config["model_name"], k_iter))
-                    np.save("./results/CoV-AbDab/{}/val_acc_{}_best.npy".format(config["model_name"], k_iter), acc)
-                    np.save("./results/CoV-AbDab/{}/val_f1_{}_best.npy".format(config["model_name"], k_iter), f1)
-                    np.save("./results/CoV-AbDab/{}/val_auc_{}_best.npy".format(config["model_name"], k_iter), auc)
-                    np.save("./results/CoV-AbDab/{}/val_gmean_{}_best.npy".format(config["model_name"], k_iter), gmean)
-                    np.save("./results/CoV-AbDab/{}/val_mcc_{}_best.npy".format(config["model_name"], k_iter), mcc)
-
-            config["model"].train()
-        
-        torch.save(config["model"], "./results/CoV-AbDab/{}/model_{}.pth".format(config["model_name"], k_iter))
-        np.save("./results/CoV-AbDab/{}/loss_buf_{}.npy".format(config["model_name"], k_iter), np.array(loss_buf))
-        np.save("./results/CoV-AbDab/{}/val_loss_buf_{}.npy".format(config["model_name"], k_iter), np.array(val_loss_buf))
-        np.save("./results/CoV-AbDab/{}/val_acc_buf_{}.npy".format(config["model_name"], k_iter), np.array(val_acc_buf))
-        np.save("./results/CoV-AbDab/{}/val_f1_buf_{}.npy".format(config["model_name"], k_iter), np.array(val_f1_buf))
-        np.save("./results/CoV-AbDab/{}/val_auc_buf_{}.npy".format(config["model_name"], k_iter), np.array(val_auc_buf))
-        np.save("./results/CoV-AbDab/{}/val_gmean_buf_{}.npy".format(config["model_name"], k_iter), np.array(val_gmean_buf))
-        np.save("./results/CoV-AbDab/{}/val_mcc_buf_{}.npy".format(config["model_name"], k_iter), np.array(val_mcc_buf))
-        
-        
-        kfold_labels.append(labels)
-        kfold_preds.append(preds)
-        
-    #     break
+def cov_train(config):
 
-    res = evaluate(model_name=config["model_name"], kfold=config["kfold"])
+    config = set_model_name(config)
 
-    return res
+    print("make folder ./results/CoV-AbDab/{}/".format(config["model_name"]))
+    os.makedirs("./results/CoV-AbDab/{}/".format(config["model_name"]), exist_ok=True)
 
+    print("model name: {}\tuse_fine_tune: {}".format(config["model_name"], config["use_fine_tune"]))
 
-if __name__=='__main__':
+    kfold_labels = []
+    kfold_preds = []
 
-    # set_seed(seed=3407)
-    set_seed(seed=42)
+    # checkpoints and metric files are written in the background, training does not wait on the disk
+    result_dir = "./results/CoV-AbDab/{}/".format(config["model_name"])
+    writer = AsyncCheckpointWriter(max_pending=2, store=open_store(config))
 
-    # model_name = "masonscnn"
-    # model_name = "lstm"
-    # model_name = "textcnn"
-    # model_name = "ag_fast_parapred"
-    # model_name = "pipr"
-    # model_name = "resppi"
-    # model_name = "pesi"
+    if config.get("stack_folds", False)==True:
+        # all folds trained together as one vmapped model, see fold_stack.py
+        from fold_stack import train_folds_stacked
+        config = train_folds_stacked(config, writer, result_dir)
+    else:
+        for k_iter in range(config["kfold"]):
+            
+            print("=========================================================")
+            print("fold {} as val set".format(k_iter))
 
-    model_name = sys.argv[1]
-    use_fine_tune = True if sys.argv[2]=="ft" else False
-    print("use_fine_tune: {}".format(use_fine_tune))
+            labels, preds, _ = train_fold(config, k_iter, writer, result_dir)
+            
+            kfold_labels.append(labels)
+            kfold_preds.append(preds)
+        
+    #     break
+
+    # evaluate reads the best metrics from disk
+    writer.close()
+
+    if writer.store is not None:
+        res = results_store.evaluate(config["results_db"], config["model_name"], run=config.get("run", 0))
+    else:
+        res = evaluate(model_name=config["model_name"], kfold=config["kfold"])
+
+    return res
 
+
+def default_config(model_name, use_fine_tune=False):
     config = {
         # data type
         "clip_norm": 1, 
@@ -983,24 +644,64 @@ if __name__=='__main__':
         # training params
         "use_reg": 0,                           # regularisation type: 0 - L2; 1 - L1
         "use_BSS": False,                       # Batch Spectral Shrinkage regularisation
-        "use_aug": True,                        # True: my_collate_fn1 for testing, my_collate_fn2 for training
+        "use_aug": True,                        # True: augment training batches in collate_fn
+        "val_batch_size": 256,                  # maximum validation batch size, see dataset.length_batches
+        "stack_folds": False,                   # True: train the kfold models together, vmapped (fold_stack.py)
+        "esm_store": None,                      # directory written by precompute_esm.py, for use_pretrain models
+        "results_db": "./results/results.db",   # SQLite results store (results_store.py), None for per-metric .npy files
+        "telemetry_every": 50,                  # train steps per telemetry_<fold>.jsonl step record (telemetry.py)
+        "log_interval": 30,                     # minimum seconds between console epoch lines
+        "stage_timers": False,                  # per-stage step timings (profiling.py) in the telemetry records
+        "sync_timers": False,                   # synchronise CUDA around the stages, exact but slower
+        "profile_steps": None,                  # [skip, active]: torch.profiler trace of `active` train steps
 
         # experiment params
         "ntimes": 3,                            # repeat ntimes of kfold
+        "workers": None,                        # worker processes training the ntimes x kfold folds in parallel
+                                                # (fold_scheduler.py), None to train them one after the other here
+        "worker_threads": 1,                    # torch threads per worker
         "kfold": 10,                            # kfold cross validation
         "batch_size": 16,                       # batch size
 
         # model_params
-        "model_name":model_name
+        "model_name": model_name
 
     }
 
+    return config
+
+
+if __name__=='__main__':
+
+    # set_seed(seed=3407)
+    set_seed(seed=42)
+
+    # model_name = "masonscnn"
+    # model_name = "lstm"
+    # model_name = "textcnn"
+    # model_name = "ag_fast_parapred"
+    # model_name = "pipr"
+    # model_name = "resppi"
+    # model_name = "pesi"
+
+    model_name = sys.argv[1]
+    use_fine_tune = True if sys.argv[2]=="ft" else False
+    print("use_fine_tune: {}".format(use_fine_tune))
+
+    config = default_config(model_name, use_fine_tune)
+
 
     print(config)
 
     # training
+    if config["workers"] is not None:
+        from fold_scheduler import schedule
+        schedule(config, config["workers"], threads=config["worker_threads"], seed=42)
+        exit()
+
     for i in range(config["ntimes"]):
         print("Run {} times of {}fold".format(config["ntimes"], config["kfold"]))
+        config["run"] = i
         result = cov_train(config=config)
         # current_time = time.strftime('%Y-%m-%d-%H-%M', time.localtime())
         print("Results dump to: ")
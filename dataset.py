@@ -6,9 +6,8 @@ import os
 import pickle
 import random
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
-from utils import *
+from utils import vocab, seq_lens, seq_pad_clip, seq_sim, seq_key, get_knearest_epi
 
 
 def get_random_sequence(length=48):
@@ -178,7 +177,17 @@ def augment_fn(seq):
         return seq
 
 
-def collate_fn(batch, mode=0, use_augment=False):
+def pad_pairs(paras, epis):
+    # +ABCD-###, padded to the longest paratope / epitope of the batch
+    max_len = max(max(list(map(lambda x:len(x), paras))), max(list(map(lambda x:len(x), epis))))
+
+    paras = ["+"+i.strip("#")+"-"+"#"*(max_len-len(i.strip("#"))) for i in paras]
+    epis = ["+"+i.strip("#")+"-"+"#"*(max_len-len(i.strip("#"))) for i in epis]
+
+    return paras, epis
+
+
+def collate_fn(batch, mode=0, use_augment=False, return_lens=False):
 
     paras = [b[0] for b in batch]
     epis = [b[1] for b in batch]
@@ -190,13 +199,14 @@ def collate_fn(batch, mode=0, use_augment=False):
     # +ABCD-###
     if mode==0:
         labels = torch.hstack([b[2] for b in batch])
-        max_len = max(max(list(map(lambda x:len(x), paras))), max(list(map(lambda x:len(x), epis))))
-
-        paras = ["+"+i.strip("#")+"-"+"#"*(max_len-len(i.strip("#"))) for i in paras]
-        epis = ["+"+i.strip("#")+"-"+"#"*(max_len-len(i.strip("#"))) for i in epis]
+        paras, epis = pad_pairs(paras, epis)
 
         new_batch = [paras, epis, labels]
 
+        # real lengths (with BEGIN/END tokens) for length-aware models
+        if return_lens==True:
+            new_batch += [torch.from_numpy(seq_lens(paras)), torch.from_numpy(seq_lens(epis))]
+
         return new_batch
     
     # padding for six CDRs
@@ -208,6 +218,35 @@ def collate_fn(batch, mode=0, use_augment=False):
 
         return new_batch
     
+def length_batches(dataset, batch_size, max_shared_len=0):
+    '''
+    batches of dataset indices grouped by padded length, for validation with collate_fn (no augmentation)
+    pairs padded to the same length always share batches, so every pair gets the input it would get alone
+
+    :param dataset:         SeqDataset with use_pair=False, or a dataset wrapping one as .dataset
+    :param batch_size:      maximum batch size
+    :param max_shared_len:  pairs padded to at most this length (with BEGIN / END) are batched regardless of their
+                            length, for models whose output does not depend on the padding up to that length
+    :return:                list of index lists
+    '''
+    base = getattr(dataset, "dataset", dataset)
+    # collate_fn pads a pair to its longest sequence plus BEGIN / END
+    lens = [max(len(para.strip("#")), len(epi.strip("#")))+2 for para, epi, _ in (base[i] for i in range(len(base)))]
+
+    batches = []
+    batch = []
+    for i in np.argsort(lens, kind="stable"):
+        shared = lens[i]<=max_shared_len
+        if len(batch)==batch_size or (len(batch)>0 and not shared and lens[i]!=lens[batch[0]]):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if len(batch)>0:
+        batches.append(batch)
+
+    return batches
+
+
 def pair_collate_fn(batch, mode=0):
 
     paras = [b[0] for b in batch]
@@ -236,6 +275,9 @@ def my_collate_fn1(batch):
 def my_collate_fn2(batch):
     return collate_fn(batch, mode=0, use_augment=True)
 
+def lens_collate_fn(batch):
+    return collate_fn(batch, mode=0, use_augment=False, return_lens=True)
+
 
 # SAbDab
 class SAbDabDataset(torch.utils.data.Dataset):
@@ -348,13 +390,21 @@ class SeqDataset(torch.utils.data.Dataset):
                  balance_samples=False, 
                  balance_ratio=1):
         
+        import pandas as pd
+
         self.use_pair = use_pair
         self.balance_samples = balance_samples
+        self.is_train_test_full = is_train_test_full
+
+        # columns already parsed into numpy arrays, e.g. in the shared memory of fold_scheduler workers
+        self.columns = None
+        if isinstance(data_path, dict):
+            self.init_columns(data_path, kfold, holdout_fold)
+            return
 
         self.data_df = pd.read_csv(data_path)
         if self.balance_samples:
             self.balance(ratio=balance_ratio)
-        self.is_train_test_full = is_train_test_full
         self.data = self.data_df.sample(frac=1, random_state=42)
 
         self.label = torch.Tensor(self.data["Class"])
@@ -378,25 +428,69 @@ class SeqDataset(torch.utils.data.Dataset):
             self.train_label = torch.hstack(self.label_folds)
         
         if self.use_pair==True:
-            self.pair_data = []
+            self.make_pairs()
 
-            for i in range(len(self.data)):
-                if self.label[i]==1:
-                    paratope = self.data.iloc[i][0]
-                    antigen_pos = self.data.iloc[i][1]
+    def init_columns(self, columns, kfold, holdout_fold):
+        """
+        columns: {"Paratope", "Epitope": (num_rows, ) bytes arrays, "Class": (num_rows, ) float32 array}
+        the sequences stay in the arrays, folds keep row indices only
+        """
+        import pandas as pd
 
-                    j = random.randint(0, len(self.data)-1)
-                    antigen_neg = self.data.iloc[j][1]
-                    while seq_sim(antigen_neg, antigen_pos)>=0.5:
-                        j = random.randint(0, len(self.data)-1)
-                        antigen_neg = self.data.iloc[j][1]
-                    
-                    self.pair_data.append((paratope, antigen_pos, antigen_neg))
+        if self.balance_samples:
+            print("balance_samples needs the csv path, not parsed columns")
+            exit()
+        self.columns = columns
+        num_rows = len(columns["Class"])
+
+        # the same order as read from the csv: the shuffle applies to the labels only
+        self.label = torch.Tensor(pd.Series(columns["Class"]).sample(frac=1, random_state=42).values)
+        self.rows = np.arange(num_rows)
+        self.row_label = self.label
+
+        if self.is_train_test_full=="train" or self.is_train_test_full=="test":
+            fold_size = int(0.1*num_rows)
+            folds = [np.arange(k*fold_size, (k+1)*fold_size) for k in range(kfold)]
+            self.test_rows = folds.pop(holdout_fold)
+            self.train_rows = np.concatenate(folds)
+            self.test_label = self.label[torch.from_numpy(self.test_rows)]
+            self.train_label = self.label[torch.from_numpy(self.train_rows)]
+            if self.is_train_test_full=="train":
+                self.rows, self.row_label = self.train_rows, self.train_label
+            else:
+                self.rows, self.row_label = self.test_rows, self.test_label
+
+        if self.use_pair==True:
+            self.make_pairs()
+
+    def seqs(self, i):
+        # paratope, epitope of row i, in csv order
+        if self.columns is not None:
+            return self.columns["Paratope"][i].decode(), self.columns["Epitope"][i].decode()
+        return self.data.iloc[i][0], self.data.iloc[i][1]
+
+    def make_pairs(self):
+        self.pair_data = []
+
+        num_rows = len(self.label)
+        for i in range(num_rows):
+            if self.label[i]==1:
+                paratope, antigen_pos = self.seqs(i)
+
+                j = random.randint(0, num_rows-1)
+                antigen_neg = self.seqs(j)[1]
+                while seq_sim(antigen_neg, antigen_pos)>=0.5:
+                    j = random.randint(0, num_rows-1)
+                    antigen_neg = self.seqs(j)[1]
+                
+                self.pair_data.append((paratope, antigen_pos, antigen_neg))
 
     def balance(self, ratio):
         """
         ratio: ratio of neg:pos
         """
+        import pandas as pd
+
         num_pos = len(self.data_df[self.data_df["Class"]==1])
         num_neg = len(self.data_df[self.data_df["Class"]==0])
         num_neg_sample = num_pos*ratio - num_neg
@@ -426,7 +520,9 @@ class SeqDataset(torch.utils.data.Dataset):
 
     def __len__(self):
         if self.use_pair==False:
-            if self.is_train_test_full=="train":
+            if self.columns is not None:
+                return len(self.rows)
+            elif self.is_train_test_full=="train":
                 return self.train_data.shape[0]
             elif self.is_train_test_full=="test":
                 return self.test_data.shape[0]
@@ -437,7 +533,9 @@ class SeqDataset(torch.utils.data.Dataset):
     
     def __getitem__(self, idx):
         if self.use_pair==False:
-            if self.is_train_test_full=="train":
+            if self.columns is not None:
+                return (*self.seqs(self.rows[idx]), self.row_label[idx])
+            elif self.is_train_test_full=="train":
                 return self.train_data.iloc[idx][0], self.train_data.iloc[idx][1], self.train_label[idx]
             elif self.is_train_test_full=="test":
                 return self.test_data.iloc[idx][0], self.test_data.iloc[idx][1], self.test_label[idx]
@@ -446,6 +544,89 @@ class SeqDataset(torch.utils.data.Dataset):
         else:
             return self.pair_data[idx][0], self.pair_data[idx][1], self.pair_data[idx][2]
 
+# precomputed ESM features, written by precompute_esm.py
+class ESMFeatureStore(object):
+    def __init__(self, store_path, per_residue=False):
+        """
+        store_path/index.pkl      {"model_name", "repr_layer", "keys": {seq_key: row}}
+        store_path/means.npy      (num_seqs, embed_size) float32, per-sequence mean embeddings
+        store_path/residues.npy   (total_residues, embed_size) float16, optional per-residue embeddings
+        store_path/offsets.npy    (num_seqs+1, ) int64, rows of residues.npy belonging to each sequence
+        all arrays are memory-mapped, so the store is shared by DataLoader workers and folds without copies
+        """
+        self.store_path = store_path
+        meta = pickle.load(open(os.path.join(store_path, "index.pkl"), "rb"))
+        self.model_name = meta["model_name"]
+        self.repr_layer = meta["repr_layer"]
+        self.keys = meta["keys"]
+
+        self.means = np.load(os.path.join(store_path, "means.npy"), mmap_mode="r")
+        self.per_residue = per_residue
+        if self.per_residue:
+            self.residues = np.load(os.path.join(store_path, "residues.npy"), mmap_mode="r")
+            self.offsets = np.load(os.path.join(store_path, "offsets.npy"))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, seq):
+        return seq_key(seq) in self.keys
+
+    def row(self, seq):
+        try:
+            return self.keys[seq_key(seq)]
+        except KeyError:
+            raise KeyError("sequence not in ESM store {}, rerun precompute_esm.py: {}".format(self.store_path, seq))
+
+    def mean(self, seq):
+        return torch.from_numpy(np.array(self.means[self.row(seq)]))
+
+    def residue(self, seq):
+        row = self.row(seq)
+        return torch.from_numpy(np.array(self.residues[self.offsets[row]:self.offsets[row+1]]))
+
+
+# serve precomputed ESM features in place of the sequences of any (para, epi, label) dataset
+class ESMFeatureDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, store):
+        """
+        :param dataset: SAbDabDataset or SeqDataset with use_pair=False
+        :param store:   ESMFeatureStore, per-residue features are served if the store was opened with per_residue
+        """
+        self.dataset = dataset
+        self.store = store
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        para, epi, label = self.dataset[idx]
+        if self.store.per_residue:
+            return self.store.residue(para), self.store.residue(epi), label
+        return self.store.mean(para), self.store.mean(epi), label
+
+
+def esm_collate_fn(batch, return_lens=False):
+    """
+    per-sequence means are stacked (batch, embed_size), 
+    per-residue features are padded with zeros (batch, max_len, embed_size), optionally followed by their lengths
+    """
+    labels = torch.hstack([b[2] for b in batch])
+    paras = [b[0] for b in batch]
+    epis = [b[1] for b in batch]
+
+    if paras[0].dim()==1:
+        return [torch.stack(paras), torch.stack(epis), labels]
+
+    new_batch = [nn.utils.rnn.pad_sequence(paras, batch_first=True), 
+                 nn.utils.rnn.pad_sequence(epis, batch_first=True), 
+                 labels]
+    if return_lens==True:
+        new_batch += [torch.LongTensor([len(p) for p in paras]), torch.LongTensor([len(e) for e in epis])]
+
+    return new_batch
+
+
 if __name__=="__main__":
     # SAbDabDataset
     # data = pickle.load(open("../../MSAI_Project/codes/data/data.json", "rb"))
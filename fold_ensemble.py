@@ -0,0 +1,94 @@
+import os
+import numpy as np
+
+import torch
+from torch.func import vmap
+
+from dataset import pad_pairs
+from utils import to_index
+from checkpoint import load_model
+from fold_stack import StackedFolds
+
+
+# scores (paratope, epitope) pairs with all fold checkpoints of a cov_train model at once
+#   ensemble = FoldEnsemble("pesi_ft")
+#   mean, var, folds = ensemble.predict(paras, epis)
+# - models taking token indices (accepts_index) are stacked and vmapped over the folds,
+#   every batch is tokenized once and scored by all folds in one call
+# - other models are run fold by fold on the same padded batch
+# - pairs are batched by length to keep padding low; models without padding masks see the "#" tokens of their
+#   batch as in training, batch_size=1 gives the scores of cov_train's validation
+
+
+class FoldEnsemble(object):
+    def __init__(self, model_name, kfold=10, result_dir=None, best=True, device="cuda"):
+        '''
+        :param model_name:  cov_train model name, e.g. pesi_ft
+        :param kfold:       number of folds
+        :param result_dir:  folder of the checkpoints, default ./results/CoV-AbDab/<model_name>/
+        :param best:        load model_{k}_best.pth, else the last epoch's model_{k}.pth
+        :param device:      device of the models
+        '''
+        self.model_name = model_name
+        self.device = device
+        result_dir = result_dir or "./results/CoV-AbDab/{}/".format(model_name)
+        paths = [os.path.join(result_dir, "model_{}_best.pth".format(k) if best else "model_{}.pth".format(k))
+                 for k in range(kfold)]
+
+        self.models = [load_model(path, device=device).eval() for path in paths]
+        self.kfold = len(self.models)
+
+        self.stacked = None
+        if all(getattr(m, "accepts_index", False) for m in self.models) and self.same_architecture():
+            self.stacked = StackedFolds(self.models)
+            self.stacked.base.eval()
+            # weights batched over folds, the tokens are shared
+            self.forward = vmap(self.stacked.forward, in_dims=(0, 0, None, None))
+
+    def same_architecture(self):
+        ref = self.models[0].state_dict()
+        for m in self.models[1:]:
+            state_dict = m.state_dict()
+            if ref.keys()!=state_dict.keys() or any(ref[k].shape!=state_dict[k].shape for k in ref):
+                return False
+        return True
+
+    @torch.no_grad()
+    def predict_batch(self, paras, epis):
+        '''
+        :param paras:   list of paratope sequences
+        :param epis:    list of epitope sequences
+        :return:        (kfold, batch) binding probabilities on the CPU
+        '''
+        paras, epis = pad_pairs(paras, epis)
+
+        if self.stacked is not None:
+            para = torch.from_numpy(to_index(paras)).long().to(self.device)
+            epi = torch.from_numpy(to_index(epis)).long().to(self.device)
+            pred = self.forward(self.stacked.params, self.stacked.buffers, para, epi)
+        else:
+            pred = torch.stack([m(paras, epis) for m in self.models])
+
+        return pred.view(self.kfold, -1).float().cpu()
+
+    def predict_folds(self, paras, epis, batch_size=64):
+        '''
+        :return:    (kfold, len(paras)) probabilities, in input order
+        '''
+        paras, epis = list(paras), list(epis)
+        # batches of similar length, scores are put back in input order
+        order = np.argsort([max(len(p.strip("#")), len(e.strip("#"))) for p, e in zip(paras, epis)], kind="stable")
+
+        out = torch.empty(self.kfold, len(paras))
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start+batch_size]
+            out[:, torch.from_numpy(idx)] = self.predict_batch([paras[i] for i in idx], [epis[i] for i in idx])
+
+        return out
+
+    def predict(self, paras, epis, batch_size=64):
+        '''
+        :return:    mean (n, ), variance over folds (n, ), per-fold probabilities (kfold, n)
+        '''
+        folds = self.predict_folds(paras, epis, batch_size=batch_size)
+        return folds.mean(dim=0), folds.var(dim=0, unbiased=False), folds
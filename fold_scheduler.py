@@ -0,0 +1,202 @@
+import os
+import time
+import pickle
+import argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+# runs the ntimes x kfold trainings of cov_train in parallel worker processes
+# python fold_scheduler.py pesi ft --workers 6 --threads 2
+# (or cov_train.py with its config "workers" set)
+# - every (run, fold) is one job, seeded with seed + run*kfold + fold, so results do not depend on the scheduling
+# - run i writes its checkpoints and metric files to ./results/CoV-AbDab/<model_name>/run_i/,
+#   its results are dumped to ./results/CoV-AbDab/<model_name>/result_i.pkl as soon as its last fold finishes
+# - the CoV-AbDab csv is parsed once here, its Paratope / Epitope / Class columns go into one shared memory block
+#   as numpy arrays that every worker and fold reads in place (SeqDataset takes them as data_path)
+# - workers get `threads` torch / OpenMP threads each, pinned to their own cores where the OS allows,
+#   and are spread round-robin over the GPUs (the models call .cuda(), several small workers can share one GPU);
+#   without a GPU they train on the CPU, their .cuda() calls leave tensors and modules where they are
+
+# per-process state of a worker, set by init_worker
+_worker = {}
+
+
+def share_columns(path):
+    '''
+    parse the csv and copy the columns SeqDataset uses into one shared memory block
+
+    :return:    shared memory block, {column: (dtype, shape, offset)} of the arrays in it
+    '''
+    import numpy as np
+    import pandas as pd
+
+    data_df = pd.read_csv(path)
+    arrays = {"Paratope": data_df["Paratope"].to_numpy(dtype="S"),
+              "Epitope": data_df["Epitope"].to_numpy(dtype="S"),
+              "Class": data_df["Class"].to_numpy(dtype=np.float32)}
+
+    layout, size = {}, 0
+    for name, array in arrays.items():
+        layout[name] = (array.dtype.str, array.shape, size)
+        size += -(-array.nbytes // 8) * 8           # 8-byte aligned
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, array in arrays.items():
+        dtype, shape, offset = layout[name]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[:] = array
+    return shm, layout
+
+
+def attach_columns(shm, layout):
+    import numpy as np
+
+    return {name: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            for name, (dtype, shape, offset) in layout.items()}
+
+
+def init_worker(shm_name, layout, threads, devices, counter):
+    '''
+    :param shm_name:    shared memory block holding the parsed csv columns
+    :param layout:      {column: (dtype, shape, offset)} of the columns in the block
+    :param threads:     torch / OpenMP threads of this worker
+    :param devices:     cuda device ids shared by the workers, empty to train on the CPU
+    :param counter:     shared mp.Value, gives each worker its index
+    '''
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+
+    # before torch is imported, so that OpenMP / MKL pools are created with the right size
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        mine = cores[index*threads % len(cores):][:threads]
+        if len(mine)==threads:
+            os.sched_setaffinity(0, mine)
+
+    import torch
+    import torch.nn as nn
+
+    torch.set_num_threads(threads)
+    if len(devices)>0:
+        torch.cuda.set_device(devices[index % len(devices)])
+    else:
+        # the models move their inputs with .cuda() in forward, training runs on the CPU
+        torch.Tensor.cuda = lambda self, *args, **kwargs: self
+        nn.Module.cuda = lambda self, *args, **kwargs: self
+
+    # the block stays open for the life of the worker, the arrays are views of it
+    _worker["shm"] = shared_memory.SharedMemory(name=shm_name)
+    _worker["columns"] = attach_columns(_worker["shm"], layout)
+    _worker["index"] = index
+
+
+def run_dir(model_name, run):
+    return "./results/CoV-AbDab/{}/run_{}/".format(model_name, run)
+
+
+def run_fold(config, run, k_iter, seed):
+    '''
+    one job: train fold k_iter of run `run` in this worker
+
+    :return:    run, k_iter, [acc, f1, auc, gmean, mcc] of the best epoch, seconds taken
+    '''
+    from utils import set_seed
+    from cov_train import train_fold, open_store
+    from checkpoint import AsyncCheckpointWriter
+
+    set_seed(seed)
+    start = time.time()
+
+    config = dict(config, data_path=_worker["columns"], run=run)
+    result_dir = run_dir(config["model_name"], run)
+    writer = AsyncCheckpointWriter(max_pending=2, store=open_store(config))
+    _, _, best = train_fold(config, k_iter, writer, result_dir)
+    writer.close()
+
+    return run, k_iter, [best[m] for m in ["acc", "f1", "auc", "gmean", "mcc"]], time.time()-start
+
+
+def schedule(config, workers, threads=1, devices=None, seed=42):
+    '''
+    run config["ntimes"] repeats of config["kfold"]-fold cross validation in parallel
+
+    :param config:      cov_train config, without a model
+    :param workers:     number of worker processes
+    :param threads:     torch threads per worker
+    :param devices:     cuda device ids, None for all visible devices, none visible or [] to train on the CPU
+    :param seed:        base seed of the jobs
+    :return:            [summarize() result of each run]
+    '''
+    import torch
+    from cov_train import set_model_name
+    from metrics import summarize
+
+    config = set_model_name(dict(config))
+    if devices is None:
+        devices = list(range(torch.cuda.device_count()))
+    if len(devices)==0:
+        print("no cuda device, the workers train on the CPU")
+
+    for run in range(config["ntimes"]):
+        os.makedirs(run_dir(config["model_name"], run), exist_ok=True)
+
+    shm, layout = share_columns(config["data_path"])
+    # spawn: cuda cannot be used in forked workers
+    ctx = mp.get_context("spawn")
+    counter = ctx.Value("i", 0)
+
+    fold_metrics = {run: {} for run in range(config["ntimes"])}
+    results = [None] * config["ntimes"]
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_worker,
+                                 initargs=(shm.name, layout, threads, devices, counter)) as executor:
+            futures = [executor.submit(run_fold, config, run, k_iter, seed + run*config["kfold"] + k_iter)
+                       for run in range(config["ntimes"]) for k_iter in range(config["kfold"])]
+
+            for future in as_completed(futures):
+                run, k_iter, metrics, seconds = future.result()
+                fold_metrics[run][k_iter] = metrics
+                print("run {} fold {} done in {:.0f}s\tacc {:.4f}\tauc {:.4f}\tmcc {:.4f}\t({:.0f}s elapsed)".format(
+                    run, k_iter, seconds, metrics[0], metrics[2], metrics[4], time.time()-start))
+
+                if len(fold_metrics[run])==config["kfold"]:
+                    results[run] = summarize(config["model_name"],
+                                             [fold_metrics[run][k] for k in range(config["kfold"])])
+                    path = "./results/CoV-AbDab/{}/result_{}.pkl".format(config["model_name"], run)
+                    print("Results dump to: ")
+                    print(path)
+                    pickle.dump(results[run], open(path, "wb"))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="parallel ntimes x kfold CoV-AbDab training")
+    parser.add_argument("model_name", type=str)
+    parser.add_argument("mode", type=str, help="ft to fine-tune a pre-trained model, anything else to train from scratch")
+    parser.add_argument("--workers", type=int, default=None, help="default cpu count / threads")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker")
+    parser.add_argument("--devices", type=int, nargs="*", default=None, help="cuda device ids, default all, the CPU without any")
+    parser.add_argument("--ntimes", type=int, default=None, help="default from cov_train.default_config")
+    parser.add_argument("--kfold", type=int, default=None, help="default from cov_train.default_config")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    from cov_train import default_config
+
+    config = default_config(args.model_name, use_fine_tune=args.mode=="ft")
+    for k in ["ntimes", "kfold"]:
+        if getattr(args, k) is not None:
+            config[k] = getattr(args, k)
+    workers = args.workers or max(1, os.cpu_count() // args.threads)
+
+    print(config)
+    print("{} workers x {} threads".format(workers, args.threads))
+    schedule(config, workers, threads=args.threads, devices=args.devices, seed=args.seed)
@@ -0,0 +1,265 @@
+import os
+import copy
+from functools import partial
+import numpy as np
+
+import torch
+import torch.optim as optim
+import torch.nn.functional as F
+from torch.func import stack_module_state, functional_call, vmap
+
+from dataset import SeqDataset, collate_fn, length_batches
+from utils import to_index
+from metrics import evaluate_metrics
+from models import build_model
+from telemetry import Telemetry
+
+
+# trains the kfold models of cov_train as one batched computation, cov_train config "stack_folds": True
+# - the parameters of the kfold models are stacked along a leading fold dimension and the forward is vmapped over it
+# - fold k still trains on its own split with its own optimizer state: the summed loss has a block-diagonal
+#   gradient, Adam is elementwise and the gradient norm is clipped per fold
+# - every fold sees exactly the batches of cov_train.train_fold: the folds whose batches at one step have the same
+#   padded length are vmapped together, folds with other lengths in separate calls, never padded further
+# - validation runs fold by fold on the length-grouped batches of cov_train (dataset.length_batches)
+# - only models whose forward takes token indices (accepts_index = True) can be stacked
+
+METRICS = ["acc", "f1", "auc", "gmean", "mcc"]
+
+
+def index_tensor(seqs):
+    return torch.from_numpy(to_index(seqs)).long().cuda()
+
+
+def length_groups(batches):
+    '''
+    :param batches:     one collate_fn batch [paras, epis, labels] per fold
+    :return:            lists of fold indices whose batches have the same padded length
+    '''
+    groups = {}
+    for k, (paras, epis, _) in enumerate(batches):
+        # collate_fn pads paratopes and epitopes of a batch to one length
+        groups.setdefault(len(paras[0]), []).append(k)
+    return list(groups.values())
+
+
+def stack_batches(batches):
+    '''
+    :param batches:     collate_fn batches [paras, epis, labels] of the same padded length, one per fold
+    :return:            para, epi (folds, batch, seq_len) token indices, label (folds, batch)
+    '''
+    para = torch.stack([index_tensor(paras) for paras, _, _ in batches])
+    epi = torch.stack([index_tensor(epis) for _, epis, _ in batches])
+    label = torch.stack([labels.view(-1) for _, _, labels in batches]).cuda()
+    return para, epi, label
+
+
+def clip_grad_norm(params, max_norm):
+    # torch.nn.utils.clip_grad_norm_ of each fold, params are stacked along dim 0
+    grads = [p.grad for p in params if p.grad is not None]
+    norms = torch.stack([g.flatten(1).norm(2, dim=1) for g in grads]).norm(2, dim=0)   # (kfold, )
+    scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+    for g in grads:
+        g.mul_(scale.view(-1, *[1]*(g.dim()-1)))
+
+
+class StackedFolds(object):
+    '''
+    kfold models of one architecture with their parameters and buffers stacked along a leading fold dimension
+    '''
+    def __init__(self, models):
+        self.models = models
+        self.params, self.buffers = stack_module_state(models)
+        # weights live in params / buffers, the base module only provides the forward
+        self.base = copy.deepcopy(models[0]).to("meta")
+
+    def trainable(self):
+        return [p for p in self.params.values() if p.requires_grad]
+
+    def fold(self, k):
+        return {n: p[k] for n, p in self.params.items()}, {n: b[k] for n, b in self.buffers.items()}
+
+    def folds(self, idx):
+        # stacked weights of the folds in idx, differentiable towards the full stack
+        if len(idx)==len(self.models):
+            return self.params, self.buffers
+        idx = torch.tensor(idx, device=next(iter(self.params.values())).device)
+        return {n: p.index_select(0, idx) for n, p in self.params.items()}, \
+               {n: b.index_select(0, idx) for n, b in self.buffers.items()}
+
+    def forward(self, params, buffers, para, epi):
+        return functional_call(self.base, (params, buffers), (para, epi))
+
+    def unstack(self, k):
+        # copy the weights of fold k back into its model, for checkpoints
+        with torch.no_grad():
+            for name, p in self.models[k].named_parameters():
+                p.copy_(self.params[name][k])
+            for name, b in self.models[k].named_buffers():
+                b.copy_(self.buffers[name][k])
+        return self.models[k]
+
+
+def fold_loss(stacked, config, params, buffers, para, epi, label):
+    # loss of one fold, as in cov_train.train_fold
+    pred = stacked.forward(params, buffers, para, epi)
+    loss = F.binary_cross_entropy(pred.view(-1), label.view(-1))
+
+    norm_p = 2 if config["use_reg"]==0 else 1
+    coef = config["l2_coef"] if config["use_reg"]==0 else config["l1_coef"]
+    loss = loss + coef * sum(torch.norm(p, p=norm_p) for name, p in params.items() if 'bias' not in name)
+
+    return loss
+
+
+def train_folds_stacked(config, writer, result_dir):
+    '''
+    train the config["kfold"] folds of config["model_name"] together, writes the same files and results store rows 
+    as cov_train.train_fold
+
+    :param config:      run config
+    :param writer:      checkpoint.AsyncCheckpointWriter for checkpoints and metric files
+    :param result_dir:  folder of the checkpoints and metric files, ending with "/"
+    '''
+    from cov_train import store_key
+
+    kfold = config["kfold"]
+    if config["use_BSS"]==True:
+        print("use_BSS is not supported with stack_folds")
+        exit()
+    if config["use_reg"] not in [0, 1]:
+        print("wrong use_reg! only 0 or 1!")
+        exit()
+
+    models = []
+    for k_iter in range(kfold):
+        config = build_model(config, stage="cov")
+        models.append(config["model"])
+    if not getattr(models[0], "accepts_index", False):
+        print("{} cannot be stacked: its forward only takes sequences".format(config["model_name"]))
+        exit()
+    stacked = StackedFolds(models)
+
+    train_loaders = []
+    test_loaders = []
+    test_batches = []
+    for k_iter in range(kfold):
+        train_dataset, test_dataset = [SeqDataset(data_path=config["data_path"],
+                                                  kfold=kfold,
+                                                  holdout_fold=k_iter,
+                                                  is_train_test_full=split,
+                                                  use_pair=config["use_pair"],
+                                                  balance_samples=False) for split in ["train", "test"]]
+        train_loaders.append(torch.utils.data.DataLoader(train_dataset,
+                                                         batch_size=config["batch_size"],
+                                                         shuffle=False,
+                                                         collate_fn=partial(collate_fn, use_augment=config["use_aug"])))
+        # validation batches as in cov_train.train_fold, the stacked models see the "#" padding of their batch
+        max_shared_len = getattr(models[0], "fixed_length", None) or 0
+        test_batches.append(length_batches(test_dataset,
+                                           batch_size=config.get("val_batch_size", 256),
+                                           max_shared_len=max_shared_len))
+        test_loaders.append(torch.utils.data.DataLoader(test_dataset,
+                                                        batch_sampler=test_batches[-1],
+                                                        collate_fn=partial(collate_fn, use_augment=False)))
+
+    print("model_name: {}, {} folds stacked".format(config["model_name"], kfold))
+    print("model parameters: ", sum(p.numel() for p in models[0].parameters() if p.requires_grad))
+
+    optimizer = optim.Adam(stacked.trainable(), lr=config["lr"])
+    # dropout masks differ between folds
+    step = vmap(partial(fold_loss, stacked, config), randomness="different")
+
+    bufs = [{m: [] for m in ["loss", "val_loss"] + METRICS} for _ in range(kfold)]
+    best_val_loss = [float("inf")] * kfold
+    for k_iter in range(kfold):
+        if os.path.exists(result_dir+"history_{}.jsonl".format(k_iter)):
+            os.remove(result_dir+"history_{}.jsonl".format(k_iter))
+    # one record for all folds, the per-fold metrics are in the history files
+    telemetry = Telemetry(result_dir+"telemetry_stacked.jsonl", 
+                          every=config.get("telemetry_every", 50), 
+                          interval=config.get("log_interval", 30), 
+                          epochs=config["epochs"], 
+                          tag="{} {} folds".format(config["model_name"], kfold))
+
+    for epoch in range(config["epochs"]):
+
+        stacked.base.train()
+
+        loss_tmp = []
+        # folds have the same number of train samples, so the loaders run in lockstep
+        for batches in telemetry.iterate(zip(*train_loaders)):
+            optimizer.zero_grad()
+
+            loss = torch.empty(kfold, device="cuda")
+            for idx in length_groups(batches):
+                params, buffers = stacked.folds(idx)
+                para, epi, label = stack_batches([batches[k] for k in idx])
+                group_loss = step(params, buffers, para, epi, label)     # (len(idx), )
+                group_loss.sum().backward()
+                loss[torch.tensor(idx, device="cuda")] = group_loss.detach()
+
+            clip_grad_norm(stacked.trainable(), config["clip_norm"])
+
+            optimizer.step()
+
+            loss_tmp.append(loss.detach().cpu().numpy())
+            telemetry.update(loss=float(loss_tmp[-1].mean()))
+
+        loss_tmp = np.mean(loss_tmp, axis=0)
+
+        with torch.no_grad():
+
+            stacked.base.eval()
+
+            records = []
+            for k_iter in range(kfold):
+                params, buffers = stacked.fold(k_iter)
+
+                # predictions in test set order, as cov_train writes them
+                num_test = len(test_loaders[k_iter].dataset)
+                preds = torch.empty(num_test)
+                labels = torch.empty(num_test)
+                val_loss_sum = 0.0
+                for idx, (para, epi, label) in zip(test_batches[k_iter],
+                                                   telemetry.iterate(test_loaders[k_iter], phase="val_{}".format(k_iter))):
+                    pred = stacked.forward(params, buffers, index_tensor(para), index_tensor(epi)).view(-1)
+                    val_loss_sum += F.binary_cross_entropy(pred, label.view(-1).cuda(), reduction="sum").item()
+
+                    preds[torch.tensor(idx)] = pred.cpu()
+                    labels[torch.tensor(idx)] = label.view(-1)
+
+                acc, f1, auc, gmean, mcc = evaluate_metrics(pred_proba=preds, label=labels)
+
+                record = {"epoch": epoch, "loss": float(loss_tmp[k_iter]), "val_loss": val_loss_sum / num_test,
+                          "acc": float(acc), "f1": float(f1), "auc": float(auc), "gmean": float(gmean), "mcc": float(mcc)}
+                for m in bufs[k_iter]:
+                    bufs[k_iter][m].append(record[m])
+                records.append(record)
+
+                is_best = record["val_loss"]<best_val_loss[k_iter]
+                if is_best:
+                    best_val_loss[k_iter] = record["val_loss"]
+                best_arrays = {result_dir+"val_pred_{}_best.npy".format(k_iter): preds.numpy(),
+                               result_dir+"val_label_{}_best.npy".format(k_iter): labels.numpy()}
+                if writer.store is None:
+                    best_arrays.update({result_dir+"val_{}_{}_best.npy".format(m, k_iter): record[m] for m in METRICS})
+                writer.epoch(result_dir+"history_{}.jsonl".format(k_iter), record,
+                             model=stacked.unstack(k_iter) if is_best else None,
+                             ckpt_path=result_dir+"model_{}_best.pth".format(k_iter),
+                             best_arrays=best_arrays,
+                             key=store_key(config, k_iter))
+
+            telemetry.end_epoch(dict({"epoch": epoch}, 
+                                     **{m: float(np.mean([r[m] for r in records])) for m in bufs[0]}))
+
+    telemetry.close()
+
+    for k_iter in range(kfold):
+        writer.save(stacked.unstack(k_iter), result_dir+"model_{}.pth".format(k_iter))
+        if writer.store is None:
+            writer.arrays({result_dir+"loss_buf_{}.npy".format(k_iter): np.array(bufs[k_iter]["loss"]),
+                           result_dir+"val_loss_buf_{}.npy".format(k_iter): np.array(bufs[k_iter]["val_loss"])})
+            writer.arrays({result_dir+"val_{}_buf_{}.npy".format(m, k_iter): np.array(bufs[k_iter][m]) for m in METRICS})
+
+    return config
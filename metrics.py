@@ -1,63 +1,121 @@
 import numpy as np
-import matplotlib.pyplot as plt
+import torch
 
-from sklearn import metrics as metricser
-from imblearn.metrics import geometric_mean_score
+
+class StreamingMetrics(object):
+    '''
+    acc / F1 / AUC / G-mean / MCC of binary predictions, accumulated batch by batch on the device of the predictions
+    nothing is copied to the host until compute(), which syncs once
+    - acc, F1, G-mean: predicted positive if p > 0.5 (np.around rounds 0.5 down)
+    - MCC: predicted positive if p >= 0.5, as mcc_score always did
+    - AUC: Mann-Whitney statistic with tied scores counted half, equal to sklearn's roc_auc_score
+    '''
+    def __init__(self):
+        self.counts = None      # tp, fp, fn, tn at > 0.5, then at >= 0.5
+        self.scores = []
+        self.labels = []
+
+    def update(self, pred, label):
+        '''
+        :param pred:    predicted probabilities, any shape
+        :param label:   0 / 1 labels, same number of elements
+        '''
+        pred = pred.detach().reshape(-1)
+        label = label.detach().reshape(-1).to(pred.device)==1
+
+        counts = []
+        for pos in [pred > 0.5, pred >= 0.5]:
+            counts += [(pos & label).sum(), (pos & ~label).sum(), (~pos & label).sum(), (~pos & ~label).sum()]
+        counts = torch.stack(counts)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+        self.scores.append(pred)
+        self.labels.append(label)
+
+    def auc(self):
+        scores = torch.cat(self.scores).double()
+        labels = torch.cat(self.labels)
+        num_pos = labels.sum()
+        num_neg = labels.numel() - num_pos
+
+        # average 1-based rank of each distinct score, ties share the mean of their ranks
+        _, inverse, counts = torch.unique(scores, sorted=True, return_inverse=True, return_counts=True)
+        ends = torch.cumsum(counts, dim=0).double()
+        ranks = (ends - (counts.double() - 1) / 2)[inverse]
+
+        return (ranks[labels].sum() - num_pos * (num_pos + 1) / 2) / (num_pos * num_neg), num_pos, num_neg
+
+    def compute(self):
+        '''
+        :return:    acc, f1, auc, gmean, mcc as floats
+        '''
+        auc, num_pos, num_neg = self.auc()
+        tp, fp, fn, tn, tp2, fp2, fn2, tn2 = self.counts.double()
+
+        values = torch.stack([auc, num_pos.double(), num_neg.double(), 
+                              tp, fp, fn, tn, tp2, fp2, fn2, tn2]).tolist()
+        auc, num_pos, num_neg, tp, fp, fn, tn, tp2, fp2, fn2, tn2 = values
+
+        if num_pos==0 or num_neg==0:
+            raise ValueError("Only one class present in y_true. ROC AUC score is not defined in that case.")
+
+        acc = (tp + tn) / (tp + fp + fn + tn)
+        f1 = 2*tp / (2*tp + fp + fn) if tp + fp + fn > 0 else 0.0
+        gmean = np.sqrt(tp / (tp + fn) * tn / (tn + fp))
+        mcc = matthews(tp2, fp2, fn2, tn2)
+
+        return acc, f1, auc, gmean, mcc
+
+
+def matthews(tp, fp, fn, tn):
+    # 0 if a row or column of the confusion matrix is empty, as sklearn's matthews_corrcoef
+    denom = np.sqrt((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn))
+    return (tp * tn - fp * fn) / denom if denom > 0 else 0.0
 
 
 def evaluate_metrics(pred_proba, label):
     '''
-    :param pred:
-    :param label:
-    :return:
+    :param pred_proba:  predicted probabilities, tensor (on any device) or array
+    :param label:       0 / 1 labels
+    :return:            acc, f1, auc, gmean, mcc
     '''
-    predicts = np.around(pred_proba)
-
-    acc = metricser.accuracy_score(y_true=label, y_pred=predicts)
-    f1 = metricser.f1_score(y_true=label, y_pred=predicts)
-    auc = metricser.roc_auc_score(y_true=label, y_score=pred_proba)
-    gmean = geometric_mean_score(y_true=label, y_pred=predicts)
-    mcc = mcc_score(pred_proba, label)
+    metrics = StreamingMetrics()
+    metrics.update(torch.as_tensor(pred_proba), torch.as_tensor(label))
 
-    return acc, f1, auc, gmean, mcc
+    return metrics.compute()
 
 
 def mcc_score(pred_proba, label):
-    trans_pred = np.ones(pred_proba.shape)
-    trans_label = np.ones(label.shape)
-    trans_pred[pred_proba < 0.5] = -1
-    trans_label[label != 1] = -1
-    mcc = metricser.matthews_corrcoef(trans_label, trans_pred)
-    return mcc
+    metrics = StreamingMetrics()
+    metrics.update(torch.as_tensor(pred_proba), torch.as_tensor(label))
+
+    return matthews(*metrics.counts[4:].double().tolist())
 
 
 def evaluate(model_name, kfold):
-    
+
+    fold_metrics = []
+    for i in range(kfold):
+        fold_metrics.append([np.load("./results/CoV-AbDab/{}/val_{}_{}_best.npy".format(model_name, m, i)) 
+                             for m in ["acc", "f1", "auc", "gmean", "mcc"]])
+
+    return summarize(model_name, fold_metrics)
+
+
+def summarize(model_name, fold_metrics):
+    '''
+    :param model_name:      name printed with the results
+    :param fold_metrics:    [acc, f1, auc, gmean, mcc] of the best epoch of each fold, in fold order
+    :return:                model_name and the per-fold lists of acc, f1, auc, gmean, mcc
+    '''
     print("Performance of {}".format(model_name))
 
-    val_acc_mean = []
-    val_f1_mean = []
-    val_auc_mean = []
-    val_gmean_mean = []
-    val_mcc_mean = []
+    val_acc_mean = [m[0] for m in fold_metrics]
+    val_f1_mean = [m[1] for m in fold_metrics]
+    val_auc_mean = [m[2] for m in fold_metrics]
+    val_gmean_mean = [m[3] for m in fold_metrics]
+    val_mcc_mean = [m[4] for m in fold_metrics]
 
-    for i in range(kfold):
-        
-        val_acc_i = np.load("./results/CoV-AbDab/{}/val_acc_{}_best.npy".format(model_name, i))
-        val_acc_mean.append(val_acc_i)
-        
-        val_f1_i = np.load("./results/CoV-AbDab/{}/val_f1_{}_best.npy".format(model_name, i))
-        val_f1_mean.append(val_f1_i)
-        
-        val_auc_i = np.load("./results/CoV-AbDab/{}/val_auc_{}_best.npy".format(model_name, i))
-        val_auc_mean.append(val_auc_i)
-        
-        val_gmean_i = np.load("./results/CoV-AbDab/{}/val_gmean_{}_best.npy".format(model_name, i))
-        val_gmean_mean.append(val_gmean_i)
-        
-        val_mcc_i = np.load("./results/CoV-AbDab/{}/val_mcc_{}_best.npy".format(model_name, i))
-        val_mcc_mean.append(val_mcc_i)
-        
     print("model: {}".format(model_name))
     print("val acc mean: ", np.mean(val_acc_mean))
     print("val f1 mean: ", np.mean(val_f1_mean))
@@ -65,4 +123,4 @@ def evaluate(model_name, kfold):
     print("val gmean mean: ", np.mean(val_gmean_mean))
     print("val mcc mean: ", np.mean(val_mcc_mean))
 
-    return model_name, val_acc_mean, val_f1_mean, val_auc_mean, val_gmean_mean, val_mcc_mean
\ No newline at end of file
+    return model_name, val_acc_mean, val_f1_mean, val_auc_mean, val_gmean_mean, val_mcc_mean
@@ -1,50 +1,99 @@
 # https://github.com/enai4bio/DeepAAI/blob/main/models/ag_fast_parapred_cls.py
 from torch.nn.utils import weight_norm
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
 
-from dataset import *
-from utils import *
-from .common import *
+from utils import seq_lens, seq_pad_clip, to_index
 
 
 class AttentionLayer(nn.Module):
-    def __init__(self, antibody_ft_dim, virus_ft_dim, heads=1, dropout=0.15):
+    def __init__(self, antibody_ft_dim, virus_ft_dim, heads=1, dropout=0.15, chunk_size=None):
+        '''
+        :param heads:       number of attention heads, computed together in one batched pass
+        :param chunk_size:  None for full score matrices, otherwise number of virus positions per step 
+                            of a streaming (online) softmax, bounding memory at batch*heads*antibody_len*chunk_size
+        '''
         super(AttentionLayer, self).__init__()
         self.heads = heads
         self.dropout = dropout
+        self.chunk_size = chunk_size
         self.antibody_ft_dim = antibody_ft_dim
         self.virus_ft_dim = virus_ft_dim
 
+        # one 1x1 conv per head, kept as separate modules so that saved weights still load
         self.antibody_trans_list = nn.ModuleList()
         self.virus_trans_list = nn.ModuleList()
         for idx in range(self.heads):
             self.antibody_trans_list.append(nn.Conv1d(self.antibody_ft_dim, 1, 1))
             self.virus_trans_list.append(nn.Conv1d(self.virus_ft_dim, 1, 1))
 
+    def project(self, ft_mat, trans_list):
+        # stack per-head projections into one conv    batch, heads, len
+        weight = torch.cat([conv.weight for conv in trans_list], dim=0)
+        bias = torch.cat([conv.bias for conv in trans_list], dim=0)
+        return F.conv1d(ft_mat, weight, bias)
+
     def forward(self, antibody_ft_mat, virus_ft_mat, bias_mat):
-        res_mat = []
-        for idx in range(self.heads):
-            w_antibody = self.antibody_trans_list[idx](antibody_ft_mat)
-            w_virus = self.virus_trans_list[idx](virus_ft_mat)
-            w = F.leaky_relu(w_virus + torch.transpose(w_antibody, 1, 2), negative_slope=0.2)  # batch, virus_len, antibody_len
+        '''
+        :param antibody_ft_mat:     batch, antibody_ft_dim, antibody_len
+        :param virus_ft_mat:        batch, virus_ft_dim, virus_len
+        :param bias_mat:            batch, antibody_len, virus_len
+        :return:                    batch, antibody_len, heads * virus_ft_dim
+        '''
+        w_antibody = self.project(antibody_ft_mat, self.antibody_trans_list)    # batch, heads, antibody_len
+        w_virus = self.project(virus_ft_mat, self.virus_trans_list)             # batch, heads, virus_len
+        virus_ft = torch.transpose(virus_ft_mat, 1, 2).unsqueeze(1)             # batch, 1, virus_len, virus_ft_dim
+        bias_mat = bias_mat.unsqueeze(1)
+
+        chunk_size = getattr(self, "chunk_size", None)
+        if chunk_size is None or chunk_size >= w_virus.size(-1):
+            # batch, heads, antibody_len, virus_len
+            w = F.leaky_relu(w_virus.unsqueeze(2) + w_antibody.unsqueeze(3), negative_slope=0.2)
             w = F.softmax(w + bias_mat, dim=-1)
             w = F.dropout(w, p=self.dropout, training=self.training)
+            trans_ft = torch.matmul(w, virus_ft)
+        else:
+            trans_ft = self.chunked_attention(w_antibody, w_virus, virus_ft, bias_mat, chunk_size)
+
+        # batch, antibody_len, heads * virus_ft_dim    (heads in the same order as concatenating them)
+        batch_size, heads, antibody_len, ft_dim = trans_ft.size()
+        return trans_ft.permute(0, 2, 1, 3).reshape(batch_size, antibody_len, heads * ft_dim)
+
+    def chunked_attention(self, w_antibody, w_virus, virus_ft, bias_mat, chunk_size):
+        # online softmax over virus positions: running max, running normaliser and running weighted sum
+        batch_size, heads, antibody_len = w_antibody.size()
+        run_max = w_antibody.new_full((batch_size, heads, antibody_len, 1), float("-inf"))
+        run_sum = w_antibody.new_zeros((batch_size, heads, antibody_len, 1))
+        acc = w_antibody.new_zeros((batch_size, heads, antibody_len, virus_ft.size(-1)))
+
+        for start in range(0, w_virus.size(-1), chunk_size):
+            end = start + chunk_size
+            w = F.leaky_relu(w_virus[:, :, start:end].unsqueeze(2) + w_antibody.unsqueeze(3), negative_slope=0.2)
+            w = w + bias_mat[..., start:end]
+
+            new_max = torch.maximum(run_max, w.max(dim=-1, keepdim=True)[0])
+            scale = torch.exp(run_max - new_max)
+            w = torch.exp(w - new_max)
+            run_sum = run_sum * scale + w.sum(dim=-1, keepdim=True)
+            # dropping unnormalised weights and dividing by the full sum matches dropout after softmax
+            w = F.dropout(w, p=self.dropout, training=self.training)
+            acc = acc * scale + torch.matmul(w, virus_ft[:, :, start:end])
+            run_max = new_max
 
-            trans_ft = torch.bmm(w, torch.transpose(virus_ft_mat, 1, 2))
-            res_mat.append(trans_ft)
-        res_mat = torch.cat(res_mat, dim=2)
-        return res_mat
+        return acc / run_sum
 
 
 
 class AgFastParapred(nn.Module):
+    accepts_lens = True         # forward takes per-sample lengths from collate_fn(return_lens=True)
+
     def __init__(self, ft_dim, max_antibody_len, max_virus_len,
                  h_dim=256,
-                 position_coding=True
+                 position_coding=True,
+                 attn_heads=1,
+                 attn_chunk_size=None
                  ):
         super(AgFastParapred, self).__init__()
         self.ft_dim = ft_dim
@@ -68,7 +117,7 @@ class AgFastParapred(nn.Module):
         self.antibody_bn2 = nn.BatchNorm1d(128)
         self.antibody_bn3 = nn.BatchNorm1d(256)
 
-        self.bn4 = nn.BatchNorm1d(512)  # after cat (raw, att)
+        self.bn4 = nn.BatchNorm1d(256 * (1 + attn_heads))  # after cat (raw, att)
 
         self.virus_bn1 = nn.BatchNorm1d(64)  # batch normalisation after the first convolutional layer for antigen
         self.virus_bn2 = nn.BatchNorm1d(128)
@@ -77,8 +126,9 @@ class AgFastParapred(nn.Module):
         self.dropout1 = nn.Dropout(0.15)
         self.dropout2 = nn.Dropout(0.5)
 
-        self.attention_layer = AttentionLayer(antibody_ft_dim=256, virus_ft_dim=256, heads=1, dropout=0.15)
-        self.final_linear1 = nn.Linear(512, self.h_dim)
+        self.attention_layer = AttentionLayer(antibody_ft_dim=256, virus_ft_dim=256, heads=attn_heads, dropout=0.15, 
+                                              chunk_size=attn_chunk_size)
+        self.final_linear1 = nn.Linear(256 * (1 + attn_heads), self.h_dim)
         self.final_linear2 = nn.Linear(self.h_dim, 1)
 
         self.activation = nn.ELU()
@@ -93,37 +143,51 @@ class AgFastParapred(nn.Module):
             torch.nn.init.xavier_uniform_(m.weight.data)
             m.bias.data.fill_(0.0)
 
-    def forward(self, batch_antibody_ft, batch_virus_ft):
+    @property
+    def fixed_length(self):
+        # forward pads / clips the sequences to max_antibody_len / max_virus_len with seq_pad_clip
+        return min(self.max_antibody_len, self.max_virus_len)
+
+    def forward(self, batch_antibody_ft, batch_virus_ft, batch_antibody_len=None, batch_virus_len=None):
         '''
-        :param batch_antibody_ft:   tensor    batch, max_antibody_len, amino_ft_dim
-        :param batch_virus_ft:     tensor    batch, max_virus_len, amino_ft_dim
-        :param batch_antibody_len:   np array      batch
-        :param batch_virus_len:     np array      batch
+        :param batch_antibody_ft:   list      batch, antibody sequences
+        :param batch_virus_ft:     list      batch, virus sequences
+        :param batch_antibody_len:   tensor      batch, residues before padding (from collate_fn with return_lens), 
+                                                computed from the sequences if None
+        :param batch_virus_len:     tensor      batch
         :return:
         '''
 
         batch_antibody_ft = [seq_pad_clip(i, target_length=self.max_antibody_len) for i in batch_antibody_ft]
         batch_virus_ft = [seq_pad_clip(i, target_length=self.max_virus_len) for i in batch_virus_ft]
 
-        batch_antibody_ft = torch.Tensor([to_onehot(i, mode=1) for i in batch_antibody_ft]).float().cuda()
-        batch_virus_ft = torch.Tensor([to_onehot(i, mode=1) for i in batch_virus_ft]).float().cuda()
+        if batch_antibody_len is None:
+            batch_antibody_len = torch.from_numpy(seq_lens(batch_antibody_ft))
+        if batch_virus_len is None:
+            batch_virus_len = torch.from_numpy(seq_lens(batch_virus_ft))
+        batch_antibody_len = batch_antibody_len.clamp(1, self.max_antibody_len)
+        batch_virus_len = batch_virus_len.clamp(1, self.max_virus_len)
+
+        # padding beyond the longest sequence in the batch is fully masked, drop it
+        antibody_len = int(batch_antibody_len.max())
+        virus_len = int(batch_virus_len.max())
+        batch_antibody_ft = torch.from_numpy(to_index(batch_antibody_ft)[:, :antibody_len]).cuda()
+        batch_virus_ft = torch.from_numpy(to_index(batch_virus_ft)[:, :virus_len]).cuda()
+        batch_antibody_ft = F.one_hot(batch_antibody_ft, num_classes=self.ft_dim).float()
+        batch_virus_ft = F.one_hot(batch_virus_ft, num_classes=self.ft_dim).float()
 
         assert batch_antibody_ft.size()[0] == batch_virus_ft.size()[0]
-        batch_size = batch_antibody_ft.size()[0]
 
-        batch_antibody_len = torch.tensor([self.max_antibody_len] * batch_size)
-        batch_virus_len = torch.tensor([self.max_antibody_len] * batch_size)
+        batch_antibody_len = batch_antibody_len.to(batch_antibody_ft.device)
+        batch_virus_len = batch_virus_len.to(batch_virus_ft.device)
 
         # virus_ft_mat shape ->  batch, amino_ft_dim, amino_max_len
         virus_ft_mat = batch_virus_ft.transpose(1, 2)
         antibody_ft_mat = batch_antibody_ft.transpose(1, 2)
 
-        # generate mask mat
-        antibody_mask_mat = torch.zeros(batch_size, 1, self.max_antibody_len).to(batch_antibody_ft.device)
-        virus_mask_mat = torch.zeros(batch_size, 1, self.max_virus_len).to(batch_virus_ft.device)
-        for idx in range(batch_size):
-            antibody_mask_mat[idx, :batch_antibody_len[idx]] = 1
-            virus_mask_mat[idx, :batch_virus_len[idx]] = 1
+        # generate mask mat    batch, 1, len
+        antibody_mask_mat = self.generate_mask_mat(batch_antibody_len, antibody_len)
+        virus_mask_mat = self.generate_mask_mat(batch_virus_len, virus_len)
 
         # antibody ft extraction
         antibody_ft_mat = torch.mul(antibody_ft_mat, antibody_mask_mat)
@@ -175,9 +239,8 @@ class AgFastParapred(nn.Module):
 
         # multi heads attention    344 * 912
         # update antibody ft
-        # head = 1
         # bias_mat:  344 * 912  0:save   -1e9:
-        bias_mat = self.generate_bias_mat(batch_antibody_len, batch_virus_len, device=batch_virus_ft.device)
+        bias_mat = self.generate_bias_mat(antibody_mask_mat, virus_mask_mat)
         trans_ft = self.attention_layer(antibody_ft_mat, virus_ft_mat, bias_mat)
 
         trans_ft = trans_ft.transpose(1, 2)
@@ -186,7 +249,8 @@ class AgFastParapred(nn.Module):
 
         antibody_ft_mat = self.bn4(antibody_ft_mat)
         antibody_ft_mat = self.activation(antibody_ft_mat)
-        antibody_ft_mat = torch.mul(antibody_ft_mat, antibody_mask_mat)
+        # max over real residues only
+        antibody_ft_mat = antibody_ft_mat.masked_fill(antibody_mask_mat==0, float("-inf"))
         antibody_ft_mat, _ = torch.max(antibody_ft_mat, dim=-1)
 
         pair_ft = self.final_linear1(antibody_ft_mat)
@@ -194,15 +258,11 @@ class AgFastParapred(nn.Module):
         pred = self.final_linear2(pair_ft)
         return torch.sigmoid(pred)
 
-    def generate_bias_mat(self, batch_antibody_len, batch_virus_len, device='cpu'):
-        batch_size = batch_antibody_len.shape[0]
-        bias_mat = []
-        for idx in range(batch_size):
-            antibody_len = batch_antibody_len[idx]
-            virus_len = batch_virus_len[idx]
-            mat = torch.zeros(1, self.max_antibody_len, self.max_virus_len).to(device)
-            mat[:, antibody_len:, :] = -1e9
-            mat[:, :, virus_len:] = -1e9
-            bias_mat.append(mat)
-        bias_mat = torch.cat(bias_mat, dim=0)
-        return bias_mat
\ No newline at end of file
+    def generate_mask_mat(self, batch_len, max_len):
+        # batch, 1, max_len    1: residue   0: padding
+        positions = torch.arange(max_len, device=batch_len.device)
+        return (positions.view(1, 1, -1) < batch_len.view(-1, 1, 1)).float()
+
+    def generate_bias_mat(self, antibody_mask_mat, virus_mask_mat):
+        # batch, antibody_len, virus_len    0: save   -1e9: padding row or column
+        return (torch.transpose(antibody_mask_mat, 1, 2) * virus_mask_mat - 1) * 1e9
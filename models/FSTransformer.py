@@ -6,9 +6,8 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
-from dataset import *
-from utils import *
-from .common import *
+from utils import vocab, to_onehot
+from .common import PositionalEncoding, CoAttention
 
 
 def frame_slice(x, frame_size=6):
@@ -6,9 +6,8 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
-from dataset import *
-from utils import *
-from .common import *
+from utils import vocab, to_onehot
+from .common import PositionalEncoding, CoAttention
 
 
 class IntTransEncoder(nn.Module):
@@ -322,6 +321,8 @@ class InteractCoattn_noTransformer(nn.Module):
 
 
 if __name__ == "__main__":
+    from dataset import SeqDataset
+
     k_iter = 0
 
     train_dataset = SeqDataset(data_path="../data/SARS-SAbDab_Shaun/CoV-AbDab_extract.csv", seq_length=128, \
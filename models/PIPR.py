@@ -2,12 +2,16 @@
 import torch.nn.functional as F
 import torch.nn as nn
 import torch
-from .common import *
+from utils import to_onehot, seq_pad_clip
+from .common import fused_towers
 
 class PIPR(nn.Module):
-    def __init__(self, protein_ft_one_hot_dim):
+    fixed_length = 100          # forward pads / clips both sequences to this length with seq_pad_clip
+
+    def __init__(self, protein_ft_one_hot_dim, fuse_towers=True):
         super(PIPR, self).__init__()
         self.protein_ft_dim = protein_ft_one_hot_dim
+        self.fuse_towers = fuse_towers      # antibody and virus share weights, run them as one batch
         self.hidden_num = 50
         self.kernel_size = 3
         self.pool_size = 3
@@ -54,6 +58,27 @@ class PIPR(nn.Module):
         output = torch.cat([ft_mat, output], dim=-1)
         return output
 
+    def encode(self, protein_ft):
+        '''
+        shared tower for antibody and virus
+        :param protein_ft:  (batch, steps, features)
+        :return:            (batch, features)
+        '''
+        for idx in range(self.conv_layer_num - 1):
+            protein_ft = self.block_cnn_rnn(
+                cnn_layer=self.conv1d_layer_list[idx],
+                rnn_layer=self.gru_list[idx],
+                ft_mat=protein_ft,
+                kernel_wide=self.pool_size
+            )
+        protein_ft = self.conv1d_layer_list[-1](
+            protein_ft.transpose(1, 2))  # (batch, features, steps)
+
+        protein_ft = F.max_pool2d(
+            protein_ft, kernel_size=(1, protein_ft.size()[-1])).squeeze(-1)  # (batch, features)
+
+        return protein_ft
+
     def forward(self, antibody_ft, virus_ft):
 
         antibody_ft = [seq_pad_clip(i, target_length=100) for i in antibody_ft]
@@ -66,30 +91,11 @@ class PIPR(nn.Module):
             gru_layer.flatten_parameters()
         # batch  * seq_len * feature
         # print('1 antibody_ft = ', antibody_ft[:, :, 1])
-        for idx in range(self.conv_layer_num - 1):
-            antibody_ft = self.block_cnn_rnn(
-                cnn_layer=self.conv1d_layer_list[idx],
-                rnn_layer=self.gru_list[idx],
-                ft_mat=antibody_ft,
-                kernel_wide=self.pool_size
-            )
-        antibody_ft = self.conv1d_layer_list[-1](
-            antibody_ft.transpose(1, 2))  # (batch, features, steps)
-
-        antibody_ft = F.max_pool2d(
-            antibody_ft, kernel_size=(1, antibody_ft.size()[-1])).squeeze()  # (batch, features)
-
-        for idx in range(self.conv_layer_num - 1):
-            virus_ft = self.block_cnn_rnn(
-                cnn_layer=self.conv1d_layer_list[idx],
-                rnn_layer=self.gru_list[idx],
-                ft_mat=virus_ft,
-                kernel_wide=self.pool_size
-            )
-        virus_ft = self.conv1d_layer_list[-1](
-            virus_ft.transpose(1, 2))  # (batch, features, steps)
-        virus_ft = F.max_pool2d(
-            virus_ft, kernel_size=(1, virus_ft.size()[-1])).squeeze()  # (batch, features)
+        if getattr(self, "fuse_towers", False):
+            antibody_ft, virus_ft = fused_towers(self.encode, antibody_ft, virus_ft)
+        else:
+            antibody_ft = self.encode(antibody_ft)
+            virus_ft = self.encode(virus_ft)
 
         pair_ft = antibody_ft + virus_ft
         pred = self.linear_pred(pair_ft)
@@ -2,7 +2,8 @@
 import torch.nn.functional as F
 import torch.nn as nn
 import torch
-from .common import *
+from utils import to_onehot, seq_pad_clip
+from .common import fused_towers
 
 
 class BasicBlock2D(nn.Module):
@@ -35,15 +36,21 @@ class BasicBlock2D(nn.Module):
 
 
 class ResPPI(nn.Module):
+    fixed_length = 100          # forward pads / clips both sequences to this length with seq_pad_clip
+
     def __init__(self,
                  amino_ft_dim,
                  max_antibody_len,
                  max_virus_len,
                  h_dim=512,
                  dropout=0.3,
+                 fuse_towers=False,
                  ):
         super(ResPPI, self).__init__()
         self.h_dim = h_dim
+        # one res_net pass over virus and antibody stacked; always used in eval mode, 
+        # in training it makes BatchNorm statistics shared by both towers so it is opt-in
+        self.fuse_towers = fuse_towers
         self.amino_ft_dim = amino_ft_dim
         self.max_antibody_len = max_antibody_len
         self.max_virus_len = max_virus_len
@@ -82,8 +89,11 @@ class ResPPI(nn.Module):
         batch_size = batch_antibody_onehot_ft.size()[0]
         batch_virus_onehot_ft = batch_virus_onehot_ft.unsqueeze(1)
         batch_antibody_onehot_ft = batch_antibody_onehot_ft.unsqueeze(1)
-        virus_ft = self.res_net(batch_virus_onehot_ft)
-        antibody_ft = self.res_net(batch_antibody_onehot_ft)
+        if getattr(self, "fuse_towers", False) or not self.training:
+            virus_ft, antibody_ft = fused_towers(self.res_net, batch_virus_onehot_ft, batch_antibody_onehot_ft)
+        else:
+            virus_ft = self.res_net(batch_virus_onehot_ft)
+            antibody_ft = self.res_net(batch_antibody_onehot_ft)
 
         virus_ft = F.max_pool2d(virus_ft, kernel_size=[self.max_virus_len, 1]).view(batch_size, -1)
         antibody_ft = F.max_pool2d(antibody_ft, kernel_size=[self.max_antibody_len, 1]).view(batch_size, -1)
@@ -3,9 +3,8 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 
-from dataset import *
-from utils import *
-from .common import *
+from utils import to_index, seq_pad_clip
+from .common import gather_conv1d
 
 
 class TextInception(nn.Module):
@@ -17,18 +16,48 @@ class TextInception(nn.Module):
         self.conv2 = nn.Conv2d(in_channel, 1, kernel_size=(7, kernel_width), padding=(3, kernel_width//2))
         self.conv3 = nn.Conv2d(in_channel, 1, kernel_size=(9, kernel_width), padding=(4, kernel_width//2))
 
+    def index_conv(self, conv, protein_idx):
+        '''
+        conv over the (amino_dim, len) one-hot map without building it: 
+        kernel column j answers token v with the band of its weights that overlaps row v
+        :param conv: nn.Conv2d with in_channel 1
+        :param protein_idx: batch*len token indices
+        :return: batch*1*amino_dim*len, same as conv(one-hot map)
+        '''
+        kernel_h, kernel_w = conv.kernel_size
+        padding_h, padding_w = conv.padding
+        amino_dim = self.kernel_width
+        out_h = amino_dim + 2*padding_h - kernel_h + 1
+
+        # table[j, v, r] = weight[v - r + padding_h, j]
+        offset = torch.arange(amino_dim, device=protein_idx.device).view(-1, 1) - \
+                 torch.arange(out_h, device=protein_idx.device).view(1, -1) + padding_h
+        valid = (offset >= 0) & (offset < kernel_h)
+        table = conv.weight[0, 0][offset.clamp(0, kernel_h-1)] * valid.unsqueeze(-1)     # amino_dim, out_h, kernel_w
+        table = F.pad(table.permute(2, 0, 1), (0, 0, 0, 1))                                # kernel_w, amino_dim+1, out_h
+
+        conv_ft = gather_conv1d(protein_idx, table, padding=padding_w) + conv.bias        # batch, len, out_h
+        return conv_ft.transpose(1, 2).unsqueeze(1)
+
     def forward(self, protein_ft):
         '''
-        :param protein_ft: batch*len*amino_dim
+        :param protein_ft: batch*len*amino_dim one-hot, or batch*len token indices
         :return:
         '''
         batch_size = protein_ft.size()[0]
-        protein_ft = protein_ft.transpose(1, 2)
-        protein_ft = protein_ft.unsqueeze(1)
 
-        conv1_ft = F.relu(self.conv1(protein_ft))
-        conv2_ft = F.relu(self.conv2(protein_ft))
-        conv3_ft = F.relu(self.conv3(protein_ft))
+        # index input: gather kernel columns instead of convolving the one-hot map
+        if protein_ft.dim()==2:
+            conv1_ft = F.relu(self.index_conv(self.conv1, protein_ft))
+            conv2_ft = F.relu(self.index_conv(self.conv2, protein_ft))
+            conv3_ft = F.relu(self.index_conv(self.conv3, protein_ft))
+        else:
+            protein_ft = protein_ft.transpose(1, 2)
+            protein_ft = protein_ft.unsqueeze(1)
+
+            conv1_ft = F.relu(self.conv1(protein_ft))
+            conv2_ft = F.relu(self.conv2(protein_ft))
+            conv3_ft = F.relu(self.conv3(protein_ft))
 
         ft1, _ = torch.max(conv1_ft, dim=-1)
         ft2, _ = torch.max(conv2_ft, dim=-1)
@@ -57,6 +86,11 @@ class TextCNN(nn.Module):
         self.out_linear2 = nn.Linear(self.h_dim, 1)
         self.activation = nn.ELU()
 
+    @property
+    def fixed_length(self):
+        # forward pads / clips the sequences to max_antibody_len / max_virus_len with seq_pad_clip
+        return min(self.max_antibody_len, self.max_virus_len)
+
     def forward(self, batch_antibody_ft, batch_virus_ft):
         '''
         :param batch_antibody_ft:   tensor    batch, len, amino_ft_dim
@@ -68,9 +102,9 @@ class TextCNN(nn.Module):
         batch_antibody_ft = [seq_pad_clip(i, target_length=self.max_antibody_len) for i in batch_antibody_ft]
         batch_virus_ft = [seq_pad_clip(i, target_length=self.max_virus_len) for i in batch_virus_ft]
 
-        batch_antibody_ft = torch.Tensor([to_onehot(i, mode=1) for i in batch_antibody_ft]).float().cuda()
-        batch_virus_ft = torch.Tensor([to_onehot(i, mode=1) for i in batch_virus_ft]).float().cuda()
-        # (batch, seq_len, embed_size) / (batch, num_inds, dim_input)
+        batch_antibody_ft = torch.from_numpy(to_index(batch_antibody_ft)).cuda()
+        batch_virus_ft = torch.from_numpy(to_index(batch_virus_ft)).cuda()
+        # (batch, seq_len) token indices
 
         batch_size = batch_antibody_ft.size()[0]
         antibody_ft = self.text_inception(batch_antibody_ft).view(batch_size, -1)
@@ -1 +1,51 @@
-from .build import *
\ No newline at end of file
+import sys
+import types
+import importlib
+
+# model classes are imported on first access, so "import models" does not pull in esm or every baseline
+# "from models import *" still imports all of them, as notebooks expect
+_exports = {
+    "common": ["replace_pad", "get_representation", "ESMEmbedder", "get_embedding", "gather_conv1d", "fused_towers",
+               "packed_lstm", "masked_mean", "PositionalEncoding", "CoAttention", "TowerBaseModel", "kmer",
+               "kmer_embed_mean", "kmer_embed", "WindowEncoder", "SequenceEncoder"],
+    "mlp_lstm": ["BiMLP", "BiLSTM_demo", "BiLSTMEncoder", "BiLSTM"],
+    "setmodel": ["MAB", "SAB", "ISAB", "PMA", "SetEncoder", "SetTransformer", "SetCoAttnTransformer",
+                 "AlternateCoattnModel", "SetModel", "SetModel_ablation"],
+    "ITransformer": ["IntTransEncoder", "InteractTransformer", "InteractTransformerLSTM", "InteractTransformer_share",
+                     "BiInteractTransformer", "InteractCoattn_noTransformer"],
+    "FTransformer": ["FTransformer"],
+    "FSTransformer": ["frame_slice", "FSAttention", "FSTransformer"],
+    "masonscnn": ["CNNmodule", "CNNEncoder", "MasonsCNN"],
+    "ensemble": ["EnsembleModel", "PESI"],
+    "TextCNN": ["TextInception", "TextCNN"],
+    "AgFastParapred": ["AttentionLayer", "AgFastParapred"],
+    "PIPR": ["PIPR"],
+    "ResPPI": ["BasicBlock2D", "ResPPI"],
+    "build": ["MODELS", "ENCODERS", "get_model_class", "model_spec", "make_model", "build_model"],
+}
+_locations = {name: module for module, names in _exports.items() for name in names}
+
+__all__ = list(_locations.keys())
+
+
+def __getattr__(name):
+    if name in _locations:
+        value = getattr(importlib.import_module("." + _locations[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(__all__))
+
+
+class _ModelsModule(types.ModuleType):
+    # importing e.g. models.TextCNN (torch.load does) binds the submodule on the package, 
+    # keep the class of the same name bound instead, as the eager star imports used to
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) and name in _locations:
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+sys.modules[__name__].__class__ = _ModelsModule
@@ -1,17 +1,263 @@
-from .common import *
-from .mlp_lstm import *
-from .setmodel import *
-from .ITransformer import *
-from .FTransformer import *
-from .FSTransformer import *
-from .masonscnn import *
-from .ensemble import *
-
-from .TextCNN import *
-from .AgFastParapred import *
-from .PIPR import *
-from .ResPPI import *
-
-
-def build_model(config, use_pretrain=False):
-    pass
\ No newline at end of file
+import importlib
+
+from utils import vocab
+
+
+# model name -> how to build it and its default hyperparameters
+#   module, cls:    class to construct, imported only when the model is built
+#   kwargs:         constructor arguments, overridden per stage by "<stage>_kwargs"
+#   pretrain:       hyperparameters for pre-training on SAbDab (pre_train.py)
+#   cov:            hyperparameters for training from scratch on CoV-AbDab (cov_train.py)
+#   ft:             hyperparameters for fine-tuning a pre-trained model on CoV-AbDab (<name>_ft, <name>_ft_pairPreTrain)
+#   freeze:         submodules frozen with fix_FE, None if not supported
+#   tower:          TowerBaseModel arguments around a pairwise pre-trained encoder, None if not supported
+#   encoder:        ENCODERS entry of the pairwise pre-trained encoder, default <name>_encoder
+MODELS = {
+    "lstm": {
+        "module": "mlp_lstm", "cls": "BiLSTM",
+        "kwargs": dict(embed_size=32, hidden=64, num_layers=1, dropout=0.5, use_pretrain=False),
+        "pretrain": dict(epochs=100, lr=6e-5),
+        "cov": dict(epochs=300, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": ["LSTM_para", "LSTM_epi"],
+        "tower": dict(embed_size=64, hidden=128, use_two_towers=False, use_coattn=False, fusion=1),
+        "encoder": "lstm_encoder",
+    },
+    "textcnn": {
+        "module": "TextCNN", "cls": "TextCNN",
+        "kwargs": dict(amino_ft_dim=len(vocab), max_antibody_len=100, max_virus_len=100, h_dim=512, dropout=0.1),
+        "pretrain": dict(epochs=100, lr=1e-4),
+        "cov": dict(epochs=100, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": ["text_inception", "text_inception2"],
+        "tower": None,                          # no single-sequence encoder class
+    },
+    "masonscnn": {
+        "module": "masonscnn", "cls": "MasonsCNN",
+        "kwargs": dict(amino_ft_dim=len(vocab), max_antibody_len=100, max_virus_len=100, h_dim=512, dropout=0.1),
+        "pretrain": dict(epochs=300, lr=1e-4, l2_coef=5e-4),
+        "cov": dict(epochs=100, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": ["cnnmodule", "cnnmodule2"],
+        "tower": dict(embed_size=32, hidden=128, use_two_towers=False, use_coattn=False, fusion=0),
+        "encoder": "masonscnn_encoder",
+    },
+    "ag_fast_parapred": {
+        "module": "AgFastParapred", "cls": "AgFastParapred",
+        "kwargs": dict(ft_dim=len(vocab), max_antibody_len=100, max_virus_len=100, h_dim=512, position_coding=True),
+        "pretrain": dict(epochs=100, lr=1e-4),
+        "cov": dict(epochs=100, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": None,
+        "tower": None,                          # no single-sequence encoder class
+    },
+    "pipr": {
+        "module": "PIPR", "cls": "PIPR",
+        "kwargs": dict(protein_ft_one_hot_dim=len(vocab)),
+        "pretrain": dict(epochs=300, lr=1e-4),
+        "cov": dict(epochs=100, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": None,
+        "tower": None,
+    },
+    "resppi": {
+        "module": "ResPPI", "cls": "ResPPI",
+        "kwargs": dict(amino_ft_dim=len(vocab), max_antibody_len=100, max_virus_len=100, h_dim=512, dropout=0.1),
+        "pretrain": dict(epochs=300, lr=1e-4),
+        "cov": dict(epochs=100, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": None,
+        "tower": None,                          # no single-sequence encoder class
+    },
+    "SetTransformer": {
+        "module": "setmodel", "cls": "SetTransformer",
+        "kwargs": dict(dim_input=32, num_outputs=32, dim_output=32, dim_hidden=64, num_inds=6, num_heads=4,
+                       ln=True, dropout=0.5, use_coattn=False, share=False),
+        "pretrain": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "cov": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": ["para_enc", "para_dec", "epi_enc", "epi_dec"],
+        "tower": None,
+    },
+    "SetTransformer_share": {
+        "module": "setmodel", "cls": "SetTransformer",
+        # one enc/dec for paratope and epitope, run once over both stacked (fuse_towers)
+        "kwargs": dict(dim_input=32, num_outputs=32, dim_output=64, dim_hidden=64, num_inds=6, num_heads=4,
+                       ln=True, dropout=0.5, use_coattn=False, share=True),
+        "pretrain": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "cov": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=1e-4, l2_coef=5e-4),
+        "freeze": ["enc", "dec"],
+        "tower": None,
+    },
+    "pesi": {
+        "module": "setmodel", "cls": "SetTransformer",
+        "kwargs": dict(dim_input=32, num_outputs=32, dim_output=32, dim_hidden=64, num_inds=6, num_heads=4,
+                       ln=True, dropout=0.5, use_coattn=True, share=False, use_BSS=False),
+        "pretrain_kwargs": dict(dim_hidden=128),
+        "pretrain": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+        "cov": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+        "ft": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+        "freeze": ["para_enc", "para_dec", "epi_enc", "epi_dec"],
+        "tower": None,
+    },
+    # new model, not a faster SetModel: WindowEncoder replaces the per-kmer transformer, train it from scratch
+    "SetModel_window": {
+        "module": "setmodel", "cls": "SetModel",
+        "kwargs": dict(embed_size=32, hidden=64, num_layers=1, dropout=0.3, k4kmer=3, use_pretrain=False,
+                       use_coattn=False, seq_encoder_type="window", num_heads=2, num_inds=6, num_outputs=6, ln=True),
+        "pretrain": dict(epochs=500, lr=3e-5),
+        "cov": dict(epochs=200, lr=3e-5, l2_coef=5e-4),
+        "ft": dict(epochs=200, lr=3e-5, l2_coef=5e-4),
+        "freeze": ["seq_encoder_para", "seq_encoder_epi", "para_enc", "para_dec", "epi_enc", "epi_dec"],
+        "tower": None,
+    },
+    "SetCoAttnTransformer": {
+        "module": "setmodel", "cls": "SetTransformer",
+        "kwargs": dict(dim_input=32, num_outputs=32, dim_output=32, dim_hidden=64, num_inds=6, num_heads=4,
+                       ln=True, dropout=0.5, use_coattn=True, share=False),
+        "pretrain": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+        "cov": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+        "ft": dict(epochs=1500, lr=1e-4, l2_coef=3e-4),
+        "freeze": ["para_enc", "para_dec", "epi_enc", "epi_dec"],
+        "tower": dict(embed_size=32, hidden=128, use_two_towers=False, mid_coattn=True, use_coattn=True, fusion=1),
+        "encoder": "SetTransformer_encoder",
+    },
+}
+
+# single-sequence encoders of the pairwise pre-training (pre_train.py with use_pair), wrapped by TowerBaseModel
+#   module, cls, kwargs:    as in MODELS, the arguments of the legacy <name>_encoder checkpoints
+#   pretrain:               hyperparameters for the pairwise pre-training on SAbDab
+ENCODERS = {
+    "lstm_encoder": {
+        "module": "mlp_lstm", "cls": "BiLSTMEncoder",
+        "kwargs": dict(embed_size=64, hidden=64, num_layers=1),
+        "pretrain": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+    },
+    "masonscnn_encoder": {
+        "module": "masonscnn", "cls": "CNNEncoder",
+        "kwargs": dict(),
+        "pretrain": dict(epochs=500, lr=6e-5, l2_coef=5e-4),
+    },
+    "SetTransformer_encoder": {
+        "module": "setmodel", "cls": "SetEncoder",
+        "kwargs": dict(embed_size=32, num_outputs=32, dim_output=32, hidden=128, num_inds=6, num_heads=4,
+                       ln=True, dropout=0.5),
+        "pretrain": dict(epochs=1000, lr=6e-5, l2_coef=5e-4),
+    },
+}
+
+
+def get_model_class(module, cls):
+    return getattr(importlib.import_module("." + module, __package__), cls)
+
+
+def split_model_name(model_name):
+    # lstm -> (lstm, None), lstm_ft -> (lstm, ft), lstm_ft_pairPreTrain -> (lstm, pair)
+    if model_name.endswith("_ft_pairPreTrain"):
+        return model_name[:-len("_ft_pairPreTrain")], "pair"
+    if model_name.endswith("_ft"):
+        return model_name[:-len("_ft")], "ft"
+    return model_name, None
+
+
+def freeze(model, names):
+    for name in names:
+        for param in getattr(model, name).parameters():
+            param.requires_grad = False
+
+
+def model_spec(name, stage="cov"):
+    '''
+    JSON-serialisable description of a registered model, saved with its checkpoints
+
+    :param name:    registered name, optionally with _ft / _ft_pairPreTrain, or an ENCODERS name
+    :param stage:   stage whose constructor arguments are used for models trained from scratch, 
+                    fine-tuned models keep the pre-training arguments of the checkpoint they start from
+    :return:        {"module", "cls", "kwargs"}, module arguments are nested as {"spec": ...}
+    '''
+    if name in ENCODERS:
+        spec = ENCODERS[name]
+        return {"module": spec["module"], "cls": spec["cls"], "kwargs": dict(spec["kwargs"])}
+
+    name, variant = split_model_name(name)
+    spec = MODELS[name]
+    if variant=="pair":
+        encoder = model_spec(spec.get("encoder", name+"_encoder"))
+        return {"module": "common", "cls": "TowerBaseModel", "kwargs": dict(spec["tower"], encoder={"spec": encoder})}
+
+    stage = "pretrain" if variant=="ft" else stage
+    return {"module": spec["module"], "cls": spec["cls"], "kwargs": dict(spec["kwargs"], **spec.get(stage+"_kwargs", {}))}
+
+
+def make_model(spec):
+    '''
+    construct an untrained model from model_spec() or a checkpoint's spec, the spec is kept as model._spec
+    '''
+    kwargs = {}
+    for k, v in spec["kwargs"].items():
+        kwargs[k] = make_model(v["spec"]) if isinstance(v, dict) and "spec" in v else v
+    model = get_model_class(spec["module"], spec["cls"])(**kwargs)
+    model._spec = spec
+    return model
+
+
+def build_model(config, stage="cov"):
+    '''
+    build config["model"] from config["model_name"] and fill in its default epochs / lr / l2_coef
+
+    :param config:  needs model_name (an ENCODERS name for pairwise pre-training), and fix_FE for fine-tuning; 
+                    hyperparameters already in config are kept
+    :param stage:   "pretrain" for SAbDab pre-training, "cov" for CoV-AbDab training and fine-tuning
+    :return:        config
+    '''
+    from checkpoint import load_model
+
+    if config["model_name"] in ENCODERS:
+        config["model"] = make_model(model_spec(config["model_name"])).cuda()
+        for k, v in ENCODERS[config["model_name"]]["pretrain"].items():
+            config.setdefault(k, v)
+        return config
+
+    name, variant = split_model_name(config["model_name"])
+    if name not in MODELS:
+        print("wrong model name: {}".format(config["model_name"]))
+        exit()
+    spec = MODELS[name]
+    ckpt_dir = "./results/SAbDab/full/{}".format(config.get("data_type", "seq1_neg0"))
+
+    if variant==None:
+        config["model"] = make_model(model_spec(name, stage)).cuda()
+        hparams = spec[stage]
+
+    elif variant=="ft":
+        config["model"] = load_model("{}/{}/model_best.pth".format(ckpt_dir, name), 
+                                     spec=model_spec(config["model_name"]), device=None).cuda()
+        config["model"].train()
+
+        if config.get("fix_FE", False)==True:
+            if spec["freeze"]==None:
+                print("fix_FE not implemented for {}".format(name))
+                exit()
+            freeze(config["model"], spec["freeze"])
+        hparams = spec["ft"]
+
+    elif variant=="pair":
+        if spec["tower"]==None or spec.get("encoder", name+"_encoder") not in ENCODERS:
+            print("no pairwise pre-trained encoder for {}".format(name))
+            exit()
+        tower_spec = model_spec(config["model_name"])
+        encoder = load_model("{}/{}/model_best.pth".format(ckpt_dir, spec.get("encoder", name+"_encoder")), 
+                             spec=tower_spec["kwargs"]["encoder"]["spec"], device=None)
+        encoder.train()
+        config["model"] = get_model_class("common", "TowerBaseModel")(encoder=encoder, **spec["tower"]).cuda()
+        config["model"]._spec = tower_spec
+
+        if config.get("fix_FE", False)==True:
+            freeze(config["model"], ["encoder"])
+        hparams = spec["ft"]
+
+    for k, v in hparams.items():
+        config.setdefault(k, v)
+
+    return config
@@ -6,10 +6,7 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
-import esm
-
-from dataset import *
-from utils import *
+from utils import to_onehot, strip_seq, seq_lens
 
 
 def replace_pad(seq):
@@ -28,7 +25,7 @@ def get_representation(esm2, sequence, alphabet):
 
     # Extract per-residue representations (on GPU)
     with torch.no_grad():
-        results = esm2(batch_tokens.cuda(), repr_layers=[6], return_contacts=True)
+        results = esm2(batch_tokens.to(next(esm2.parameters()).device), repr_layers=[6], return_contacts=False)
     token_representations = results["representations"][6]
 
     # Generate per-sequence representations via averaging
@@ -40,24 +37,180 @@ def get_representation(esm2, sequence, alphabet):
     return sequence_representations
 
 
-# predict paratope/epitope embedding [batch_size, seq_len, embed_size]
+class ESMEmbedder(object):
+    '''
+    process-wide ESM-2 embedding service, use ESMEmbedder.get() instead of constructing it
+    the model is loaded on first use and kept, sequences are deduplicated, cached, 
+    and run in batches of at most max_tokens (padded) tokens
+    '''
+    _instance = None
+
+    def __init__(self, model_name="esm2_t6_8M_UR50D", repr_layer=6, max_tokens=16384, device=None, use_cache=True):
+        '''
+        :param model_name:  name of a loader in esm.pretrained
+        :param repr_layer:  layer whose representations are returned
+        :param max_tokens:  token budget of a forward pass, batch_size * padded_len <= max_tokens
+        :param device:      None for cuda if available, else cpu
+        :param use_cache:   keep per-sequence mean embeddings of every sequence seen (on cpu)
+        '''
+        self.model_name = model_name
+        self.repr_layer = repr_layer
+        self.max_tokens = max_tokens
+        self.device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.use_cache = use_cache
+
+        self.model = None
+        self.alphabet = None
+        self.cache = {}
+
+    @classmethod
+    def get(cls, **kwargs):
+        if cls._instance is None:
+            cls._instance = cls(**kwargs)
+        return cls._instance
+
+    @property
+    def embed_size(self):
+        self.load()
+        return self.model.embed_dim
+
+    def load(self):
+        if self.model is None:
+            import esm
+
+            self.model, self.alphabet = getattr(esm.pretrained, self.model_name)()
+            self.model = self.model.to(self.device).eval()
+            self.batch_converter = self.alphabet.get_batch_converter()
+        return self.model
+
+    @staticmethod
+    def clean(seq):
+        # strip padding and the BEGIN/END tokens added by collate_fn, map the remaining special tokens to ESM's
+        # every residue of strip_seq(seq) stays a single ESM token
+        return strip_seq(seq).replace("*", "<unk>").replace("/", "<mask>")
+
+    def batches(self, seqs):
+        # longest first, so that the first batch shows the peak memory
+        order = sorted(range(len(seqs)), key=lambda i: -len(seqs[i]))
+        batch, batch_len = [], 0
+        for i in order:
+            seq_len = len(seqs[i]) + 2
+            if batch and max(batch_len, seq_len) * (len(batch) + 1) > self.max_tokens:
+                yield batch
+                batch, batch_len = [], 0
+            batch.append(i)
+            batch_len = max(batch_len, seq_len)
+        if batch:
+            yield batch
+
+    def run(self, seqs, per_residue=False):
+        '''
+        :param seqs:            list of cleaned sequences
+        :param per_residue:     also return per-residue representations
+        :return:                means (n, embed_size) on cpu, list of (len, embed_size) on cpu or None
+        '''
+        self.load()
+        means = torch.zeros(len(seqs), self.model.embed_dim)
+        residues = [None] * len(seqs) if per_residue else None
+
+        with torch.no_grad():
+            for batch in self.batches(seqs):
+                _, _, tokens = self.batch_converter([(str(i), seqs[i]) for i in batch])
+                lens = (tokens != self.alphabet.padding_idx).sum(1)
+                results = self.model(tokens.to(self.device), repr_layers=[self.repr_layer], return_contacts=False)
+                reps = results["representations"][self.repr_layer].float().cpu()
+
+                # token 0 is the beginning-of-sequence token, the last one is end-of-sequence
+                for j, i in enumerate(batch):
+                    rep = reps[j, 1 : lens[j] - 1]
+                    means[i] = rep.mean(0)
+                    if per_residue:
+                        residues[i] = rep.clone()
+
+        return means, residues
+
+    def embed(self, seqs):
+        '''
+        :param seqs:    list of sequences, possibly padded and wrapped by collate_fn
+        :return:        tensor (batch, embed_size) on self.device
+        '''
+        seqs = [self.clean(seq) for seq in seqs]
+        if not self.use_cache:
+            return self.run(seqs)[0].to(self.device)
+
+        missing = list(set(seq for seq in seqs if seq not in self.cache))
+        if missing:
+            means, _ = self.run(missing)
+            for seq, mean in zip(missing, means):
+                self.cache[seq] = mean
+
+        return torch.stack([self.cache[seq] for seq in seqs]).to(self.device)
+
+
+# predict paratope/epitope embedding [batch_size, embed_size]
+# tensors are taken as precomputed embeddings (ESMFeatureDataset) and only moved to the embedder's device
 def get_embedding(paratope, epitope, use_subseq=False):
-    esm2, alphabet = esm.pretrained.esm2_t6_8M_UR50D()
-    esm2.cuda()
-    esm2.eval()
-
-    paratope = [("paratope", i[0].replace("#", "<pad>").replace("*", "<unk>").replace("/", "<mask>")) for i in paratope]
-    epitope = [("epitope", i[1].replace("#", "<pad>").replace("*", "<unk>").replace("/", "<mask>")) for i in epitope]
+    embedder = ESMEmbedder.get()
 
-    para_embed = get_representation(esm2, paratope, alphabet)
-    epi_embed = get_representation(esm2, epitope, alphabet)
+    if torch.is_tensor(paratope) and torch.is_tensor(epitope):
+        return paratope.to(embedder.device).float(), epitope.to(embedder.device).float()
 
-    para_embed = torch.vstack(para_embed)
-    epi_embed = torch.vstack(epi_embed)
+    para_embed = embedder.embed(list(paratope))
+    epi_embed = embedder.embed(list(epitope))
 
     return para_embed, epi_embed
 
 
+# convolution over a one-hot sequence computed as a sum of gathered kernel columns
+# tokens: (batch, seq_len) vocab indices
+# table: (kernel_size, vocab_size+1, out_channels), table[j, v] is the response of kernel column j to token v, 
+#        the last row must be zeros and is used for the zero padding
+# -> (batch, seq_len+2*padding-kernel_size+1, out_channels)
+def gather_conv1d(tokens, table, padding=0):
+    kernel_size = table.size(0)
+    tokens = F.pad(tokens, (padding, padding), value=table.size(1)-1)
+    out_len = tokens.size(1) - kernel_size + 1
+
+    out = 0
+    for j in range(kernel_size):
+        out = out + F.embedding(tokens[:, j:j+out_len], table[j])
+
+    return out
+
+
+# run a shared-weight tower once over several inputs stacked along the batch axis and split the result
+# inputs are either lists of sequences padded to one length or tensors with matching trailing shapes,
+# anything else (e.g. paratopes and epitopes padded to different lengths) falls back to one call per input
+def fused_towers(tower, *inputs):
+    if all(isinstance(x, list) for x in inputs) and len(set(len(x[0]) for x in inputs if len(x)>0))<=1:
+        out = tower(sum(inputs, []))
+    elif all(torch.is_tensor(x) for x in inputs) and len(set(x.shape[1:] for x in inputs))==1:
+        out = tower(torch.cat(inputs, dim=0))
+    else:
+        return tuple(tower(x) for x in inputs)
+
+    return torch.split(out, [len(x) for x in inputs], dim=0)
+
+
+# run an LSTM over the real residues of a padded batch only
+# x: (batch, seq_len, embed_size), lens: (batch, ) number of residues before padding
+# -> (batch, seq_len, hidden) with zeros at padded positions
+def packed_lstm(lstm, x, lens):
+    seq_len = x.size(1)
+    lens = lens.cpu().clamp(1, seq_len)
+    x = nn.utils.rnn.pack_padded_sequence(x, lens, batch_first=True, enforce_sorted=False)
+    x, _ = lstm(x)
+    x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=seq_len)
+    return x
+
+
+# mean over the first lens positions    (batch, seq_len, hidden) -> (batch, hidden)
+def masked_mean(x, lens):
+    mask = torch.arange(x.size(1), device=x.device).view(1, -1) < lens.to(x.device).view(-1, 1)
+    mask = mask.unsqueeze(-1).to(x.dtype)
+    return (x * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+
 # https://pytorch.org/tutorials/beginner/transformer_tutorial.html
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model: int, dropout: float = 0.1, max_len: int = 100):
@@ -151,10 +304,12 @@ class TowerBaseModel(nn.Module):
                  mid_coattn=False, 
                  use_coattn=False, 
                  fusion=0, 
-                 dropout=0.1):
+                 dropout=0.1, 
+                 fuse_towers=True):
         super(TowerBaseModel, self).__init__()
 
         self.embed_size = embed_size
+        self.fuse_towers = fuse_towers                   # single pass of the shared encoder over para and epi
         self.use_two_towers = use_two_towers
         self.mid_coattn = mid_coattn
         self.use_coattn = use_coattn
@@ -188,6 +343,12 @@ class TowerBaseModel(nn.Module):
 
     def forward(self, para, epi):
 
+        # per-residue encoders (accepts_lens) output zeros at the padding, their outputs are pooled over the residues
+        para_lens, epi_lens = None, None
+        encoder = self.encoder_para if self.use_two_towers==True else self.encoder
+        if self.mid_coattn==False and getattr(encoder, "accepts_lens", False):
+            para_lens, epi_lens = torch.from_numpy(seq_lens(para)), torch.from_numpy(seq_lens(epi))
+
         if self.mid_coattn==True:
             if self.use_two_towers==True:
                 para = torch.Tensor([to_onehot(i) for i in para]).int().cuda()
@@ -204,6 +365,17 @@ class TowerBaseModel(nn.Module):
 
                 para = self.encoder_para.decoder(para)
                 epi = self.encoder_epi.decoder(epi)
+            elif getattr(self, "fuse_towers", False):
+                para = torch.Tensor([to_onehot(i) for i in para]).int().cuda()
+                epi = torch.Tensor([to_onehot(i) for i in epi]).int().cuda()
+
+                para, epi = fused_towers(self.encoder.embedding, para, epi)
+                para, epi = fused_towers(self.encoder.encoder, para, epi)
+
+                if self.use_coattn==True:
+                    para, epi = self.coattn(para, epi)
+
+                para, epi = fused_towers(self.encoder.decoder, para, epi)
             else:
                 para = torch.Tensor([to_onehot(i) for i in para]).int().cuda()
                 epi = torch.Tensor([to_onehot(i) for i in epi]).int().cuda()
@@ -222,11 +394,13 @@ class TowerBaseModel(nn.Module):
                 
         else:
             if self.use_two_towers==True:
-                para = self.encoder_para(para)
-                epi = self.encoder_epi(epi)
+                para = self.encoder_para(para, para_lens) if para_lens is not None else self.encoder_para(para)
+                epi = self.encoder_epi(epi, epi_lens) if epi_lens is not None else self.encoder_epi(epi)
+            elif getattr(self, "fuse_towers", False):
+                para, epi = fused_towers(self.encoder, para, epi)
             else:
-                para = self.encoder(para)
-                epi = self.encoder(epi)
+                para = self.encoder(para, para_lens) if para_lens is not None else self.encoder(para)
+                epi = self.encoder(epi, epi_lens) if epi_lens is not None else self.encoder(epi)
 
             # (batch, len, embed_size)
 
@@ -240,7 +414,10 @@ class TowerBaseModel(nn.Module):
 
         # (batch, len, embed_size)
 
-        if len(para.shape)==3:
+        if len(para.shape)==3 and para_lens is not None:
+            para = masked_mean(para, para_lens)
+            epi = masked_mean(epi, epi_lens)
+        elif len(para.shape)==3:
             para = torch.mean(para, dim=1)
             epi = torch.mean(epi, dim=1)
 
@@ -267,26 +444,56 @@ def kmer(seq, k=3):
 # length of token is k
 # (batch, seq_len, hidden) -> (batch, seq_len-k+1, hidden)
 def kmer_embed_mean(seqs, k=3):
-    ngram_li = []
-    for seq in seqs:
-        ngram = [torch.mean(seq[i:i+k, :], dim=0) for i in range(len(seq)-k+1)]
-        ngram_li.append(torch.vstack(ngram))
-
-    return torch.stack(ngram_li)
+    return seqs.unfold(1, k, 1).mean(dim=-1)
 
 # reshape by slicing original sequence with kmer
 # (batch, seq_len, hidden) -> (batch*(seq_len-k+1), k, hidden)
 def kmer_embed(seqs, k=3):
-    ngram_li = []
-    for seq in seqs:
-        ngram = [seq[i:i+k, :] for i in range(len(seq)-k+1)]
-        ngram_li.append(torch.stack(ngram, dim=0))
+    # unfold gives (batch, seq_len-k+1, hidden, k) views of the overlapping windows
+    ngram = seqs.unfold(1, k, 1).permute(0, 1, 3, 2)
     
-    return torch.vstack(ngram_li)
+    return ngram.reshape(-1, k, seqs.size(2))
+
+
+class WindowEncoder(nn.Module):
+    """encode every length-k window of a sequence in one pass
+
+    depthwise convolution with kernel k mixes the residues inside each window, 
+    followed by position-wise feed-forward layers, so output i only sees residues i..i+k-1 
+    like the per-kmer SequenceEncoder, without materialising batch*(seq_len-k+1) sub-sequences
+
+    not a faster form of the per-kmer transformer / LSTM: the weights differ, so their checkpoints do not load
+    into it and a model has to be trained again with it, its accuracy is not that of the per-kmer encoders.
+    registered as the model SetModel_window (models/build.py), benchmarks/bench_models.py times it against
+    SetModel / SetModel_lstm
+    """
+    def __init__(self, k=3, num_layers=2, embed_size=64, hidden=128, dropout=0):
+        super(WindowEncoder, self).__init__()
+
+        self.k = k
+        self.window_conv = nn.Conv1d(embed_size, embed_size, kernel_size=k, groups=embed_size)
+        self.norm = nn.LayerNorm(embed_size)
+
+        self.ffn = nn.ModuleList()
+        for i in range(num_layers):
+            self.ffn.append(nn.Sequential(nn.Linear(embed_size, hidden), nn.GELU(), nn.Dropout(dropout), 
+                                          nn.Linear(hidden, embed_size), nn.Dropout(dropout)))
+        self.ffn_norm = nn.ModuleList([nn.LayerNorm(embed_size) for i in range(num_layers)])
+
+    def forward(self, x):
+        # (batch, seq_len, embed_size) -> (batch, seq_len-k+1, embed_size)
+        window_mean = x.unfold(1, self.k, 1).mean(dim=-1)
+        x = self.window_conv(x.transpose(1, 2)).transpose(1, 2)
+        x = self.norm(x + window_mean)
+
+        for ffn, norm in zip(self.ffn, self.ffn_norm):
+            x = norm(x + ffn(x))
+
+        return x
 
 
 class SequenceEncoder(nn.Module):
-    def __init__(self, seq_encoder_type="lstm", num_layers=2, embed_size=64, hidden=512, dropout=0, nhead=4):
+    def __init__(self, seq_encoder_type="lstm", num_layers=2, embed_size=64, hidden=512, dropout=0, nhead=4, k=3):
         super(SequenceEncoder, self).__init__()
 
         self.dropout = dropout
@@ -297,6 +504,13 @@ class SequenceEncoder(nn.Module):
             self.pos_encoder = PositionalEncoding(d_model=embed_size, dropout=self.dropout)
             encoder_layer = nn.TransformerEncoderLayer(d_model=embed_size, nhead=nhead, batch_first=True)
             self.seq_encoder = nn.TransformerEncoder(encoder_layer=encoder_layer, num_layers=num_layers)
+        # windowed convolution over all kmers at once
+        elif self.seq_encoder_type=="window":
+            self.seq_encoder = WindowEncoder(k=k, 
+                                             num_layers=num_layers, 
+                                             embed_size=embed_size, 
+                                             hidden=hidden, 
+                                             dropout=self.dropout)
         # lstm
         else:
             self.seq_encoder = nn.LSTM(input_size=embed_size, 
@@ -7,12 +7,10 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
-from dataset import *
-from utils import *
-from .common import *
-from .masonscnn import *
-from .ITransformer import *
-from .setmodel import *
+from utils import vocab, to_onehot, to_index, seq_pad_clip
+from .common import PositionalEncoding, CoAttention
+from .masonscnn import CNNmodule
+from .setmodel import SAB, ISAB, PMA
 
 
 
@@ -115,8 +113,8 @@ class EnsembleModel(nn.Module):
 
         frame_para = [seq_pad_clip(i, target_length=self.max_len) for i in frame_para]
         frame_epi = [seq_pad_clip(i, target_length=self.max_len) for i in frame_epi]
-        frame_para = torch.Tensor([to_onehot(i, mode=1) for i in frame_para]).float().cuda()        
-        frame_epi = torch.Tensor([to_onehot(i, mode=1) for i in frame_epi]).float().cuda()
+        frame_para = torch.from_numpy(to_index(frame_para)).cuda()
+        frame_epi = torch.from_numpy(to_index(frame_epi)).cuda()
 
         batch_size = frame_para.size()[0]
 
@@ -250,8 +248,8 @@ class PESI(nn.Module):
 
         frame_para = [seq_pad_clip(i, target_length=self.max_len) for i in frame_para]
         frame_epi = [seq_pad_clip(i, target_length=self.max_len) for i in frame_epi]
-        frame_para = torch.Tensor([to_onehot(i, mode=1) for i in frame_para]).float().cuda()        
-        frame_epi = torch.Tensor([to_onehot(i, mode=1) for i in frame_epi]).float().cuda()
+        frame_para = torch.from_numpy(to_index(frame_para)).cuda()
+        frame_epi = torch.from_numpy(to_index(frame_epi)).cuda()
 
         batch_size = frame_para.size()[0]
 
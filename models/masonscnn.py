@@ -1,10 +1,10 @@
 # https://github.com/enai4bio/DeepAAI/blob/main/models/masonscnn_cls.py
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from .common import *
+from utils import vocab, to_index, seq_pad_clip
+from .common import gather_conv1d
 
 
 class CNNmodule(nn.Module):
@@ -18,14 +18,29 @@ class CNNmodule(nn.Module):
         self.dropout = nn.Dropout(0.5)
 
 
+    def index_conv(self, protein_idx):
+        '''
+        conv over one-hot input as a sum of gathered kernel columns
+        :param protein_idx: batch*len token indices
+        :return: batch*out_channels*(len+1), same as self.conv(one-hot)
+        '''
+        # table[j, v] = weight[:, v, j], plus a zero row for padding
+        table = F.pad(self.conv.weight.permute(2, 1, 0), (0, 0, 0, 1))
+        conv_ft = gather_conv1d(protein_idx, table, padding=self.conv.padding[0]) + self.conv.bias
+        # contiguous: forward flattens the pooled map with .view
+        return conv_ft.transpose(1, 2).contiguous()
+
     def forward(self, protein_ft):
         '''
-        :param protein_ft: batch*len*amino_dim
+        :param protein_ft: batch*len*amino_dim one-hot, or batch*len token indices
         :return:
         '''
         batch_size = protein_ft.size()[0]
-        protein_ft = protein_ft.transpose(1, 2)
-        conv_ft = self.conv(protein_ft)
+        if protein_ft.dim()==2:
+            conv_ft = self.index_conv(protein_ft)
+        else:
+            protein_ft = protein_ft.transpose(1, 2)
+            conv_ft = self.conv(protein_ft)
         conv_ft = self.dropout(conv_ft)
         conv_ft = self.pool(conv_ft).view(batch_size, -1)
         conv_ft = self.out_linear(conv_ft)
@@ -42,7 +57,7 @@ class CNNEncoder(nn.Module):
 
         x = [seq_pad_clip(i, target_length=100) for i in x]
 
-        x = torch.Tensor([to_onehot(i, mode=1) for i in x]).float().cuda()
+        x = torch.from_numpy(to_index(x)).cuda()
 
         x = self.encoder(x)
 
@@ -73,6 +88,11 @@ class MasonsCNN(nn.Module):
         self.activation = nn.ELU()
 
 
+    @property
+    def fixed_length(self):
+        # forward pads / clips the sequences to max_antibody_len / max_virus_len with seq_pad_clip
+        return min(self.max_antibody_len, self.max_virus_len)
+
     def forward(self, batch_antibody_ft, batch_virus_ft):
         '''
         :param batch_antibody_ft:   tensor    batch, len, amino_ft_dim
@@ -83,8 +103,8 @@ class MasonsCNN(nn.Module):
         batch_antibody_ft = [seq_pad_clip(i, target_length=self.max_antibody_len) for i in batch_antibody_ft]
         batch_virus_ft = [seq_pad_clip(i, target_length=self.max_virus_len) for i in batch_virus_ft]
 
-        batch_antibody_ft = torch.Tensor([to_onehot(i, mode=1) for i in batch_antibody_ft]).float().cuda()
-        batch_virus_ft = torch.Tensor([to_onehot(i, mode=1) for i in batch_virus_ft]).float().cuda()
+        batch_antibody_ft = torch.from_numpy(to_index(batch_antibody_ft)).cuda()
+        batch_virus_ft = torch.from_numpy(to_index(batch_virus_ft)).cuda()
 
         batch_size = batch_antibody_ft.size()[0]
         antibody_ft = self.cnnmodule(batch_antibody_ft).view(batch_size, -1)
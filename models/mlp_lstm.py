@@ -6,9 +6,8 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
-from dataset import *
-from utils import *
-from .common import *
+from utils import vocab, to_onehot, to_index, seq_lens
+from .common import replace_pad, get_embedding, packed_lstm, masked_mean
 
 
 class BiMLP(nn.Module):
@@ -97,9 +96,9 @@ class BiLSTM_demo(nn.Module):
             self.embedding = nn.Embedding(len(vocab), embed_size)
         
         proj_size = int(hidden/num_layers) if num_layers>1 else int(hidden/2)
-        self.LSTM_para = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size)
+        self.LSTM_para = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size, batch_first=True)
 
-        self.LSTM_epi = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size)
+        self.LSTM_epi = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size, batch_first=True)
         
         if self.use_pretrain:
             pass
@@ -116,8 +115,14 @@ class BiLSTM_demo(nn.Module):
             self.output_layer = nn.Sequential(nn.Linear(hidden, hidden//2), nn.LeakyReLU(), nn.Dropout(dropout), \
                                               nn.Linear(hidden//2, 1), nn.Sigmoid())
 
-    def forward(self, para, epi):
-        
+    def forward(self, para, epi, para_len=None, epi_len=None):
+        '''
+        :param para:        list    batch, paratope sequences padded with "#"
+        :param epi:         list    batch, epitope sequences padded with "#"
+        :param para_len:    tensor  batch, residues before padding (from collate_fn with return_lens), 
+                                    computed from the sequences if None
+        :param epi_len:     tensor  batch
+        '''
         if self.use_pretrain:
             para, epi = get_embedding(para, epi)
             # print(para.shape, epi.shape)
@@ -139,28 +144,27 @@ class BiLSTM_demo(nn.Module):
             return x
 
         else:
+            # lengths are taken after dropping the "/" separator, so any passed in from collate_fn are ignored
             para = list(map(replace_pad, para))
             epi = list(map(replace_pad, epi))
-            para, epi = torch.Tensor([to_onehot(i) for i in para]).int().cuda(), torch.Tensor([to_onehot(i) for i in epi]).int().cuda()
+            para_len, epi_len = torch.from_numpy(seq_lens(para)), torch.from_numpy(seq_lens(epi))
+            para = torch.from_numpy(to_index(para)[:, :int(para_len.max())]).cuda()
+            epi = torch.from_numpy(to_index(epi)[:, :int(epi_len.max())]).cuda()
 
             # paratope
             para = self.embedding(para)
             # (batch, para_seq_length, hidden)
-            para, _ = self.LSTM_para(para)
+            para = packed_lstm(self.LSTM_para, para, para_len)
             # (batch, para_seq_length, hidden)
-            para = torch.mean(para, dim=1)
-            # (batch, 1, hidden)
-            para = para.squeeze(1)
+            para = masked_mean(para, para_len)
             # (batch, hidden)
             
             # epitope
             epi = self.embedding(epi)
             # (batch, epi_seq_length, hidden)
-            epi, _ = self.LSTM_epi(epi)        
+            epi = packed_lstm(self.LSTM_epi, epi, epi_len)
             # (batch, epi_seq_length, hidden)
-            epi = torch.mean(epi, dim=1)
-            # (batch, 1, hidden)
-            epi = epi.squeeze(1)
+            epi = masked_mean(epi, epi_len)
             # (batch, hidden)
 
             x = para * epi
@@ -171,6 +175,8 @@ class BiLSTM_demo(nn.Module):
         
 
 class BiLSTMEncoder(nn.Module):
+    accepts_lens = True         # forward takes per-sample lengths, its output is zero at padded positions
+
     def __init__(self, embed_size=64, hidden=128, num_layers=2):
         super(BiLSTMEncoder, self).__init__()
 
@@ -182,21 +188,30 @@ class BiLSTMEncoder(nn.Module):
 
         proj_size = int(hidden/num_layers) if num_layers>1 else int(hidden/2)
         self.encoder = nn.LSTM(input_size=embed_size, hidden_size=hidden, 
-                               num_layers=num_layers, bidirectional=True, proj_size=proj_size)
+                               num_layers=num_layers, bidirectional=True, proj_size=proj_size, batch_first=True)
 
 
-    def forward(self, x):
-        x = torch.Tensor([to_onehot(i) for i in x]).int().cuda()
+    def forward(self, x, lens=None):
+        '''
+        :param x:       list    batch, sequences padded with "#"
+        :param lens:    tensor  batch, residues before padding, computed from the sequences if None
+        :return:        tensor  batch, len, hidden    zeros at padded positions
+        '''
+        if lens is None:
+            lens = torch.from_numpy(seq_lens(x))
+        x = torch.from_numpy(to_index(x)).cuda()
 
         x = self.embedding(x)
         # (batch, len, hidden)
-        x, _ = self.encoder(x)
+        x = packed_lstm(self.encoder, x, lens)
         # (batch, len, hidden)
 
         return x
 
 
 class BiLSTM(nn.Module):
+    accepts_lens = True         # forward takes per-sample lengths from collate_fn(return_lens=True)
+
     def __init__(self, embed_size=64, hidden=128, num_layers=2, dropout=0.1, use_pretrain=False):
         super(BiLSTM, self).__init__()
 
@@ -209,9 +224,9 @@ class BiLSTM(nn.Module):
             self.embedding = nn.Embedding(len(vocab), embed_size)
         
         proj_size = int(hidden/num_layers) if num_layers>1 else int(hidden/2)
-        self.LSTM_para = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size)
+        self.LSTM_para = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size, batch_first=True)
 
-        self.LSTM_epi = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size)
+        self.LSTM_epi = nn.LSTM(input_size=embed_size, hidden_size=hidden, num_layers=num_layers, bidirectional=True, proj_size=proj_size, batch_first=True)
         
         if self.use_pretrain:
             pass
@@ -228,8 +243,14 @@ class BiLSTM(nn.Module):
             self.output_layer = nn.Sequential(nn.Linear(hidden, hidden//2), nn.LeakyReLU(), nn.Dropout(dropout), \
                                               nn.Linear(hidden//2, 1), nn.Sigmoid())
     
-    def forward(self, para, epi):
-        
+    def forward(self, para, epi, para_len=None, epi_len=None):
+        '''
+        :param para:        list    batch, paratope sequences padded with "#"
+        :param epi:         list    batch, epitope sequences padded with "#"
+        :param para_len:    tensor  batch, residues before padding (from collate_fn with return_lens), 
+                                    computed from the sequences if None
+        :param epi_len:     tensor  batch
+        '''
         if self.use_pretrain:
             para, epi = get_embedding(para, epi)
             # print(para.shape, epi.shape)
@@ -251,26 +272,28 @@ class BiLSTM(nn.Module):
             return x
 
         else:
-            para, epi = torch.Tensor([to_onehot(i) for i in para]).int().cuda(), torch.Tensor([to_onehot(i) for i in epi]).int().cuda()
+            if para_len is None:
+                para_len = torch.from_numpy(seq_lens(para))
+            if epi_len is None:
+                epi_len = torch.from_numpy(seq_lens(epi))
+            # padding beyond the longest sequence in the batch is never read
+            para = torch.from_numpy(to_index(para)[:, :int(para_len.max())]).cuda()
+            epi = torch.from_numpy(to_index(epi)[:, :int(epi_len.max())]).cuda()
 
             # paratope
             para = self.embedding(para)
             # (batch, para_seq_length, hidden)
-            para, _ = self.LSTM_para(para)
+            para = packed_lstm(self.LSTM_para, para, para_len)
             # (batch, para_seq_length, hidden)
-            para = torch.mean(para, dim=1)
-            # (batch, 1, hidden)
-            para = para.squeeze(1)
+            para = masked_mean(para, para_len)
             # (batch, hidden)
             
             # epitope
             epi = self.embedding(epi)
             # (batch, epi_seq_length, hidden)
-            epi, _ = self.LSTM_epi(epi)        
+            epi = packed_lstm(self.LSTM_epi, epi, epi_len)
             # (batch, epi_seq_length, hidden)
-            epi = torch.mean(epi, dim=1)
-            # (batch, 1, hidden)
-            epi = epi.squeeze(1)
+            epi = masked_mean(epi, epi_len)
             # (batch, hidden)
 
             x = para * epi
@@ -6,9 +6,8 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 
-from dataset import *
-from utils import *
-from .common import *
+from utils import vocab, to_onehot
+from .common import get_embedding, CoAttention, kmer_embed, kmer_embed_mean, SequenceEncoder, fused_towers
 
 
 # Set Transformer Modules
@@ -104,6 +103,8 @@ class SetEncoder(nn.Module):
 
 
 class SetTransformer(nn.Module):
+    accepts_index = True        # forward also takes (batch, seq_len) token indices, as fold_stack.py passes under vmap
+
     def __init__(self, 
                  dim_input, 
                  num_outputs, 
@@ -115,7 +116,8 @@ class SetTransformer(nn.Module):
                  dropout=0.1, 
                  use_coattn=False, 
                  share=False, 
-                 use_BSS=False):
+                 use_BSS=False, 
+                 fuse_towers=True):
         super(SetTransformer, self).__init__()
 
         self.use_coattn = use_coattn
@@ -124,6 +126,7 @@ class SetTransformer(nn.Module):
         self.embedding = nn.Embedding(len(vocab), dim_input)
         
         self.share = share
+        self.fuse_towers = fuse_towers      # share==True: one pass of enc/dec over para and epi stacked
         if self.share==True:
             self.enc = nn.Sequential(
                     ISAB(dim_input, dim_hidden, num_heads, num_inds, ln=ln),
@@ -164,12 +167,24 @@ class SetTransformer(nn.Module):
 
     def forward(self, para, epi):
         # embedding
-        para, epi = torch.Tensor([to_onehot(i) for i in para]).int().cuda(), torch.Tensor([to_onehot(i) for i in epi]).int().cuda()
+        if not torch.is_tensor(para):
+            para, epi = torch.Tensor([to_onehot(i) for i in para]).int().cuda(), torch.Tensor([to_onehot(i) for i in epi]).int().cuda()
         para = self.embedding(para)
         epi = self.embedding(epi)
         # (batch, seq_len, embed_size) / (batch, num_inds, dim_input)
 
-        if self.share==True:
+        if self.share==True and getattr(self, "fuse_towers", False):
+            # encoder
+            para, epi = fused_towers(self.enc, para, epi)
+            # (batch, seq_len, hidden) / (batch, num_inds, dim_hidden)
+
+            if self.use_coattn==True:
+                para, epi = self.co_attn(para, epi)
+
+            # decoder
+            para, epi = fused_towers(self.dec, para, epi)
+            # (batch, seq_len, embed_size) / (batch, num_inds, dim_output)
+        elif self.share==True:
             # encoder
             para = self.enc(para)
             epi = self.enc(epi)
@@ -384,13 +399,15 @@ class SetModel(nn.Module):
                                                     embed_size=embed_size, 
                                                     hidden=hidden, 
                                                     dropout=dropout, 
-                                                    nhead=num_heads)
+                                                    nhead=num_heads, 
+                                                    k=k4kmer)
             self.seq_encoder_epi = SequenceEncoder(seq_encoder_type=self.seq_encoder_type, 
                                                    num_layers=num_layers, 
                                                    embed_size=embed_size, 
                                                    hidden=hidden, 
                                                    dropout=dropout, 
-                                                   nhead=num_heads)
+                                                   nhead=num_heads, 
+                                                   k=k4kmer)
         
         # set interaction
         self.para_enc = nn.Sequential(
@@ -425,6 +442,25 @@ class SetModel(nn.Module):
             self.output_layer = nn.Sequential(nn.Linear(embed_size, embed_size//2), nn.LeakyReLU(), nn.Dropout(dropout), \
                                               nn.Linear(embed_size//2, 1), nn.Sigmoid())
 
+    # 1. kmer sequential features
+    # (batch, seq_length, embed_size) -> (batch, seq_length-k+1, embed_size)
+    def kmer_features(self, x, seq_encoder):
+        seq_length = x.size(1)
+
+        # all windows in one pass
+        if self.seq_encoder_type=="window":
+            return seq_encoder(x)
+
+        x = kmer_embed(x, self.k4kmer)                      # (batch*(seq_length-k+1), k, embed_size)
+        if self.seq_encoder_type=="transformer":
+            x = seq_encoder(x)                              # (batch*(seq_length-k+1), k, embed_size)
+        elif self.seq_encoder_type=="lstm":
+            x, _ = seq_encoder(x)                           # (batch*(seq_length-k+1), k, embed_size)
+        x = torch.mean(x, dim=1)                            # (batch*(seq_length-k+1), 1, embed_size)
+        x = x.reshape(-1, seq_length-self.k4kmer+1, self.embed_size)
+
+        return x
+
     def forward(self, para, epi):
         
         if self.use_pretrain:
@@ -452,9 +488,7 @@ class SetModel(nn.Module):
 
             
             # 0. kmer embedding
-            para_seq_length = para.size(1)
             para = self.embedding(para)                     # (batch, para_seq_length, embed_size)
-            epi_seq_length = epi.size(1)
             epi = self.embedding(epi)                       # (batch, epi_seq_length, embed_size)
 
             # co-attn
@@ -465,13 +499,7 @@ class SetModel(nn.Module):
 
             # paratope
             # 1. kmer sequential features
-            para = kmer_embed(para, self.k4kmer)            # (batch*(para_seq_length-k+1), k, embed_size)
-            if self.seq_encoder_type=="transformer":
-                para = self.seq_encoder_para(para)          # (batch*(para_seq_length-k+1), k, embed_size)
-            elif self.seq_encoder_type=="lstm":
-                para, _ = self.seq_encoder_para(para)       # (batch*(para_seq_length-k+1), k, embed_size)
-            para = torch.mean(para, dim=1)                  # (batch*(para_seq_length-k+1), 1, embed_size)
-            para = para.reshape(-1, para_seq_length-self.k4kmer+1, self.embed_size)
+            para = self.kmer_features(para, self.seq_encoder_para)
                                                             # (batch, para_seq_length-k+1, embed_size)
             # 2. paratope set interaction
             para = self.para_enc(para)                      # (batch, para_seq_length-k+1, hidden)
@@ -480,13 +508,7 @@ class SetModel(nn.Module):
 
             # epitope
             # 1. kmer sequential features
-            epi = kmer_embed(epi, self.k4kmer)              # (batch*(epi_seq_length-k+1), k, embed_size)
-            if self.seq_encoder_type=="transformer":
-                epi = self.seq_encoder_epi(epi)             # (batch*(epi_seq_length-k+1), k, embed_size)
-            elif self.seq_encoder_type=="lstm":
-                epi, _ = self.seq_encoder_epi(epi)          # (batch*(epi_seq_length-k+1), k, embed_size)
-            epi = torch.mean(epi, dim=1)                    # (batch*(epi_seq_length-k+1), 1, embed_size)
-            epi = epi.reshape(-1, epi_seq_length-self.k4kmer+1, self.embed_size)
+            epi = self.kmer_features(epi, self.seq_encoder_epi)
                                                             # (batch, epi_seq_length-k+1, embed_size)
             # 2. epitope set interaction
             epi = self.epi_enc(epi)                         # (batch, epi_seq_length-k+1, hidden)
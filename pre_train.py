@@ -1,27 +1,24 @@
 import os
 import sys
-import copy
 import pickle
-import random
 import warnings
 warnings.filterwarnings('ignore')
-import argparse
+from functools import partial
 import numpy as np
-import pandas as pd
-from tqdm import tqdm
-from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
-import matplotlib.pyplot as plt
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
-import torch.nn.functional as F
-from Bio import Align
 
-from dataset import *
-from utils import *
-from models import *
-from cov_train import *
+from dataset import SAbDabDataset, SeqDataset, ESMFeatureStore, ESMFeatureDataset, collate_fn, pair_collate_fn, \
+                    esm_collate_fn
+from utils import set_seed, seq_lens
+from models import build_model, fused_towers, masked_mean
+from checkpoint import AsyncCheckpointWriter
+from metrics import evaluate_metrics
+from results_store import ResultsStore
+from telemetry import Telemetry
+from profiling import stage, start_timing, stop_timing, ModelProfiler
 
 
 def load_data(data_path):
@@ -43,120 +40,23 @@ def load_data(data_path):
     return data
 
 
-def prepare_lstm(config):
-
-    config["model"] = BiLSTM(embed_size=32, 
-                             hidden=64, 
-                             num_layers=1, 
-                             dropout=0.5, 
-                             use_pretrain=False).cuda()
-    config["epochs"] = 100
-    config["lr"] = 6e-5
-
-    return config
-
-
-def prepare_textcnn(config):
-    config["model"] = TextCNN(amino_ft_dim=len(vocab), 
-                              max_antibody_len=100, 
-                              max_virus_len=100, 
-                              h_dim=512, 
-                              dropout=0.1).cuda()
-    config["epochs"] = 100
-    config["lr"] = 1e-4
-
-    return config
-
-def prepare_masonscnn(config):
-    config["model"] = MasonsCNN(amino_ft_dim=len(vocab), 
-                                max_antibody_len=100, 
-                                max_virus_len=100, 
-                                h_dim=512, 
-                                dropout=0.1).cuda()
-    config["epochs"] = 300
-    config["lr"] = 1e-4
-    config["l2_coef"] = 5e-4
-
-    return config
-
-def prepare_ag_fast_parapred(config):
-    config["model"] = AgFastParapred(ft_dim=len(vocab), 
-                                     max_antibody_len=100, 
-                                     max_virus_len=100, 
-                                     h_dim=512, 
-                                     position_coding=True).cuda()
-    config["epochs"] = 100
-    config["lr"] = 1e-4
-
-    return config
-
-def prepare_pipr(config):
-    config["model"] = PIPR(protein_ft_one_hot_dim=len(vocab)).cuda()
-    
-    config["epochs"] = 300
-    config["lr"] = 1e-4
-
-    return config
-
-def prepare_resppi(config):
-    config["model"] = ResPPI(amino_ft_dim=len(vocab), 
-                             max_antibody_len=100, 
-                             max_virus_len=100, 
-                             h_dim=512, 
-                             dropout=0.1).cuda()
-    config["epochs"] = 300
-    config["lr"] = 1e-4
-
-    return config
-
-def prepare_deepaai(config):
-    pass
-
-def prepare_pesi(config):
-    config["model"] = SetTransformer(dim_input=32, 
-                                     num_outputs=32, 
-                                     dim_output=32, 
-                                     dim_hidden=128, 
-                                     num_inds=6, 
-                                     num_heads=4, 
-                                     ln=True, 
-                                     dropout=0.5, 
-                                     use_coattn=True, 
-                                     share=False).cuda()
-    
-    config["epochs"] = 500
-    config["lr"] = 6e-5
-    config["l2_coef"] = 5e-4
-
-    return config
+def pool_encoded(model, y, seqs):
+    # (batch, len, hidden) -> (batch, hidden), outputs of per-residue encoders (accepts_lens) are zero at the
+    # padding and are averaged over the residues only
+    if getattr(model, "accepts_lens", False):
+        return masked_mean(y, torch.from_numpy(seq_lens(seqs)))
+    return torch.mean(y, dim=1)
 
 
 def pre_train(config):
 
-    # model name
-    if config["model_name"]=="lstm":
-        config = prepare_lstm(config)
-    elif config["model_name"]=="textcnn":
-        config = prepare_textcnn(config)
-    elif config["model_name"]=="masonscnn":
-        config = prepare_masonscnn(config)
-    elif config["model_name"]=="ag_fast_parapred":
-        config = prepare_ag_fast_parapred(config)
-    elif config["model_name"]=="pipr":
-        config = prepare_pipr(config)
-    elif config["model_name"]=="resppi":
-        config = prepare_resppi(config)
-    elif config["model_name"]=="deepaai":
-        config = prepare_deepaai(config)
-    elif config["model_name"]=="pesi":
-        config = prepare_pesi(config)
-    else:
-        print("wrong model_name")
-        exit()
-
+    # model name, see models/build.py for the registered models and their hyperparameters
+    # pairwise pre-training trains the single-sequence encoder <model_name>_encoder (ENCODERS)
     if config["use_pair"]==True:
         config["model_name"] += "_encoder"
 
+    config = build_model(config, stage="pretrain")
+
     print("training {} on SAbDab-full".format(config["model_name"]))
     
     os.makedirs("./results/SAbDab/full/{}/{}/".format(config["data_type"], config["model_name"]), exist_ok=True)
@@ -180,7 +80,15 @@ def pre_train(config):
                                 is_train_test_full="full", 
                                 use_pair=config["use_pair"])
 
-    func = pair_collate_fn if config["use_pair"] else collate_fn
+    use_lens = getattr(config["model"], "accepts_lens", False)
+    func = pair_collate_fn if config["use_pair"] else partial(collate_fn, return_lens=use_lens)
+
+    # ESM-feature models read precomputed embeddings instead of running ESM every batch
+    if config.get("esm_store")!=None and getattr(config["model"], "use_pretrain", False)==True and config["use_pair"]==False:
+        store = ESMFeatureStore(config["esm_store"])
+        train_dataset = ESMFeatureDataset(train_dataset, store)
+        test_dataset = ESMFeatureDataset(test_dataset, store)
+        func = esm_collate_fn
     train_loader = torch.utils.data.DataLoader(train_dataset, 
                                                 batch_size=config["batch_size"], 
                                                 shuffle=False, 
@@ -377,72 +285,114 @@ def pre_train(config):
     best_train_loss = float("inf")
     best_val_loss = float("inf")
 
-    for epoch in range(config["epochs"]):
+    # checkpoints and metric files are written in the background, training does not wait on the disk
+    result_dir = "./results/SAbDab/full/{}/{}/".format(config["data_type"], config["model_name"])
+    store = ResultsStore(config["results_db"]) if config.get("results_db")!=None else None
+    writer = AsyncCheckpointWriter(max_pending=2, store=store)
+    key = {"stage": "pretrain", "dataset": "SAbDab/{}".format(config["data_type"]), "model": config["model_name"], 
+           "run": 0, "fold": 0}
+    if os.path.exists(result_dir+"history.jsonl"):
+        os.remove(result_dir+"history.jsonl")
+    telemetry = Telemetry(result_dir+"telemetry.jsonl", 
+                          every=config.get("telemetry_every", 50), 
+                          interval=config.get("log_interval", 30), 
+                          epochs=config["epochs"], 
+                          tag=config["model_name"])
+    # per-stage step times in the telemetry epoch records, a torch.profiler trace of a window of train steps
+    timer = start_timing(sync=config.get("sync_timers", False)) if config.get("stage_timers", False)==True else None
+    profiler = None
+    if config.get("profile_steps")!=None:
+        profiler = ModelProfiler(config["model"], result_dir+"profile/", 
+                                 start=config["profile_steps"][0], 
+                                 active=config["profile_steps"][1])
 
-        print("Epoch {}".format(epoch))
+    for epoch in range(config["epochs"]):
 
         loss_tmp = []
         if config["use_pair"]==False:
-            for i, (para, epi, label) in enumerate(tqdm(train_loader)):
+            for i, (para, epi, label, *lens) in enumerate(telemetry.iterate(train_loader)):
                 optimizer.zero_grad()
 
                 if config["use_pair"]==False:
-                    pred = config["model"](para, epi)
-                    loss = criterion(pred.view(-1), label.view(-1).cuda())
+                    with stage("forward"):
+                        pred = config["model"](para, epi, *lens)
+                    with stage("loss"):
+                        loss = criterion(pred.view(-1), label.view(-1).cuda())
 
-                if config["use_L2"] == True:
-                    param_l2_loss = 0
-                    for name, param in config["model"].named_parameters():
-                        if 'bias' not in name:
-                            param_l2_loss += torch.norm(param, p=2)
-                    param_l2_loss = config["l2_coef"] * param_l2_loss
-                    loss += param_l2_loss
+                with stage("regularization"):
+                    if config["use_L2"] == True:
+                        param_l2_loss = 0
+                        for name, param in config["model"].named_parameters():
+                            if 'bias' not in name:
+                                param_l2_loss += torch.norm(param, p=2)
+                        param_l2_loss = config["l2_coef"] * param_l2_loss
+                        loss += param_l2_loss
 
-                loss.backward()
+                with stage("backward"):
+                    loss.backward()
 
-                torch.nn.utils.clip_grad_norm_(config["model"].parameters(), config["clip_norm"])
+                with stage("clip_grad"):
+                    torch.nn.utils.clip_grad_norm_(config["model"].parameters(), config["clip_norm"])
 
-                optimizer.step()
+                with stage("optimizer"):
+                    optimizer.step()
 
-                loss_tmp.append(loss.item())
+                with stage("sync"):
+                    loss_tmp.append(loss.item())
+                telemetry.update(loss=loss_tmp[-1])
+                if profiler is not None:
+                    profiler.step()
                 
             loss_buf.append(np.mean(loss_tmp))
                 
         elif config["use_pair"]==True:
-            for i, (para, epi_pos, epi_neg) in enumerate(tqdm(train_loader)):
+            for i, (para, epi_pos, epi_neg) in enumerate(telemetry.iterate(train_loader)):
                 optimizer.zero_grad()
 
-                y_pred_anc = config["model"](para)
-                y_pred_pos = config["model"](epi_pos)
-                y_pred_neg = config["model"](epi_neg)
+                with stage("forward"):
+                    if config["fuse_towers"]==True:
+                        y_pred_anc, y_pred_pos, y_pred_neg = fused_towers(config["model"], para, epi_pos, epi_neg)
+                    else:
+                        y_pred_anc = config["model"](para)
+                        y_pred_pos = config["model"](epi_pos)
+                        y_pred_neg = config["model"](epi_neg)
                 
-                if len(y_pred_anc.shape)==3:
-                    y_pred_anc = torch.nn.functional.normalize(torch.mean(y_pred_anc, dim=1), p=2, dim=1)
-                    y_pred_pos = torch.nn.functional.normalize(torch.mean(y_pred_pos, dim=1), p=2, dim=1)
-                    y_pred_neg = torch.nn.functional.normalize(torch.mean(y_pred_neg, dim=1), p=2, dim=1)
-                
-                elif len(y_pred_anc.shape)==2:
-                    y_pred_anc = torch.nn.functional.normalize(y_pred_anc, p=2, dim=1)
-                    y_pred_pos = torch.nn.functional.normalize(y_pred_pos, p=2, dim=1)
-                    y_pred_neg = torch.nn.functional.normalize(y_pred_neg, p=2, dim=1)
-                
-                loss = - (torch.dist(y_pred_anc, y_pred_pos, 2) - torch.dist(y_pred_anc, y_pred_neg, 2)).sigmoid().log().sum()
+                with stage("loss"):
+                    if len(y_pred_anc.shape)==3:
+                        y_pred_anc = torch.nn.functional.normalize(pool_encoded(config["model"], y_pred_anc, para), p=2, dim=1)
+                        y_pred_pos = torch.nn.functional.normalize(pool_encoded(config["model"], y_pred_pos, epi_pos), p=2, dim=1)
+                        y_pred_neg = torch.nn.functional.normalize(pool_encoded(config["model"], y_pred_neg, epi_neg), p=2, dim=1)
+                    
+                    elif len(y_pred_anc.shape)==2:
+                        y_pred_anc = torch.nn.functional.normalize(y_pred_anc, p=2, dim=1)
+                        y_pred_pos = torch.nn.functional.normalize(y_pred_pos, p=2, dim=1)
+                        y_pred_neg = torch.nn.functional.normalize(y_pred_neg, p=2, dim=1)
+                    
+                    loss = - (torch.dist(y_pred_anc, y_pred_pos, 2) - torch.dist(y_pred_anc, y_pred_neg, 2)).sigmoid().log().sum()
 
-                if config["use_L2"] == True:
-                    param_l2_loss = 0
-                    for name, param in config["model"].named_parameters():
-                        if 'bias' not in name:
-                            param_l2_loss += torch.norm(param, p=2)
-                    param_l2_loss = config["l2_coef"] * param_l2_loss
-                    loss += param_l2_loss
+                with stage("regularization"):
+                    if config["use_L2"] == True:
+                        param_l2_loss = 0
+                        for name, param in config["model"].named_parameters():
+                            if 'bias' not in name:
+                                param_l2_loss += torch.norm(param, p=2)
+                        param_l2_loss = config["l2_coef"] * param_l2_loss
+                        loss += param_l2_loss
 
-                loss.backward()
+                with stage("backward"):
+                    loss.backward()
 
-                torch.nn.utils.clip_grad_norm_(config["model"].parameters(), config["clip_norm"])
+                with stage("clip_grad"):
+                    torch.nn.utils.clip_grad_norm_(config["model"].parameters(), config["clip_norm"])
 
-                optimizer.step()
+                with stage("optimizer"):
+                    optimizer.step()
 
-                loss_tmp.append(loss.item())
+                with stage("sync"):
+                    loss_tmp.append(loss.item())
+                telemetry.update(loss=loss_tmp[-1])
+                if profiler is not None:
+                    profiler.step()
 
             loss_buf.append(np.mean(loss_tmp))
         else:
@@ -450,7 +400,6 @@ def pre_train(config):
             exit()
             
     #     scheduler.step()
-        print("lr: ", optimizer.param_groups[0]['lr'])
 #         print("train loss {:.4f}\n".format(np.mean(loss_buf)))
 
 
@@ -464,35 +413,40 @@ def pre_train(config):
                 preds = []
                 labels = []
                 val_loss_tmp = []
-                for i, (para, epi, label) in enumerate(tqdm(test_loader)):
+                for i, (para, epi, label, *lens) in enumerate(telemetry.iterate(test_loader, phase="val")):
 
-                    pred = config["model"](para, epi)
-                    val_loss = criterion(pred.view(-1), label.view(-1).cuda())
+                    with stage("eval_forward"):
+                        pred = config["model"](para, epi, *lens)
+                    with stage("eval_loss"):
+                        val_loss = criterion(pred.view(-1), label.view(-1).cuda())
 
-                    preds.append(pred.detach().cpu().view(-1))
-                    labels.append(label.view(-1))
-                    val_loss_tmp.append(val_loss.item())
+                        preds.append(pred.detach().cpu().view(-1))
+                        labels.append(label.view(-1))
+                        val_loss_tmp.append(val_loss.item())
 
-                preds = torch.hstack(preds).view(-1)
-                labels = torch.hstack(labels).view(-1)
+                with stage("eval_metrics"):
+                    preds = torch.hstack(preds).view(-1)
+                    labels = torch.hstack(labels).view(-1)
 
-                acc = accuracy_score(y_true=labels, y_pred=torch.round(preds))
-                f1 = f1_score(y_true=labels, y_pred=torch.round(preds))
-                auc = roc_auc_score(y_true=labels, y_score=preds)
+                    acc, f1, auc, _, _ = evaluate_metrics(pred_proba=preds, label=labels)
 
                 val_acc_buf.append(acc)
                 val_f1_buf.append(f1)
                 val_auc_buf.append(auc)
                 val_loss_buf.append(np.mean(val_loss_tmp))
 
-                print("Epoch {}: \n Train Loss\t{:.4f} \n Val Loss\t{:.4f} \n Val Acc\t{:.4f} \n Val F1\t\t{:.4f} \n Val AUC\t{:.4f}".format(epoch, np.mean(loss_buf), np.mean(val_loss_buf), acc, f1, auc))
-
-                if np.mean(val_loss_tmp)<best_val_loss:
+                record = {"epoch": epoch, "loss": float(loss_buf[-1]), "val_loss": float(val_loss_buf[-1]), 
+                          "acc": float(acc), "f1": float(f1), "auc": float(auc)}
+                telemetry.end_epoch(record)
+                is_best = np.mean(val_loss_tmp)<best_val_loss
+                if is_best:
                     best_val_loss = np.mean(val_loss_tmp)
-                    torch.save(config["model"], "./results/SAbDab/full/{}/{}/model_best.pth".format(config["data_type"], config["model_name"]))
-                    np.save("./results/SAbDab/full/{}/{}/val_acc_best.npy".format(config["data_type"], config["model_name"]), acc)
-                    np.save("./results/SAbDab/full/{}/{}/val_f1_best.npy".format(config["data_type"], config["model_name"]), f1)
-                    np.save("./results/SAbDab/full/{}/{}/val_auc_best.npy".format(config["data_type"], config["model_name"]), auc)
+                writer.epoch(result_dir+"history.jsonl", record, 
+                             model=config["model"] if is_best else None, 
+                             ckpt_path=result_dir+"model_best.pth", 
+                             best_arrays={result_dir+"val_{}_best.npy".format(m): record[m] for m in ["acc", "f1", "auc"]} 
+                                         if store is None else None, 
+                             key=key)
 
         elif config["use_pair"]==True:
 #             if np.mean(loss_tmp)<best_train_loss:
@@ -505,16 +459,20 @@ def pre_train(config):
                 preds = []
                 labels = []
                 val_loss_tmp = []
-                for i, (para1, epi_pos1, epi_neg1) in enumerate(tqdm(test_loader)):
-
-                    y_pred_anc1 = config["model"](para1)
-                    y_pred_pos1 = config["model"](epi_pos1)
-                    y_pred_neg1 = config["model"](epi_neg1)
+                for i, (para1, epi_pos1, epi_neg1) in enumerate(telemetry.iterate(test_loader, phase="val")):
+
+                    with stage("eval_forward"):
+                        if config["fuse_towers"]==True:
+                            y_pred_anc1, y_pred_pos1, y_pred_neg1 = fused_towers(config["model"], para1, epi_pos1, epi_neg1)
+                        else:
+                            y_pred_anc1 = config["model"](para1)
+                            y_pred_pos1 = config["model"](epi_pos1)
+                            y_pred_neg1 = config["model"](epi_neg1)
                     
                     if len(y_pred_anc1.shape)==3:
-                        y_pred_anc1 = torch.nn.functional.normalize(torch.mean(y_pred_anc1, dim=1), p=2, dim=1)
-                        y_pred_pos1 = torch.nn.functional.normalize(torch.mean(y_pred_pos1, dim=1), p=2, dim=1)
-                        y_pred_neg1 = torch.nn.functional.normalize(torch.mean(y_pred_neg1, dim=1), p=2, dim=1)
+                        y_pred_anc1 = torch.nn.functional.normalize(pool_encoded(config["model"], y_pred_anc1, para1), p=2, dim=1)
+                        y_pred_pos1 = torch.nn.functional.normalize(pool_encoded(config["model"], y_pred_pos1, epi_pos1), p=2, dim=1)
+                        y_pred_neg1 = torch.nn.functional.normalize(pool_encoded(config["model"], y_pred_neg1, epi_neg1), p=2, dim=1)
 
                     elif len(y_pred_anc1.shape)==2:
                         y_pred_anc1 = torch.nn.functional.normalize(y_pred_anc1, p=2, dim=1)
@@ -534,11 +492,15 @@ def pre_train(config):
                     val_loss_tmp.append(val_loss.item())
 
                 val_loss_buf.append(np.mean(val_loss_tmp))
-                print("Epoch {}: \n Train Loss\t{:.4f} \n Val Loss\t{:.4f}\n".format(epoch, np.mean(loss_buf), np.mean(val_loss_buf)))
-
-                if np.mean(val_loss_tmp)<best_val_loss:
+                record = {"epoch": epoch, "loss": float(loss_buf[-1]), "val_loss": float(val_loss_buf[-1])}
+                telemetry.end_epoch(record)
+                is_best = np.mean(val_loss_tmp)<best_val_loss
+                if is_best:
                     best_val_loss = np.mean(val_loss_tmp)
-                    torch.save(config["model"], "./results/SAbDab/full/{}/{}/model_best.pth".format(config["data_type"], config["model_name"]))
+                writer.epoch(result_dir+"history.jsonl", record, 
+                             model=config["model"] if is_best else None, 
+                             ckpt_path=result_dir+"model_best.pth", 
+                             key=key)
         else:
             print("Wrong")
             exit()
@@ -550,14 +512,21 @@ def pre_train(config):
 
 
 
-    torch.save(config["model"], "./results/SAbDab/full/{}/{}/model.pth".format(config["data_type"], config["model_name"]))
-    np.save("./results/SAbDab/full/{}/{}/loss_buf.npy".format(config["data_type"], config["model_name"]), np.array(loss_buf))
-    np.save("./results/SAbDab/full/{}/{}/val_loss_buf.npy".format(config["data_type"], config["model_name"]), np.array(val_loss_buf))
-    if config["use_pair"]==False:
+    telemetry.close()
+    if profiler is not None:
+        profiler.close()
+    if timer is not None:
+        print(stop_timing().table())
+    writer.save(config["model"], result_dir+"model.pth")
+    if store is None:
+        writer.arrays({result_dir+"loss_buf.npy": np.array(loss_buf), 
+                       result_dir+"val_loss_buf.npy": np.array(val_loss_buf)})
+    if config["use_pair"]==False and store is None:
         
-        np.save("./results/SAbDab/full/{}/{}/val_acc_buf.npy".format(config["data_type"], config["model_name"]), np.array(val_acc_buf))
-        np.save("./results/SAbDab/full/{}/{}/val_f1_buf.npy".format(config["data_type"], config["model_name"]), np.array(val_f1_buf))
-        np.save("./results/SAbDab/full/{}/{}/val_auc_buf.npy".format(config["data_type"], config["model_name"]), np.array(val_auc_buf))
+        writer.arrays({result_dir+"val_acc_buf.npy": np.array(val_acc_buf), 
+                       result_dir+"val_f1_buf.npy": np.array(val_f1_buf), 
+                       result_dir+"val_auc_buf.npy": np.array(val_auc_buf)})
+    writer.close()
 
 
     #     break
@@ -592,12 +561,20 @@ if __name__=='__main__':
         "test_data_path": "../SARS-SAbDab_Shaun/CoV-AbDab_extract.csv", 
                                                 # data path for SARS-CoV-2 antibody-antigen dataset
         "use_cache": True,                      # whether using cached pair data
+        "esm_store": None,                      # directory written by precompute_esm.py, for use_pretrain models
+        "results_db": "./results/results.db",   # SQLite results store (results_store.py), None for per-metric .npy files
+        "telemetry_every": 50,                  # train steps per telemetry.jsonl step record (telemetry.py)
+        "log_interval": 30,                     # minimum seconds between console epoch lines
+        "stage_timers": False,                  # per-stage step timings (profiling.py) in the telemetry records
+        "sync_timers": False,                   # synchronise CUDA around the stages, exact but slower
+        "profile_steps": None,                  # [skip, active]: torch.profiler trace of `active` train steps
         
 
         # pre-training params
         "use_L2": False,                        # whether using L2 regularisation for pre-training
         "use_pair": False,                      # whether using pairwise pre-training or not
         "num_neg": 4,                           # number of negative samples per positive pair
+        "fuse_towers": True,                    # pairwise pre-training: encode anchor/pos/neg in one batched pass
         "use_reg": 0,                           # regularisation type: 0 - L2; 1 - L1
         "use_BSS": False,                       # Batch Spectral Shrinkage regularisation
 
@@ -0,0 +1,103 @@
+import os
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from utils import *
+from models.common import ESMEmbedder
+
+
+# precompute ESM-2 features of every unique sequence for dataset.ESMFeatureStore
+# python precompute_esm.py --pair_data ./data/processed_data_clip1_neg0.pkl --csv ../SARS-SAbDab_Shaun/CoV-AbDab_extract.csv
+
+
+def collect_sequences(pair_data_paths, csv_paths):
+    seqs = {}
+
+    for path in pair_data_paths:
+        print("reading pairs from {}".format(path))
+        for pair in pickle.load(open(path, "rb")):
+            for entry in pair:
+                if isinstance(entry, str):
+                    seqs.setdefault(seq_key(entry), strip_seq(entry))
+
+    for path in csv_paths:
+        print("reading pairs from {}".format(path))
+        data_df = pd.read_csv(path)
+        for col in ["Paratope", "Epitope"]:
+            for entry in data_df[col]:
+                seqs.setdefault(seq_key(entry), strip_seq(entry))
+
+    return seqs
+
+
+def precompute(seqs, out_path, embedder, per_residue=False, chunk_size=2048):
+    '''
+    :param seqs:        {seq_key: stripped sequence}
+    :param out_path:    directory of the store
+    :param embedder:    ESMEmbedder
+    :param per_residue: also write float16 per-residue features
+    :param chunk_size:  number of sequences embedded between writes
+    '''
+    os.makedirs(out_path, exist_ok=True)
+
+    keys = sorted(seqs.keys())
+    embed_size = embedder.embed_size
+
+    means = np.lib.format.open_memmap(os.path.join(out_path, "means.npy"), mode="w+",
+                                      dtype=np.float32, shape=(len(keys), embed_size))
+    if per_residue:
+        # every residue of a stripped sequence is one ESM token
+        offsets = np.zeros(len(keys)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(seqs[key]) for key in keys])
+        residues = np.lib.format.open_memmap(os.path.join(out_path, "residues.npy"), mode="w+",
+                                             dtype=np.float16, shape=(int(offsets[-1]), embed_size))
+        np.save(os.path.join(out_path, "offsets.npy"), offsets)
+
+    for start in tqdm(range(0, len(keys), chunk_size)):
+        chunk = [ESMEmbedder.clean(seqs[key]) for key in keys[start:start+chunk_size]]
+        chunk_means, chunk_residues = embedder.run(chunk, per_residue=per_residue)
+
+        means[start:start+len(chunk)] = chunk_means.numpy()
+        if per_residue:
+            for i, rep in enumerate(chunk_residues):
+                row = start + i
+                residues[offsets[row]:offsets[row+1]] = rep.numpy().astype(np.float16)
+
+    means.flush()
+    if per_residue:
+        residues.flush()
+
+    # the index is written last, a store without it is incomplete
+    meta = {"model_name": embedder.model_name,
+            "repr_layer": embedder.repr_layer,
+            "keys": {key: row for row, key in enumerate(keys)}}
+    pickle.dump(meta, open(os.path.join(out_path, "index.pkl"), "wb"))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pair_data", type=str, nargs="*", default=["./data/processed_data_clip1_neg0.pkl"],
+                        help="processed SAbDab pair pickles")
+    parser.add_argument("--csv", type=str, nargs="*", default=["../SARS-SAbDab_Shaun/CoV-AbDab_extract.csv"],
+                        help="CoV-AbDab csv files with Paratope and Epitope columns")
+    parser.add_argument("--out", type=str, default="./data/esm_store/", help="output directory")
+    parser.add_argument("--model_name", type=str, default="esm2_t6_8M_UR50D")
+    parser.add_argument("--repr_layer", type=int, default=6)
+    parser.add_argument("--max_tokens", type=int, default=16384, help="token budget of one ESM forward pass")
+    parser.add_argument("--device", type=str, default=None, help="cuda or cpu, default cuda if available")
+    parser.add_argument("--per_residue", action="store_true", help="also store float16 per-residue features")
+    args = parser.parse_args()
+
+    seqs = collect_sequences(args.pair_data, args.csv)
+    print("{} unique sequences".format(len(seqs)))
+
+    embedder = ESMEmbedder(model_name=args.model_name,
+                           repr_layer=args.repr_layer,
+                           max_tokens=args.max_tokens,
+                           device=args.device,
+                           use_cache=False)
+    precompute(seqs, args.out, embedder, per_residue=args.per_residue)
+    print("ESM store written to {}".format(args.out))
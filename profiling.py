@@ -0,0 +1,280 @@
+import os
+import sys
+import time
+import math
+import functools
+import contextlib
+from collections import defaultdict
+
+
+# hot-path instrumentation of the training step, config "stage_timers" / "profile_steps" of cov_train / pre_train
+# stage timers:
+#   with stage("forward"): ...          named scope, a no-op unless start_timing() was called
+#   @timed("tokenize")                  the same for a function (utils.to_onehot / to_index / seq_pad_clip)
+# - scopes nest and are recorded by their path ("forward/tokenize", "eval_forward/tokenize") with their self time,
+#   so the stages of a step add up to the step; the time of a step is summed over its calls (one per sequence
+#   for to_onehot) and timer.step() closes the step
+# - summaries give count, total, mean / p50 / p90 / p99 / max in ms and a histogram of power-of-two ms buckets
+# - CUDA runs asynchronously: without sync a stage measures its launch cost and the wait lands in whichever
+#   stage synchronises next (loss.item() after optimizer); sync=True synchronises around top-level scopes
+# torch.profiler window:
+#   ModelProfiler(model, out_dir, start=20, active=5), .step() after every train step
+# - exports a Chrome trace (chrome://tracing, ui.perfetto.dev) and a table of operator costs per submodule
+#   (para_enc.0.mab0), from record_function ranges that forward hooks open around every submodule
+# - backward ops run outside the module ranges, they show in the trace and in the "backward" stage
+
+NULL = contextlib.nullcontext()
+
+_timer = None
+
+
+def cuda_sync():
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+class StageTimer(object):
+    def __init__(self, sync=False):
+        '''
+        :param sync:    synchronise CUDA around top-level scopes, exact stage times at the cost of the overlap
+        '''
+        self.sync = sync
+        self.stack = []                     # [name, child time] of the open scopes
+        self.current = defaultdict(float)   # self time of the current step per stage path
+        self.samples = defaultdict(list)    # per-step times per stage path, of the current epoch
+        self.history = defaultdict(list)    # per-step times per stage path, of the previous epochs
+
+    @contextlib.contextmanager
+    def scope(self, name):
+        top = len(self.stack)==0
+        if self.sync and top:
+            cuda_sync()
+        self.stack.append([name, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync and top:
+                cuda_sync()
+            total = time.perf_counter() - start
+            path = "/".join(s[0] for s in self.stack)
+            _, child = self.stack.pop()
+            self.current[path] += total - child
+            if len(self.stack)>0:
+                self.stack[-1][1] += total
+
+    def add(self, name, seconds):
+        # time measured outside a scope (the data loader wait), nested in the open scopes like one
+        path = "/".join([s[0] for s in self.stack] + [name])
+        self.current[path] += seconds
+        if len(self.stack)>0:
+            self.stack[-1][1] += seconds
+
+    def step(self):
+        for path, seconds in self.current.items():
+            self.samples[path].append(seconds)
+        self.current.clear()
+
+    def summary(self, everything=False):
+        '''
+        :param everything:  all epochs, else the current one
+        :return:            {stage path: {"count", "total_s", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms", "hist"}},
+                            hist maps the upper bound of a power-of-two ms bucket to its count
+        '''
+        stages = self.samples
+        if everything:
+            stages = {path: self.history.get(path, []) + self.samples.get(path, [])
+                      for path in set(self.history) | set(self.samples)}
+        out = {}
+        for path, samples in stages.items():
+            ms = sorted(s * 1e3 for s in samples)
+            hist = defaultdict(int)
+            for t in ms:
+                hist[2 ** max(math.ceil(math.log2(t)), -4) if t>0 else 2 ** -4] += 1
+            out[path] = {"count": len(ms),
+                         "total_s": sum(ms) / 1e3,
+                         "mean_ms": sum(ms) / len(ms),
+                         "p50_ms": percentile(ms, 50),
+                         "p90_ms": percentile(ms, 90),
+                         "p99_ms": percentile(ms, 99),
+                         "max_ms": ms[-1],
+                         "hist": {"{:g}".format(k): v for k, v in sorted(hist.items())}}
+        return out
+
+    def next_epoch(self):
+        for path, samples in self.samples.items():
+            self.history[path].extend(samples)
+        self.samples.clear()
+
+    def table(self):
+        # all epochs, slowest stage first
+        summary = self.summary(everything=True)
+        step_total = sum(s["total_s"] for path, s in summary.items() if not path.startswith("eval"))
+        lines = ["{:<32}{:>8}{:>10}{:>10}{:>10}{:>10}{:>8}".format("stage", "count", "mean ms", "p50 ms",
+                                                                 "p99 ms", "total s", "share")]
+        for path, s in sorted(summary.items(), key=lambda x: -x[1]["total_s"]):
+            share = "" if path.startswith("eval") or step_total==0 else "{:.0%}".format(s["total_s"] / step_total)
+            lines.append("{:<32}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.2f}{:>8}".format(
+                path, s["count"], s["mean_ms"], s["p50_ms"], s["p99_ms"], s["total_s"], share))
+        return "\n".join(lines)
+
+
+def percentile(sorted_values, q):
+    # linear interpolation between the closest ranks, as numpy.percentile
+    pos = (len(sorted_values) - 1) * q / 100
+    lo, hi = int(math.floor(pos)), int(math.ceil(pos))
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def start_timing(sync=False):
+    global _timer
+    _timer = StageTimer(sync=sync)
+    return _timer
+
+
+def stop_timing():
+    global _timer
+    timer, _timer = _timer, None
+    return timer
+
+
+def current_timer():
+    return _timer
+
+
+def stage(name):
+    return NULL if _timer is None else _timer.scope(name)
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _timer is None:
+                return func(*args, **kwargs)
+            with _timer.scope(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ModelProfiler(object):
+    def __init__(self, model, out_dir, start=20, active=5, tag="train"):
+        '''
+        :param model:   module whose submodules are labelled in the profile
+        :param out_dir: folder of trace_<tag>.json and profile_<tag>.txt
+        :param start:   train steps skipped before the window (the first one is a profiler warm-up step)
+        :param active:  train steps recorded
+        :param tag:     suffix of the output files, e.g. the fold
+        '''
+        import torch
+        from torch.profiler import profile, schedule, ProfilerActivity
+
+        self.torch = torch
+        self.model = model
+        self.out_dir = out_dir
+        self.tag = tag
+        self.handles = []
+        self.exported = False
+        self.done = False
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        self.prof = profile(activities=activities,
+                            schedule=schedule(skip_first=max(start-1, 0), wait=0, warmup=1, active=active, repeat=1),
+                            on_trace_ready=self.export,
+                            record_shapes=True)
+        self.label_modules()
+        self.prof.__enter__()
+
+    def label_modules(self):
+        record_function = self.torch.autograd.profiler.record_function
+
+        def pre_hook(name, module, inputs):
+            rf = record_function("module::" + name)
+            rf.__enter__()
+            module.__dict__.setdefault("_profile_ranges", []).append(rf)
+
+        def hook(module, inputs, output):
+            module.__dict__["_profile_ranges"].pop().__exit__(None, None, None)
+
+        for name, module in self.model.named_modules():
+            if name=="":
+                continue
+            self.handles.append(module.register_forward_pre_hook(functools.partial(pre_hook, name)))
+            self.handles.append(module.register_forward_hook(hook))
+
+    def step(self):
+        if not self.done:
+            self.prof.step()
+            # the window is over, stop recording and remove the hooks
+            if self.exported:
+                self.close()
+
+    def export(self, prof):
+        os.makedirs(self.out_dir, exist_ok=True)
+        trace_path = os.path.join(self.out_dir, "trace_{}.json".format(self.tag))
+        prof.export_chrome_trace(trace_path)
+
+        table = "\n\n".join([module_table(prof.events()),
+                             prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=30)])
+        with open(os.path.join(self.out_dir, "profile_{}.txt".format(self.tag)), "w") as f:
+            f.write(table + "\n")
+        print("profile written to {} ({})".format(self.out_dir, trace_path))
+        print(module_table(prof.events(), limit=15))
+        self.exported = True
+
+    def close(self):
+        if self.done:
+            return
+        self.done = True
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.prof.__exit__(None, None, None)
+
+
+def device_time(event):
+    # renamed from cuda_time_total in torch 2.4
+    return getattr(event, "device_time_total", None) or getattr(event, "cuda_time_total", 0) or 0
+
+
+def module_table(events, limit=None):
+    '''
+    operator costs grouped by submodule: total time of the module range and self time without its submodules
+
+    :param events:  profiler events (prof.events())
+    :return:        table as a string, slowest self time first
+    '''
+    rows = defaultdict(lambda: [0, 0.0, 0.0, 0.0, 0.0])     # calls, cpu total, cpu self, device total, device self
+
+    def nested_modules(event):
+        # closest module ranges below event
+        out = []
+        for child in event.cpu_children:
+            if child.name.startswith("module::"):
+                out.append(child)
+            else:
+                out.extend(nested_modules(child))
+        return out
+
+    for event in events:
+        if not event.name.startswith("module::"):
+            continue
+        children = nested_modules(event)
+        row = rows[event.name[len("module::"):]]
+        row[0] += 1
+        row[1] += event.cpu_time_total
+        row[2] += event.cpu_time_total - sum(c.cpu_time_total for c in children)
+        row[3] += device_time(event)
+        row[4] += device_time(event) - sum(device_time(c) for c in children)
+
+    lines = ["{:<48}{:>8}{:>14}{:>14}{:>14}{:>14}".format("module", "calls", "cpu total ms", "cpu self ms",
+                                                         "cuda total ms", "cuda self ms")]
+    ordered = sorted(rows.items(), key=lambda x: -max(x[1][2], x[1][4]))
+    for name, (calls, cpu, cpu_self, dev, dev_self) in ordered[:limit]:
+        lines.append("{:<48}{:>8}{:>14.3f}{:>14.3f}{:>14.3f}{:>14.3f}".format(
+            name, calls, cpu / 1e3, cpu_self / 1e3, dev / 1e3, dev_self / 1e3))
+    return "\n".join(lines)
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import argparse
+import math
+
+
+# one SQLite table of every training epoch, replacing the per-metric .npy files of cov_train.py / pre_train.py
+#   epochs: one row per (stage, dataset, model, run, fold, epoch) with the train / val loss and the val metrics
+#   best:   1 on the epochs that improved the best val loss of their fold so far
+# rows are buffered by ResultsStore and inserted in batches from the checkpoint writer thread
+# python results_store.py ./results/results.db --stage cov           mean of the best epochs per model
+
+METRICS = ["acc", "f1", "auc", "gmean", "mcc"]
+COLUMNS = ["stage", "dataset", "model", "run", "fold", "epoch", "loss", "val_loss"] + METRICS + ["best"]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS epochs (
+    stage TEXT NOT NULL,
+    dataset TEXT NOT NULL,
+    model TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    fold INTEGER NOT NULL,
+    epoch INTEGER NOT NULL,
+    loss REAL,
+    val_loss REAL,
+    acc REAL,
+    f1 REAL,
+    auc REAL,
+    gmean REAL,
+    mcc REAL,
+    best INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (stage, dataset, model, run, fold, epoch)
+)
+'''
+
+# best epoch of every fold: lowest val loss, the first one on ties (training keeps the first)
+BEST = '''
+SELECT * FROM (
+    SELECT *, ROW_NUMBER() OVER (PARTITION BY stage, dataset, model, run, fold ORDER BY val_loss, epoch) AS r
+    FROM epochs WHERE stage=? {where}
+) WHERE r=1
+'''
+
+
+def connect(path):
+    # several fold_scheduler workers may write at once, WAL lets them wait for each other instead of failing
+    con = sqlite3.connect(path, timeout=60)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(SCHEMA)
+    return con
+
+
+class ResultsStore(object):
+    def __init__(self, path, batch_size=64):
+        '''
+        :param path:        SQLite file, created if missing
+        :param batch_size:  rows buffered before an insert
+        '''
+        self.path = path
+        self.batch_size = batch_size
+        self.rows = []
+        if os.path.dirname(path)!="":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        connect(path).close()
+
+    def append(self, row):
+        # row: {column: value}, missing metrics are stored as NULL
+        self.rows.append(tuple(row.get(c) if c!="best" else int(row.get(c, False)) for c in COLUMNS))
+        if len(self.rows)>=self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows)==0:
+            return
+        con = connect(self.path)
+        with con:
+            con.executemany("INSERT OR REPLACE INTO epochs ({}) VALUES ({})".format(
+                ", ".join(COLUMNS), ", ".join("?"*len(COLUMNS))), self.rows)
+        con.close()
+        self.rows = []
+
+
+def query(path, sql, args=()):
+    con = connect(path)
+    try:
+        cursor = con.execute(sql, args)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+    finally:
+        con.close()
+
+
+def best_epochs(path, model=None, stage="cov", dataset=None, run=None):
+    '''
+    :return:    best-epoch rows of every fold, ordered by model, run, fold
+    '''
+    where = ""
+    args = [stage]
+    for column, value in [("model", model), ("dataset", dataset), ("run", run)]:
+        if value is not None:
+            where += " AND {}=?".format(column)
+            args.append(value)
+    return query(path, BEST.format(where=where) + " ORDER BY model, run, fold", args)
+
+
+def latest_run(path, model, stage="cov", dataset="CoV-AbDab"):
+    rows = query(path, "SELECT MAX(run) AS run FROM epochs WHERE stage=? AND dataset=? AND model=?",
+                 (stage, dataset, model))
+    return rows[0]["run"]
+
+
+def evaluate(path, model_name, run=None, dataset="CoV-AbDab"):
+    '''
+    metrics.evaluate from the store: per-fold best metrics of one run, the latest if run is None
+
+    :return:    model_name, and the per-fold lists of acc, f1, auc, gmean, mcc
+    '''
+    from metrics import summarize
+
+    run = latest_run(path, model_name, dataset=dataset) if run is None else run
+    rows = best_epochs(path, model=model_name, stage="cov", dataset=dataset, run=run)
+    return summarize(model_name, [[row[m] for m in METRICS] for row in rows])
+
+
+def summary(path, stage="cov", dataset=None):
+    '''
+    mean and standard deviation of the best-epoch metrics of every model, over all its runs and folds
+
+    :return:    [{"model", "dataset", "runs", "folds", "<metric>", "<metric>_std"}]
+    '''
+    where = "" if dataset is None else " AND dataset=?"
+    args = [stage] + ([] if dataset is None else [dataset])
+    # SQLite has no stddev, it is computed from the mean of squares
+    sql = ("SELECT model, dataset, COUNT(DISTINCT run) AS runs, COUNT(*) AS folds, " +
+           ", ".join("AVG({0}) AS {0}, AVG({0}*{0}) AS {0}_sq".format(m) for m in METRICS) +
+           " FROM (" + BEST.format(where=where) + ") GROUP BY model, dataset ORDER BY model")
+    rows = query(path, sql, args)
+    for row in rows:
+        for m in METRICS:
+            sq = row.pop(m+"_sq")
+            row[m+"_std"] = math.sqrt(max(sq - row[m]**2, 0)) if row[m] is not None else None
+    return rows
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="best-epoch metrics of every model in a results store")
+    parser.add_argument("path", type=str, nargs="?", default="./results/results.db")
+    parser.add_argument("--stage", type=str, default="cov", choices=["cov", "pretrain"])
+    parser.add_argument("--dataset", type=str, default=None)
+    args = parser.parse_args()
+
+    print("{:<40}{:>6}{:>7}".format("model", "runs", "folds") + "".join("{:>18}".format(m) for m in METRICS))
+    for row in summary(args.path, stage=args.stage, dataset=args.dataset):
+        print("{:<40}{:>6}{:>7}".format(row["model"], row["runs"], row["folds"]) +
+              "".join("{:>18}".format("-" if row[m] is None else "{:.4f} ± {:.4f}".format(row[m], row[m+"_std"]))
+                      for m in METRICS))
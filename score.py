@@ -0,0 +1,261 @@
+import io
+import os
+import csv
+import json
+import time
+import argparse
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+# offline scoring of (paratope, epitope) pairs with a saved checkpoint or the fold ensemble of a cov_train model
+# python score.py pairs.csv scores.csv --checkpoint ./results/CoV-AbDab/pesi/model_0_best.pth --workers 8
+# python score.py pairs.parquet scores.csv --ensemble pesi_ft --workers 4 --threads 2
+# - the input is read in chunks of --chunk_size rows (csv or parquet), columns --para_col / --epi_col
+#   (CoV-AbDab's Paratope / Epitope), --id_col is copied to the output
+# - workers score whole chunks on the CPU: pairs are sorted by length, padded per batch and tokenized with
+#   utils.to_index for models taking token indices (the others tokenize in forward as in training)
+# - at most 2 chunks per worker are in flight and chunks are written in input order, so memory stays bounded
+#   whatever the input size
+# - <output>.progress.json records the rows written and the size of the output after every chunk, a run started
+#   again with the same arguments truncates the output to that size and resumes after the last written chunk
+# - output csv: id (or row), prob, plus var (over folds) for --ensemble; rows with an empty sequence get no score
+
+# per-process state of a worker, set by init_worker
+_worker = {}
+
+
+def init_worker(checkpoint, ensemble, kfold, threads, counter):
+    '''
+    :param checkpoint:  checkpoint path of a single model
+    :param ensemble:    cov_train model name whose fold checkpoints are averaged, instead of checkpoint
+    :param kfold:       number of folds of the ensemble
+    :param threads:     torch / OpenMP threads of this worker
+    :param counter:     shared mp.Value, gives each worker its index
+    '''
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+
+    # before torch is imported, so that OpenMP / MKL pools are created with the right size
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(threads)
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        mine = cores[index*threads % len(cores):][:threads]
+        if len(mine)==threads:
+            os.sched_setaffinity(0, mine)
+
+    import torch
+    import torch.nn as nn
+
+    torch.set_num_threads(threads)
+    # the models move their inputs with .cuda() in forward, scoring runs on the CPU
+    torch.Tensor.cuda = lambda self, *args, **kwargs: self
+    nn.Module.cuda = lambda self, *args, **kwargs: self
+
+    if ensemble is not None:
+        from fold_ensemble import FoldEnsemble
+        _worker["ensemble"] = FoldEnsemble(ensemble, kfold=kfold, device="cpu")
+    else:
+        from checkpoint import load_model
+        _worker["model"] = load_model(checkpoint, device="cpu").eval()
+
+
+def predict_batch(model, paras, epis):
+    import torch
+    from dataset import pad_pairs
+    from utils import to_index, seq_lens
+
+    paras, epis = pad_pairs(paras, epis)
+    if getattr(model, "accepts_index", False):
+        out = model(torch.from_numpy(to_index(paras)).long(), torch.from_numpy(to_index(epis)).long())
+    elif getattr(model, "accepts_lens", False):
+        out = model(paras, epis, torch.from_numpy(seq_lens(paras)), torch.from_numpy(seq_lens(epis)))
+    else:
+        out = model(paras, epis)
+    # use_BSS models return (pred, BSS)
+    out = out[0] if isinstance(out, tuple) else out
+    return out.view(-1).float()
+
+
+def score_chunk(paras, epis, batch_size):
+    '''
+    :return:    probabilities, variance over folds (None for a single model), as lists in input order
+    '''
+    import numpy as np
+    import torch
+
+    if "ensemble" in _worker:
+        mean, var, _ = _worker["ensemble"].predict(paras, epis, batch_size=batch_size)
+        return mean.tolist(), var.tolist()
+
+    model = _worker["model"]
+    order = np.argsort([max(len(p.strip("#")), len(e.strip("#"))) for p, e in zip(paras, epis)], kind="stable")
+    out = torch.empty(len(paras))
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start+batch_size]
+            out[torch.from_numpy(idx)] = predict_batch(model, [paras[i] for i in idx], [epis[i] for i in idx])
+    return out.tolist(), None
+
+
+def read_chunks(path, columns, chunk_size, skip_chunks=0):
+    '''
+    :param columns:     columns to read
+    :param skip_chunks: chunks already scored, not returned
+    :return:            generator of DataFrames of chunk_size rows
+    '''
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns)
+        chunks = (batch.to_pandas() for batch in batches)
+    else:
+        import pandas as pd
+
+        # the scored rows are skipped by the parser, they are not parsed again
+        chunks = pd.read_csv(path, usecols=columns, chunksize=chunk_size, dtype=str, keep_default_na=False,
+                             skiprows=range(1, 1+skip_chunks*chunk_size))
+        skip_chunks = 0
+
+    for i, chunk in enumerate(chunks):
+        if i>=skip_chunks:
+            yield chunk
+
+
+def load_progress(path, settings):
+    '''
+    :param settings:    arguments the output depends on, a resumed run has to use the same
+    :return:            {"chunks", "rows", "bytes"} of the output written so far
+    '''
+    if not os.path.exists(path):
+        return {"settings": settings, "chunks": 0, "rows": 0, "bytes": 0}
+    progress = json.load(open(path))
+    if progress["settings"]!=settings:
+        print("{} was written with other arguments, remove it to start over".format(path))
+        for k in settings:
+            if progress["settings"].get(k)!=settings[k]:
+                print("\t{}: {} -> {}".format(k, progress["settings"].get(k), settings[k]))
+        exit(1)
+    return progress
+
+
+def save_progress(path, progress):
+    # write next to the target and rename, the progress file is never half-written
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, path)
+
+
+def score(args):
+    settings = {k: getattr(args, k) for k in ["input", "checkpoint", "ensemble", "kfold", "para_col", "epi_col",
+                                              "id_col", "chunk_size"]}
+    progress_path = args.output + ".progress.json"
+    progress = load_progress(progress_path, settings)
+
+    # drop whatever was written after the last recorded chunk
+    out = open(args.output, "r+b" if os.path.exists(args.output) else "wb")
+    out.truncate(progress["bytes"])
+    out.seek(progress["bytes"])
+    if progress["bytes"]==0:
+        header = [args.id_col or "row", "prob"] + (["var"] if args.ensemble is not None else [])
+        out.write((",".join(header) + "\n").encode())
+    if progress["chunks"]>0:
+        print("resuming after {} rows ({} chunks)".format(progress["rows"], progress["chunks"]))
+
+    columns = [args.para_col, args.epi_col] + ([args.id_col] if args.id_col is not None else [])
+    chunks = read_chunks(args.input, columns, args.chunk_size, skip_chunks=progress["chunks"])
+
+    # spawn: the workers import torch themselves, with their thread settings
+    ctx = mp.get_context("spawn")
+    counter = ctx.Value("i", 0)
+
+    start = time.time()
+    last_print = start
+    rows_start = progress["rows"]
+    next_row = progress["rows"]
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx, initializer=init_worker,
+                                 initargs=(args.checkpoint, args.ensemble, args.kfold, args.threads, counter)) as executor:
+            pending = deque()
+            exhausted = False
+            while not exhausted or len(pending)>0:
+                # keep 2 chunks per worker in flight
+                while not exhausted and len(pending)<2*args.workers:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    chunk = chunk.fillna("")
+                    paras = chunk[args.para_col].astype(str).str.strip().tolist()
+                    epis = chunk[args.epi_col].astype(str).str.strip().tolist()
+                    valid = [i for i, (p, e) in enumerate(zip(paras, epis)) if len(p)>0 and len(e)>0]
+                    ids = (chunk[args.id_col].astype(str).tolist() if args.id_col is not None
+                           else [str(next_row + i) for i in range(len(chunk))])
+                    next_row += len(chunk)
+                    future = executor.submit(score_chunk, [paras[i] for i in valid], [epis[i] for i in valid],
+                                             args.batch_size)
+                    pending.append((ids, valid, future))
+                if len(pending)==0:
+                    break
+
+                # in input order
+                ids, valid, future = pending.popleft()
+                probs, var = future.result()
+                cols = [[""] * len(ids) for _ in range(1 if var is None else 2)]
+                for j, i in enumerate(valid):
+                    cols[0][i] = "{:.6g}".format(probs[j])
+                    if var is not None:
+                        cols[1][i] = "{:.6g}".format(var[j])
+                lines = io.StringIO()
+                csv.writer(lines, lineterminator="\n").writerows([row_id] + [c[i] for c in cols] for i, row_id in enumerate(ids))
+                out.write(lines.getvalue().encode())
+                out.flush()
+                # on disk before the progress file points past it
+                os.fsync(out.fileno())
+
+                progress["chunks"] += 1
+                progress["rows"] += len(ids)
+                progress["bytes"] = out.tell()
+                save_progress(progress_path, progress)
+
+                now = time.time()
+                if now - last_print>=args.log_interval:
+                    last_print = now
+                    print("{} rows scored\t{:.0f} rows/s".format(progress["rows"],
+                                                                   (progress["rows"] - rows_start) / (now - start)))
+    finally:
+        out.close()
+
+    seconds = time.time() - start
+    rows = progress["rows"] - rows_start
+    print("{} rows scored in {:.1f}s, {:.0f} rows/s, {} workers x {} threads\tscores written to {}".format(
+        rows, seconds, rows / max(seconds, 1e-9), args.workers, args.threads, args.output))
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="score (paratope, epitope) pairs of a csv / parquet file")
+    parser.add_argument("input", type=str, help="csv, or parquet (.parquet)")
+    parser.add_argument("output", type=str, help="csv of the scores")
+    parser.add_argument("--checkpoint", type=str, default=None, help="checkpoint of one model (checkpoint.save_model)")
+    parser.add_argument("--ensemble", type=str, default=None, help="cov_train model name, e.g. pesi_ft, mean of its folds")
+    parser.add_argument("--kfold", type=int, default=10, help="folds of --ensemble")
+    parser.add_argument("--para_col", type=str, default="Paratope")
+    parser.add_argument("--epi_col", type=str, default="Epitope")
+    parser.add_argument("--id_col", type=str, default=None, help="copied to the output, default the row number")
+    parser.add_argument("--chunk_size", type=int, default=8192, help="rows per chunk")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=None, help="default cpu count / threads")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per worker")
+    parser.add_argument("--log_interval", type=float, default=30.0, help="seconds between progress lines")
+    args = parser.parse_args()
+
+    if (args.checkpoint is None)==(args.ensemble is None):
+        print("give either --checkpoint or --ensemble")
+        exit(1)
+    args.workers = args.workers or max(1, os.cpu_count() // args.threads)
+
+    score(args)
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import resource
+
+import profiling
+
+
+# training telemetry of pre_train.py / cov_train.py, instead of tqdm bars and multi-line epoch prints
+# one JSONL line per `every` train steps and one per epoch:
+#   {"kind": "step" | "epoch", "epoch", "step", "samples_per_s", "tokens_per_s", "padding",
+#    "data_wait_s", "compute_s", "peak_rss_mb", "peak_cuda_mb", ...}
+# epoch lines also carry the eval phase, the history record (loss, val_loss, metrics) and, when
+# profiling.start_timing() is active, the stage timer summary of the epoch as "stages"
+# - tokens are the residues of the collate_fn string batches ("+ABCD-###": 6 tokens, 3 of them "#" padding),
+#   ESM feature batches count samples only
+# - data wait is the time spent in the loader, compute is the rest of the phase; steps are not synchronised
+#   with the GPU, so the split is exact over a phase (which ends with a .item()) and approximate per window
+# - console output is one line per epoch, at most every `interval` seconds (the first and last epoch always)
+
+MB = 1024 * 1024
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / MB if sys.platform=="darwin" else rss / 1024
+
+
+def peak_cuda_mb():
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    return torch.cuda.max_memory_allocated() / MB
+
+
+def batch_tokens(batch):
+    '''
+    :param batch:   collate_fn / pair_collate_fn batch, sequences first, or a tuple of them (fold_stack)
+    :return:        samples, residue tokens, padded tokens (None for tensor batches)
+    '''
+    if isinstance(batch, tuple) and isinstance(batch[0], (list, tuple)) and isinstance(batch[0][0], (list, tuple)):
+        counts = [batch_tokens(b) for b in batch]
+        if any(c[1] is None for c in counts):
+            return sum(c[0] for c in counts), None, None
+        return tuple(sum(c[i] for c in counts) for i in range(3))
+
+    seqs = [b for b in batch if isinstance(b, (list, tuple)) and len(b)>0 and isinstance(b[0], str)]
+    samples = len(batch[0])
+    if len(seqs)==0:
+        return samples, None, None
+
+    tokens = sum(len(s.rstrip("#")) for b in seqs for s in b)
+    padded = sum(len(s) for b in seqs for s in b)
+    return samples, tokens, padded
+
+
+class PhaseStats(object):
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = self.start
+        self.steps = 0
+        self.samples = 0
+        self.tokens = 0
+        self.padded = 0
+        self.wait = 0.0
+
+    def add(self, samples, tokens, padded, wait):
+        self.steps += 1
+        self.samples += samples
+        self.tokens += tokens or 0
+        self.padded += padded or 0
+        self.wait += wait
+
+    def summary(self, prefix=""):
+        seconds = max(self.end - self.start, 1e-9)
+        summary = {"steps": self.steps,
+                   "seconds": seconds,
+                   "samples_per_s": self.samples / seconds,
+                   "tokens_per_s": self.tokens / seconds if self.padded>0 else None,
+                   "padding": 1 - self.tokens / self.padded if self.padded>0 else None,
+                   "data_wait_s": self.wait,
+                   "compute_s": seconds - self.wait}
+        return {prefix+k: v for k, v in summary.items()}
+
+
+class Telemetry(object):
+    def __init__(self, path=None, every=50, interval=30.0, epochs=None, tag=None):
+        '''
+        :param path:        JSONL file, None for console only; an existing file is replaced
+        :param every:       train steps per step record, 0 for epoch records only
+        :param interval:    minimum seconds between console lines
+        :param epochs:      total number of epochs, its last epoch is always printed
+        :param tag:         prefix of the console lines, e.g. the model name and fold
+        '''
+        self.every = every
+        self.interval = interval
+        self.epochs = epochs
+        self.tag = tag
+        self.file = None
+        if path is not None:
+            if os.path.dirname(path)!="":
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, "w")
+
+        self.epoch = 0
+        self.step = 0
+        self.phases = {}
+        self.values = {}
+        self.last_print = None
+
+    def iterate(self, loader, phase="train"):
+        '''
+        yields the batches of loader and records their data wait, samples and tokens under phase
+        '''
+        stats = self.phases[phase] = PhaseStats()
+        window = PhaseStats()
+        timer = profiling.current_timer()
+        t = time.perf_counter()
+        for batch in loader:
+            samples, tokens, padded = batch_tokens(batch)
+            now = time.perf_counter()
+            stats.add(samples, tokens, padded, now - t)
+            window.add(samples, tokens, padded, now - t)
+            if timer is not None:
+                timer.add("data" if phase=="train" else "eval_data", now - t)
+
+            yield batch
+
+            t = time.perf_counter()
+            stats.end = window.end = t
+            if phase=="train":
+                self.step += 1
+                # one stage timer step per train step, the validation phase is one step closed by end_epoch
+                if timer is not None:
+                    timer.step()
+                if self.every>0 and window.steps==self.every:
+                    self.write(dict({"kind": "step", "epoch": self.epoch, "step": self.step},
+                                    **window.summary(), **self.values))
+                    window = PhaseStats()
+
+    def update(self, **values):
+        # latest scalars (e.g. the train loss), added to the next step record
+        self.values.update(values)
+
+    def end_epoch(self, record):
+        '''
+        :param record:  history record of the epoch, with "epoch" and the losses / metrics
+        '''
+        out = {"kind": "epoch", "epoch": record.get("epoch", self.epoch), "step": self.step}
+        for phase, stats in self.phases.items():
+            out.update(stats.summary(prefix="" if phase=="train" else phase+"_"))
+        out.update(record)
+        timer = profiling.current_timer()
+        if timer is not None:
+            timer.step()
+            out["stages"] = timer.summary()
+            timer.next_epoch()
+        self.write(out)
+
+        now = time.perf_counter()
+        last = self.epochs is not None and out["epoch"]==self.epochs-1
+        if self.last_print is None or last or now - self.last_print>=self.interval:
+            self.last_print = now
+            print(self.format(out), flush=True)
+
+        self.epoch = out["epoch"] + 1
+        self.phases = {}
+        self.values = {}
+
+    def format(self, out):
+        line = [] if self.tag is None else [str(self.tag)]
+        line.append("epoch {}".format(out["epoch"]))
+        for k in ["loss", "val_loss", "acc", "f1", "auc", "gmean", "mcc"]:
+            if out.get(k) is not None:
+                line.append("{} {:.4f}".format(k, out[k]))
+        if "samples_per_s" in out:
+            line.append("{:.0f} samples/s".format(out["samples_per_s"]))
+        if out.get("tokens_per_s") is not None:
+            line.append("{:.0f} tok/s pad {:.0%}".format(out["tokens_per_s"], out["padding"]))
+        if "seconds" in out:
+            line.append("wait {:.0%}".format(out["data_wait_s"] / out["seconds"]))
+        line.append("rss {:.0f}MB".format(out["peak_rss_mb"]))
+        return "  ".join(line)
+
+    def write(self, out):
+        out["time"] = time.time()
+        out["peak_rss_mb"] = peak_rss_mb()
+        out["peak_cuda_mb"] = peak_cuda_mb()
+        if self.file is not None:
+            self.file.write(json.dumps(out) + "\n")
+            if out["kind"]=="epoch":
+                self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,4 +1,5 @@
 import copy
+import pickle
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
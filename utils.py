@@ -1,16 +1,15 @@
 import os
 import copy
+import hashlib
 import heapq
 import pickle
 import random
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from tqdm import tqdm
 
 import torch
 import torch.nn as nn
-from Bio import Align
+
+from profiling import timed
 
 
 def set_seed(seed=3407):
@@ -23,8 +22,6 @@ def set_seed(seed=3407):
     torch.backends.cudnn.deterministic = True
     os.environ['PYTHONHASHSEED'] = str(seed)
 
-set_seed(seed=3407)
-
 
 vocab = {
     'A': 0,
@@ -70,6 +67,7 @@ def toOneHot(seq, seq_length=128):
         
     return np.array((li+pad))
 
+@timed("tokenize")
 def to_onehot(seq, mode=0):
     li = []
 
@@ -90,7 +88,62 @@ def to_onehot(seq, mode=0):
     return np.array(li)
 
 
+def make_vocab_lut():
+    # ASCII code -> vocab index, characters outside vocab are UNK as in to_onehot
+    lut = np.full(256, vocab["*"], dtype=np.int64)
+    lut[[ord(c) for c in vocab]] = list(vocab.values())
+    return lut
+
+vocab_lut = make_vocab_lut()
+
+@timed("tokenize")
+def to_index(seqs):
+    """tokenize equal-length sequences with one table lookup, same indices as to_onehot(mode=0)
+
+    :param seqs: list of sequences with the same length
+    :return: np.array (batch, seq_len)
+    """
+    if len(seqs)==0:
+        return np.empty((0, 0), dtype=np.int64)
+    codes = np.frombuffer("".join(seqs).encode("latin-1", errors="replace"), dtype=np.uint8)
+
+    return vocab_lut[codes].reshape(len(seqs), -1)
+
+
+def seq_lens(seqs):
+    """number of residues before the trailing "#" padding of each sequence
+
+    :param seqs: list of sequences
+    :return: np.array (batch, )
+    """
+    return np.array([len(seq.rstrip("#")) for seq in seqs], dtype=np.int64)
+
+
+def strip_seq(seq):
+    """residues of a sequence without the "#" padding and the BEGIN/END tokens added by collate_fn
+
+    :param seq: sequence
+    :return: str
+    """
+    seq = seq.rstrip("#")
+    if seq.startswith("+"):
+        seq = seq[1:]
+    if seq.endswith("-"):
+        seq = seq[:-1]
+    return seq
+
+
+def seq_key(seq):
+    """key of a sequence in precomputed feature stores, the same for padded and unpadded forms
+
+    :param seq: sequence
+    :return: str, sha1 hex digest
+    """
+    return hashlib.sha1(strip_seq(seq).encode("utf-8")).hexdigest()
+
+
 def seq_sim(target, query):
+    from Bio import Align
 
     try:
         aligner = Align.PairwiseAligner()
@@ -120,6 +173,7 @@ def get_knearest_epi(data, mode=0, K=48, threshold=10):
 
     :return: [data_entry]
     """
+    from tqdm import tqdm
 
     # get k nearest (K = 48)
     if mode==0:
@@ -211,6 +265,7 @@ def get_knearest_epi(data, mode=0, K=48, threshold=10):
     return data
 
 
+@timed("tokenize")
 def seq_pad_clip(seq, target_length=800):
     """clip sequence to target length
 